@@ -5,6 +5,7 @@ from ._shapes import read_shapefile
 from ._utils import (
     DataLakeError,
     distance,
+    load_trace,
     rawfiles2jsonchunks,
     rawfiles2jsonfile,
     json2geojson,
@@ -11,6 +11,9 @@ KERNEL = [[0.5, 0.5, 0.5],
 
 TARGET_CELL_SIZES_IN_DEG = (.5, .05, .003)
 
+#: Points with speeds no greater than this are used to locate bases.
+MAX_STATIONARY_SPEED = 1.
+
 
 
 class EmptyCellsException(Exception): pass
@@ -23,7 +26,7 @@ def locate_base(lons, lats, speeds,
         minlon = MINLON,
         maxlon = MAXLON,
         cellsizes = TARGET_CELL_SIZES_IN_DEG,
-        maxspeed = 1.):
+        maxspeed = MAX_STATIONARY_SPEED):
 
     lats = np.array(lats)
     lons = np.array(lons)
@@ -75,3 +78,130 @@ def locate_base(lons, lats, speeds,
 
         else:
             return meanlon, meanlat
+
+
+
+def locate_bases(vehicle_ids, lons, lats, speeds,
+        minlat = MINLAT,
+        maxlat = MAXLAT,
+        minlon = MINLON,
+        maxlon = MAXLON,
+        cellsizes = TARGET_CELL_SIZES_IN_DEG,
+        maxspeed = MAX_STATIONARY_SPEED):
+    """Locate the bases of many vehicles at once.
+
+    This does what :py:func:`locate_base` does for each vehicle, but handles
+    all vehicles together at each cell size. Instead of building a grid and
+    convolving it for each vehicle, the points are counted in the occupied
+    cells of each vehicle's grid and the (weighted) 3x3 sums are only
+    evaluated around those, which is where the densest neighbourhood must be.
+    The results are the same as those of :py:func:`locate_base`.
+
+    :param vehicle_ids: The id of the vehicle for each point.
+
+    :return: A tuple containing the (sorted, unique) vehicle ids and the
+        longitudes and latitudes of their bases. These are NaN for vehicles
+        whose base could not be located (those for which
+        :py:func:`locate_base` would raise an :py:class:`EmptyCellsException`).
+    """
+    ids, group = np.unique(np.asarray(vehicle_ids), return_inverse=True)
+    group = group.ravel()
+    n = len(ids)
+    keep = np.asarray(speeds) <= maxspeed
+
+    # keep the points for each vehicle together (and in order).
+    order = np.argsort(group[keep], kind='stable')
+    lons = np.asarray(lons, dtype=float)[keep][order]
+    lats = np.asarray(lats, dtype=float)[keep][order]
+    group = group[keep][order]
+
+    base_lons = np.full(n, np.nan)
+    base_lats = np.full(n, np.nan)
+    g_minlat = np.full(n, float(minlat))
+    g_maxlat = np.full(n, float(maxlat))
+    g_minlon = np.full(n, float(minlon))
+    g_maxlon = np.full(n, float(maxlon))
+    weights = np.asarray(KERNEL)
+
+    for cellsize in cellsizes:
+        # the extent of each vehicle's grid, as calculated by Grid.
+        ncol = np.ceil((g_maxlon - g_minlon) / cellsize).astype(np.int64)
+        nrow = np.ceil((g_maxlat - g_minlat) / cellsize).astype(np.int64)
+        top = g_minlat + nrow * cellsize
+        right = g_minlon + ncol * cellsize
+
+        valid = \
+            (lats > g_minlat[group]) & (lats < top[group]) & \
+            (lons > g_minlon[group]) & (lons < right[group])
+        lons, lats, group = lons[valid], lats[valid], group[valid]
+        if len(group) == 0:
+            break
+
+        rows = (nrow[group] - np.floor((lats - g_minlat[group]) / cellsize) - 1) \
+            .astype(np.int64)
+        cols = np.floor((lons - g_minlon[group]) / cellsize).astype(np.int64)
+
+        # counts in the occupied cells, keyed by vehicle and cell.
+        n_cells = int((nrow * ncol).max())
+        def key(g, r, c):
+            return g * n_cells + r * ncol[g] + c
+        cells, counts = np.unique(key(group, rows, cols), return_counts=True)
+        cg = cells // n_cells
+        cr = (cells % n_cells) // ncol[cg]
+        cc = (cells % n_cells) %  ncol[cg]
+
+        # candidates for the densest neighbourhood: cells next to occupied ones.
+        cand = []
+        for dr in (-1, 0, 1):
+            for dc in (-1, 0, 1):
+                r, c = cr + dr, cc + dc
+                ok = (0 <= r) & (r < nrow[cg]) & (0 <= c) & (c < ncol[cg])
+                cand.append(key(cg[ok], r[ok], c[ok]))
+        cand = np.unique(np.concatenate(cand))
+        ag = cand // n_cells
+        ar = (cand % n_cells) // ncol[ag]
+        ac = (cand % n_cells) %  ncol[ag]
+
+        # weighted 3x3 sums. Neighbours off the edge of the grid are reflected
+        # back onto it, as scipy.ndimage.convolve does, and the sums are
+        # truncated as they are when convolving the integer counts in Grid.
+        sums = np.zeros(len(cand))
+        for dr in (-1, 0, 1):
+            for dc in (-1, 0, 1):
+                k = key(ag,
+                    np.clip(ar + dr, 0, nrow[ag] - 1),
+                    np.clip(ac + dc, 0, ncol[ag] - 1))
+                i = np.minimum(np.searchsorted(cells, k), len(cells) - 1)
+                sums += weights[dr + 1, dc + 1] * np.where(cells[i] == k, counts[i], 0)
+        sums = np.floor(sums)
+
+        # the first densest cell for each vehicle (in row major order).
+        order = np.lexsort((cand, -sums, ag))
+        located, first = np.unique(ag[order], return_index=True)
+        best_r = np.zeros(n, dtype=np.int64)
+        best_c = np.zeros(n, dtype=np.int64)
+        best_r[located] = ar[order][first]
+        best_c[located] = ac[order][first]
+
+        inds = (np.abs(rows - best_r[group]) <= 1) & (np.abs(cols - best_c[group]) <= 1)
+        lons, lats, group = lons[inds], lats[inds], group[inds]
+
+        # np.mean for each vehicle (rather than, say, np.bincount) so the
+        # results are the same as locate_base's, to the last bit.
+        has, starts = np.unique(group, return_index=True)
+        ends = np.append(starts[1:], len(group))
+        meanlon = np.array([np.mean(lons[s:e]) for s, e in zip(starts, ends)])
+        meanlat = np.array([np.mean(lats[s:e]) for s, e in zip(starts, ends)])
+
+        if cellsize > cellsizes[-1]:
+            # centers the cells on the average of what's left
+            g_minlat[has] = meanlat - 2.0 * cellsize
+            g_maxlat[has] = meanlat + 2.0 * cellsize
+            g_minlon[has] = meanlon - 2.0 * cellsize
+            g_maxlon[has] = meanlon + 2.0 * cellsize
+
+        else:
+            base_lons[has] = meanlon
+            base_lats[has] = meanlat
+
+    return ids, base_lons, base_lats
@@ -0,0 +1,173 @@
+"""Bulk loading of ORM objects into PostgreSQL using COPY.
+
+The tables and columns written are taken from the models in
+:py:mod:`cvts.models`, which remain the source of truth for the schema.
+"""
+
+import io
+import csv
+import logging
+from collections import defaultdict
+from typing import Callable, Iterable, List
+from sqlalchemy import inspect, text
+from sqlalchemy.orm.interfaces import MANYTOONE
+from .models import Vehicle, Base, Stop, Trip, Traversal
+
+
+
+logger = logging.getLogger(__name__)
+
+#: Models written by :py:class:`BulkLoader`, in an order that satisfies their
+#: foreign keys.
+BULK_MODELS = (Base, Stop, Trip, Traversal)
+
+#: Models for which ids are assigned before writing (because other rows refer
+#: to them). Ids for other models are assigned by the database.
+ID_MODELS = (Stop, Trip)
+
+
+
+def _column_getters(model):
+    """List of (column name, getter) pairs for the columns of *model*.
+
+    Foreign keys are read from the related object (if set) so that objects
+    can be linked through relationships, as they are when using a
+    session."""
+    fks = {}
+    for rel in inspect(model).relationships:
+        if rel.direction is MANYTOONE:
+            for local, remote in rel.local_remote_pairs:
+                fks[local.key] = (rel.key, remote.key)
+
+    def getter(col):
+        if col.key in fks:
+            rel_key, remote_key = fks[col.key]
+            def get(obj):
+                other = getattr(obj, rel_key)
+                return getattr(other, remote_key) if other is not None \
+                    else getattr(obj, col.key)
+            return get
+        return lambda obj: getattr(obj, col.key)
+
+    return [(col.name, getter(col)) for col in model.__table__.columns \
+        if not (col.primary_key and model not in ID_MODELS)]
+
+
+
+class BulkLoader:
+    """Buffers rows for :py:data:`BULK_MODELS` (possibly from many vehicles)
+    and writes them to the database with COPY once *batch_rows* rows have been
+    buffered (or :py:meth:`flush` is called).
+
+    :param engine: SQLAlchemy engine for the (PostgreSQL) database.
+
+    :param batch_rows: The number of rows to buffer before writing.
+
+    :param id_block: The number of ids to reserve from a sequence at a time.
+    """
+
+    def __init__(self, engine, batch_rows: int = 200000, id_block: int = 1000):
+        self.engine = engine
+        self.batch_rows = batch_rows
+        self.id_block = id_block
+        self._getters = {m: _column_getters(m) for m in BULK_MODELS}
+        self._rows = defaultdict(list)
+        self._n_rows = 0
+        self._on_commit = []
+        self._sequences = {}
+        self._ids = defaultdict(list)
+
+    def _sequence(self, conn, model):
+        if model not in self._sequences:
+            pk = model.__table__.primary_key.columns.values()[0]
+            self._sequences[model] = conn.execute(
+                text('SELECT pg_get_serial_sequence(:t, :c)'),
+                {'t': model.__tablename__, 'c': pk.name}).scalar()
+        return self._sequences[model]
+
+    def _reserve_ids(self, conn, model, n):
+        ids = self._ids[model]
+        if len(ids) < n:
+            ids.extend(conn.execute(
+                text('SELECT nextval(:s) FROM generate_series(1, :n)'),
+                {'s': self._sequence(conn, model),
+                 'n': max(n - len(ids), self.id_block)}).scalars())
+        res, ids[:n] = ids[:n], []
+        return res
+
+    def _ensure_vehicle(self, vehicle):
+        # adding the vehicle to a session would cascade to the objects linked
+        # to it, so insert it directly.
+        if vehicle.id is None:
+            with self.engine.begin() as conn:
+                vehicle.id = conn.execute(
+                    Vehicle.__table__.insert().values({
+                        n: g(vehicle) for n, g in _column_getters(Vehicle)}).returning(
+                        Vehicle.__table__.c.id)).scalar()
+
+    def add(
+            self,
+            vehicle,
+            base,
+            stops: List[Stop],
+            trips: List[Trip],
+            travs: Iterable[Traversal],
+            on_commit: Callable[[], None] = None):
+        """Buffer the rows for a vehicle.
+
+        :param on_commit: Called once the rows have been committed.
+        """
+        self._ensure_vehicle(vehicle)
+
+        objs = [s for s in stops if s.id is None], \
+               [t for t in trips if t.id is None]
+        with self.engine.connect() as conn:
+            for model, os_ in zip(ID_MODELS, objs):
+                for obj, id_ in zip(os_, self._reserve_ids(conn, model, len(os_))):
+                    obj.id = id_
+            conn.commit()
+
+        for model, os_ in zip(BULK_MODELS, ([] if base is None else [base],) + objs):
+            getters = self._getters[model]
+            self._rows[model].extend(tuple(g(o) for _, g in getters) for o in os_)
+            self._n_rows += len(os_)
+
+        getters = self._getters[Traversal]
+        rows = self._rows[Traversal]
+        n = len(rows)
+        rows.extend(tuple(g(t) for _, g in getters) for t in travs)
+        self._n_rows += len(rows) - n
+
+        if on_commit is not None:
+            self._on_commit.append(on_commit)
+
+        if self._n_rows >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered rows in a single transaction."""
+        if self._n_rows == 0 and not self._on_commit:
+            return
+
+        rows, self._rows = self._rows, defaultdict(list)
+        callbacks, self._on_commit = self._on_commit, []
+        n_rows, self._n_rows = self._n_rows, 0
+
+        # if this fails, the rows are dropped and the callbacks not called, so
+        # the vehicles they came from will be processed again on the next run.
+        with self.engine.begin() as conn:
+            cursor = conn.connection.cursor()
+            for model in BULK_MODELS:
+                if not rows[model]:
+                    continue
+                # None is written as an unquoted empty field, which is NULL.
+                buf = io.StringIO()
+                csv.writer(buf).writerows(rows[model])
+                buf.seek(0)
+                cursor.copy_expert('COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+                    model.__tablename__,
+                    ', '.join(n for n, _ in self._getters[model])), buf)
+
+        logger.debug('bulk loaded {} rows'.format(n_rows))
+        for cb in callbacks:
+            cb()
@@ -1,9 +1,14 @@
 import os
 from os.path import join, isfile, isdir
 from datetime import date
-from typing import Iterable
+from typing import Dict, Iterable, Tuple
+import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine
+from sqlalchemy import bindparam, create_engine, text
+from ._trace import make_trace, concatenate_traces
+from ._trace_cache import TraceCache, day_slices, _day, _EPOCH
+from ._timer import tally
+from .settings import TRACE_CACHE, TRACE_CACHE_PATH
 
 DATALAKE_CONNECTION_STRING = os.environ['DATALAKE_CONNECTION_STRING']
 RAW_PATH = os.environ['DATALAKE_RAW_PATH']
@@ -23,27 +28,111 @@ def list_of_vehicles() -> pd.DataFrame:
     return pd.read_sql(sql, conn)
 
 
-def vehicle_trace(vehicle_id: str, dates: Iterable[date]) -> dict:
-    """Creates a list of GPS records for a given vehicle for the specified
+def vehicle_pings(dates: Iterable[date] = None) -> pd.Series:
+    """Queries the *vehicle_days* table for the number of GPS pings recorded
+    for each vehicle on *dates*.
+
+    :param dates: dates to count pings for. If *None*, all days are counted.
+
+    :return: A Pandas Series of ping counts indexed by vehicle ID
+    """
+    engine = create_engine(DATALAKE_CONNECTION_STRING)
+    params = {}
+    sql = 'select vehicle_id, sum(pings) as pings from vehicle_days'
+    if dates is not None:
+        sql += ' where day in :days'
+        params['days'] = list(dates)
+    sql = text(sql + ' group by vehicle_id')
+    if dates is not None:
+        sql = sql.bindparams(bindparam('days', expanding=True))
+
+    with engine.connect() as conn:
+        df = pd.read_sql(sql, conn, params=params)
+    return df.set_index('vehicle_id')['pings']
+
+
+def _read_month(filename: str) -> np.ndarray:
+    """Read a monthly file for a vehicle from the data lake."""
+    tally('bytes_read', os.path.getsize(filename))
+    df = pd.read_csv(filename)
+    df.columns = ['time', 'speed', 'lon', 'lat', 'heading']
+    return make_trace(
+        lat     = df['lat'].values,
+        lon     = df['lon'].values,
+        time    = df['time'].values,
+        heading = df['heading'].values,
+        speed   = df['speed'].values)
+
+
+_trace_cache = None
+def _month(filename):
+    """The trace for a monthly file and its index of days (see
+    :py:meth:`cvts._trace_cache.TraceCache.get`)."""
+    global _trace_cache
+    if _trace_cache is None:
+        _trace_cache = TraceCache(TRACE_CACHE_PATH, RAW_PATH)
+    return _trace_cache.get(filename, _read_month)
+
+
+def vehicle_days(
+        dates: Iterable[date] = None,
+        min_pings: int = 1,
+        bbox: Tuple[float, float, float, float] = None) -> Dict[int, Dict[date, int]]:
+    """Queries the *vehicle_days* table for the days on which each vehicle
+    recorded GPS pings.
+
+    :param dates: dates to consider. If *None*, all days are considered.
+
+    :param min_pings: vehicles with fewer pings than this (over all the days
+        considered) are omitted.
+
+    :param bbox: If given, only days on which the vehicle's bounding box
+        intersects this box (min lon, min lat, max lon, max lat) are
+        considered. This requires the data lake to be in PostGIS.
+
+    :return: A dictionary keyed by vehicle ID of dictionaries mapping the days
+        on which the vehicle recorded pings to the number of pings.
+    """
+    engine = create_engine(DATALAKE_CONNECTION_STRING)
+    where, params = ['pings > 0'], {}
+    if dates is not None:
+        where.append('day in :days')
+        params['days'] = list(dates)
+    if bbox is not None:
+        where.append('ST_Intersects(geom, ST_MakeEnvelope(' \
+            ':minlon, :minlat, :maxlon, :maxlat, ST_SRID(geom)))')
+        params.update(zip(('minlon', 'minlat', 'maxlon', 'maxlat'), bbox))
+    sql = text('select vehicle_id, day, pings from vehicle_days where ' + \
+        ' and '.join(where))
+    if dates is not None:
+        sql = sql.bindparams(bindparam('days', expanding=True))
+
+    with engine.connect() as conn:
+        df = pd.read_sql(sql, conn, params=params)
+
+    df['day'] = pd.to_datetime(df['day']).dt.date
+    days = {}
+    for vehicle_id, vdf in df.groupby('vehicle_id'):
+        if vdf['pings'].sum() >= min_pings:
+            days[int(vehicle_id)] = dict(zip(vdf['day'], vdf['pings'].astype(int).tolist()))
+    return days
+
+
+def vehicle_trace(vehicle_id: str, dates: Iterable[date]) -> np.ndarray:
+    """Creates a trace of GPS records for a given vehicle for the specified
     *dates*..
 
+    If :py:data:`cvts.settings.TRACE_CACHE` is set, each monthly file is
+    converted to a trace once and cached, and the records for *dates* are
+    sliced from that.
+
     :param vehicle_id: Vehicle ID as archived in the data lake. Correspondence
         between alphanumerical hash and integer ID is in the project database
 
     :param dates: dates for which we wish to extract data.
 
-    :return: A list of dicts for GPS pings. Each list element is an individual
-        GPS ping:
-
-            {
-                'lat':     latitude/y,
-                'lon':     longitude/x,
-                'time':    datetime,
-                'heading': heading,
-                'speed':   speed,
-                'heading_tolerance': 45,
-                'type':    'via'
-            }
+    :return: A trace (see :py:mod:`cvts._trace`) with an element for each
+        GPS ping.
     """
     data = []
     data_month = {}
@@ -55,14 +144,17 @@ def vehicle_trace(vehicle_id: str, dates: Iterable[date]) -> dict:
         if not isfile(filename):
             continue
         if fldr_month not in data_month:
-            data_month[fldr_month] = pd.read_csv(filename)
+            if TRACE_CACHE:
+                data_month[fldr_month] = _month(filename)
+            else:
+                trace = _read_month(filename)
+                data_month[fldr_month] = (trace, _day(trace['time']))
 
-        df = data_month[fldr_month]
-        data.append(df[pd.to_datetime(df.datetime, unit='s').dt.date == date])
-    try:
-        df = pd.concat(data)
-    except ValueError as e:
+        trace, index = data_month[fldr_month]
+        if TRACE_CACHE:
+            data.extend(day_slices(trace, index, [date]))
+        else:
+            data.append(trace[index == date.toordinal() - _EPOCH])
+    if len(data) == 0:
         raise NoRawDataException(vehicle_id)
-    df.columns = ['time', 'speed', 'lon', 'lat', 'heading']
-    df = df.assign(type='via', heading_tolerance=45)
-    return df.to_dict('records')
+    return concatenate_traces(data)
@@ -0,0 +1,103 @@
+"""Deterministic stand-in for Valhalla's trace_attributes service.
+
+Points are 'matched' to the cells of a regular grid, each of which is treated
+as an edge, so the same request always gets the same response without needing
+Valhalla or a road network. This is meant for tests and benchmarks (see
+*scripts/benchfleet*). Run as::
+
+    python -m cvts._fake_matcher              # like cvts._matcher_service
+    python -m cvts._fake_matcher --http PORT  # like a trace_attributes server
+"""
+
+import sys
+import json
+from math import floor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict
+from ._polyline import encode_coords
+
+
+
+#: Size, in degrees, of the grid cells used as edges.
+EDGE_SIZE = 0.002
+
+
+
+def _edge_id(lon, lat):
+    return floor(lon / EDGE_SIZE) * 1000000 + floor(lat / EDGE_SIZE)
+
+
+
+def trace_attributes(request: Dict[str, Any]) -> Dict[str, Any]:
+    """The response to a trace_attributes *request*.
+
+    Consecutive points in the same grid cell are matched to the same edge.
+    Traces with fewer than two points are errors, as they are for Valhalla.
+    """
+    shape = request['shape']
+    if len(shape) < 2:
+        return {'error_code': 443, 'error': 'Need at least two points'}
+
+    edges, matched_points = [], []
+    for p in shape:
+        edge_id = _edge_id(p['lon'], p['lat'])
+        if not edges or edges[-1]['id'] != edge_id:
+            edges.append({
+                'id'         : edge_id,
+                'way_id'     : edge_id // 4,
+                'speed'      : 40,
+                'speed_limit': 50,
+                'names'      : ['synthetic']})
+        matched_points.append({
+            'lat'       : p['lat'],
+            'lon'       : p['lon'],
+            'type'      : 'matched',
+            'edge_index': len(edges) - 1})
+
+    # Valhalla encodes shapes with six decimal places.
+    return {
+        'edges'         : edges,
+        'matched_points': matched_points,
+        'shape'         : encode_coords(
+            [(p['lon'] * 10., p['lat'] * 10.) for p in shape])}
+
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        result = trace_attributes(request)
+        body = json.dumps(result).encode()
+        self.send_response(400 if 'error' in result else 200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+
+def serve_lines():
+    """Respond to one request per line on stdin until it is closed."""
+    for line in sys.stdin:
+        if line.strip():
+            sys.stdout.write(json.dumps(trace_attributes(json.loads(line))) + '\n')
+            sys.stdout.flush()
+
+
+
+def serve_http(port: int, host: str = 'localhost'):
+    """Respond to requests posted to *host*:*port* until killed."""
+    ThreadingHTTPServer((host, port), _Handler).serve_forever()
+
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--http':
+        serve_http(int(sys.argv[2]))
+    else:
+        serve_lines()
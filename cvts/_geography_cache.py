@@ -0,0 +1,114 @@
+"""Content addressed, on disk cache of geographies prepared for intersecting.
+
+Reading a shapefile with :py:func:`cvts.read_shapefile` splits multipolygons
+and repairs invalid polygons, which can take minutes for large geographies.
+The result (the keys, polygons and bounding boxes) is cached as arrays, with
+the polygons as WKB, keyed by the contents of the shapefile, the id field, the
+version of shapely and a version of the preparation.
+"""
+
+import os
+import logging
+from glob import glob, escape
+from hashlib import sha256 as _hasher
+from typing import Callable, Tuple
+import numpy as np
+import shapely
+import shapely.wkb
+
+
+
+logger = logging.getLogger(__name__)
+
+#: Is shapely 2 (which can read many geometries at once) available.
+_SHAPELY_2 = int(shapely.__version__.split('.')[0]) >= 2
+
+_CHUNK_SIZE = 1 << 20
+
+#: The extensions of the files of a shapefile which are read.
+_COMPONENTS = ('.shp', '.shx', '.dbf', '.prj', '.cpg')
+
+
+
+class GeographyCache:
+    """On disk cache of prepared geographies.
+
+    Each geography is stored as a *.npz* file, named by the key, under *path*.
+    Several processes may share a cache.
+
+    :param path: The directory to store geographies in.
+
+    :param version: Included in every key. Change it to invalidate the cache
+        (e.g., when the way geographies are prepared changes).
+    """
+
+    def __init__(self, path: str, version: str = ''):
+        self.path = path
+        self.version = version
+
+    def key(self, filename: str, geometry_id_field: str) -> str:
+        """Hash of the version, the version of shapely, the components of the
+        shapefile *filename* (the files with the same name and the extensions
+        in :py:data:`_COMPONENTS`) and *geometry_id_field*."""
+        h = _hasher('\0'.join((
+            self.version, shapely.__version__, geometry_id_field)).encode())
+        for component in sorted(glob(escape(os.path.splitext(filename)[0]) + '.*')):
+            ext = os.path.splitext(component)[1].lower()
+            if ext not in _COMPONENTS:
+                continue
+            h.update(ext.encode())
+            with open(component, 'rb') as f:
+                for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+                    h.update(chunk)
+        return h.hexdigest()
+
+    def _file_name(self, key):
+        return os.path.join(self.path, key + '.npz')
+
+    def get(
+            self,
+            filename: str,
+            geometry_id_field: str,
+            read: Callable[[str, str], Tuple]) -> Tuple:
+        """The prepared geography for the shapefile *filename*, reading it
+        first (by calling *read* with *filename* and *geometry_id_field*) if
+        it is not in the cache.
+
+        :return: A tuple containing the geometry ids, polygons and bounding
+            boxes (see :py:func:`cvts.read_shapefile`).
+        """
+        fn = self._file_name(self.key(filename, geometry_id_field))
+        try:
+            with np.load(fn) as data:
+                keys, boxes = data['keys'], data['boxes']
+                wkb, offsets = data['wkb'].tobytes(), data['offsets'].tolist()
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning('ignoring corrupt cached geography {}: {}'.format(fn, e))
+        else:
+            wkbs = [wkb[s:e] for s, e in zip(offsets[:-1], offsets[1:])]
+            if _SHAPELY_2:
+                polys = list(shapely.from_wkb(np.array(wkbs, dtype=object)))
+            else:
+                polys = [shapely.wkb.loads(w) for w in wkbs]
+            return keys, polys, boxes
+
+        keys, polys, boxes = read(filename, geometry_id_field)
+        self._put(fn, keys, polys, boxes)
+        return keys, polys, boxes
+
+    def _put(self, fn, keys, polys, boxes):
+        wkbs = [p.wkb for p in polys]
+        offsets = np.cumsum([0] + [len(w) for w in wkbs])
+
+        os.makedirs(self.path, exist_ok=True)
+        # numpy adds the extension if it is missing.
+        tmp = '{}.{}.tmp.npz'.format(fn, os.getpid())
+        np.savez(
+            tmp,
+            keys    = keys,
+            boxes   = boxes,
+            wkb     = np.frombuffer(b''.join(wkbs), dtype=np.uint8),
+            offsets = offsets)
+        os.replace(tmp, fn)
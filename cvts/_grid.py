@@ -1,3 +1,4 @@
+import os
 from math import floor, ceil
 import numpy as np
 import logging
@@ -23,9 +24,29 @@ CELLSIZE =   0.1
 #: NA value to use for the raster 'covering' Vietnam.
 NA_VALUE = -9999
 
+#: Largest number of cells for which :py:func:`new_grid` returns a (dense)
+#: :py:class:`Grid`; larger rasters are a :py:class:`SparseGrid`.
+MAX_DENSE_CELLS = 10000000
+
 logger = logging.getLogger(__name__)
 
 
+def _add_counts(keys, counts, new_keys, new_counts):
+    """Add *new_counts* for the cells *new_keys* to the counts *counts* for the
+    (sorted, unique) cells *keys*.
+
+    :return: The sorted, unique keys and their counts.
+    """
+    keys, inverse = np.unique(
+        np.concatenate((keys, new_keys)), return_inverse=True)
+    counts = np.bincount(
+        inverse.ravel(),
+        np.concatenate((counts, new_counts)),
+        len(keys)).astype(np.int64)
+    return keys, counts
+
+
+
 class Grid:
     """Raster used for accumulating stop points."""
 
@@ -79,15 +100,78 @@ class Grid:
             dtype='int32')
 
         indexes, counts = np.unique(row_cols, return_counts=True, axis=1)
-        self.cells[indexes[0,:],indexes[1,:]] += counts
+        self._add_cells(indexes[0,:], indexes[1,:], counts)
 
         return row_cols.T, lons, lats
 
+    def _add_cells(self, rows, cols, counts):
+        """Add *counts* to the cells in rows *rows* and columns *cols*."""
+        self.cells[rows, cols] += counts
+
+    def _cell_indexes(self, lons, lats):
+        """The (row major) indexes of the cells :py:meth:`increment` would
+        increment for the points (*lons*, *lats*), skipping points outside the
+        raster, and a mask of the points which were not skipped."""
+        lons = np.asarray(lons, dtype=float)
+        lats = np.asarray(lats, dtype=float)
+        finite = np.isfinite(lons) & np.isfinite(lats)
+        if not finite.all():
+            logger.error('skipping {} points with non-finite coordinates'.format(
+                np.count_nonzero(~finite)))
+            lons, lats = np.where(finite, lons, 0.), np.where(finite, lats, 0.)
+        rows = self.nrow - np.floor((lats - self.minlat) / self.cellsize).astype(np.int64) - 1
+        cols =             np.floor((lons - self.minlon) / self.cellsize).astype(np.int64)
+        ok = finite & (0 <= cols) & (cols < self.ncol) & (0 <= rows) & (rows < self.nrow)
+        return rows[ok] * self.ncol + cols[ok], ok
+
+    def increment_points(self, lons, lats):
+        """Increment the counts in the cells containing the points (*lons*,
+        *lats*), exactly as calling :py:meth:`increment` for each would, but in
+        one (vectorised) pass."""
+        self.cells += np.bincount(
+            self._cell_indexes(lons, lats)[0],
+            minlength = self.cells.size).reshape(self.cells.shape)
+
+    def nonzero(self):
+        """The rows and columns of the cells with non-zero counts, in row major
+        order, and the counts in them."""
+        rows, cols = np.nonzero(self.cells)
+        return rows, cols, self.cells[rows, cols]
+
+    def _check_extent(self, other):
+        if (self.minlat, self.minlon, self.nrow, self.ncol, self.cellsize) != \
+                (other.minlat, other.minlon, other.nrow, other.ncol, other.cellsize):
+            raise ValueError('grids have different extents')
+
+    def merge(self, other):
+        """Add the counts in *other*, which must have the same extent (but may
+        be dense or sparse), to this grid. This is used to sum grids
+        accumulated separately (e.g., by different workers).
+
+        :return: This grid.
+        """
+        self._check_extent(other)
+        self._add_cells(*other.nonzero())
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
     def convolve(self, kernel):
         return convolve(self.cells, kernel)
 
+    def _rows(self):
+        """Generator over the rows of counts, from the top. *None* may be
+        given for rows which are all zero."""
+        for r in range(self.nrow):
+            yield self.cells[r]
+
+    def _max_count(self):
+        return int(self.cells.max()) if self.cells.size else 0
+
     def save(self, fn):
-        """Save as ASCII grid."""
+        """Save as ASCII grid, one row at a time."""
+        empty = None
         with open(fn, 'w') as f:
             f.write('ncols        {}\n'.format(self.ncol))
             f.write('nrows        {}\n'.format(self.nrow))
@@ -95,4 +179,422 @@ class Grid:
             f.write('yllcorner    {}\n'.format(self.minlat))
             f.write('cellsize     {}\n'.format(self.cellsize))
             f.write('NODATA_value {}\n'.format(self.na_value))
-            f.write(' '.join([str(i) for i in self.cells.flatten()]))
+            for r, row in enumerate(self._rows()):
+                if r:
+                    f.write(' ')
+                if row is None:
+                    # most rows of fine rasters are empty.
+                    if empty is None:
+                        empty = ' '.join(['0'] * self.ncol)
+                    f.write(empty)
+                else:
+                    f.write(' '.join(map(str, row.tolist())))
+
+    def save_binary(self, fn):
+        """Save as an ESRI BIL raster, with a header (in the same directory
+        and with the same name as *fn* but the extension *.hdr*), which GIS
+        software (e.g., GDAL) can read, and which can be loaded with
+        :py:func:`load_grid`.
+
+        The counts are written one row at a time, using the smallest integer
+        type which holds them. Rows which are all zero are skipped (rather
+        than written), so they take no space on file systems which support
+        sparse files.
+        """
+        max_count = self._max_count()
+        for dtype in (np.dtype('<i2'), np.dtype('<i4'), np.dtype('<i8')):
+            if max_count <= np.iinfo(dtype).max:
+                break
+
+        with open(os.path.splitext(fn)[0] + '.hdr', 'w') as f:
+            for k, v in (
+                    ('BYTEORDER',    'I'),
+                    ('LAYOUT',       'BIL'),
+                    ('NROWS',        self.nrow),
+                    ('NCOLS',        self.ncol),
+                    ('NBANDS',       1),
+                    ('NBITS',        dtype.itemsize * 8),
+                    ('PIXELTYPE',    'SIGNEDINT'),
+                    # centre of the upper left cell.
+                    ('ULXMAP',       repr(self.minlon + .5 * self.cellsize)),
+                    ('ULYMAP',       repr(self.maxlat - .5 * self.cellsize)),
+                    ('XDIM',         repr(self.cellsize)),
+                    ('YDIM',         repr(self.cellsize)),
+                    ('NODATA',       self.na_value)):
+                f.write('{:<12} {}\n'.format(k, v))
+
+        row_bytes = self.ncol * dtype.itemsize
+        with open(fn, 'wb') as f:
+            for row in self._rows():
+                if row is None:
+                    f.seek(row_bytes, os.SEEK_CUR)
+                else:
+                    f.write(row.astype(dtype).tobytes())
+            f.truncate(self.nrow * row_bytes)
+
+
+
+class SparseGrid(Grid):
+    """Raster used for accumulating stop points, which only stores the cells
+    with non-zero counts.
+
+    The counts are kept as sorted (row major) cell indexes and the counts for
+    each, so memory depends on the number of occupied cells rather than the
+    size of the raster. This makes very fine rasters covering the whole
+    country affordable. The interface is the same as that of :py:class:`Grid`,
+    except that :py:meth:`convolve` returns another :py:class:`SparseGrid`.
+    """
+
+    def __init__(
+            self,
+            minlat   = MINLAT,
+            minlon   = MINLON,
+            maxlat   = MAXLAT,
+            maxlon   = MAXLON,
+            cellsize = CELLSIZE,
+            na_value = NA_VALUE):
+        self.minlat = minlat
+        self.minlon = minlon
+        self.cellsize = cellsize
+        self.na_value = na_value
+        self.ncol = int(ceil((maxlon - minlon) / self.cellsize))
+        self.nrow = int(ceil((maxlat - minlat) / self.cellsize))
+        self.maxlat = minlat + self.nrow * cellsize
+        self.maxlon = minlon + self.ncol * cellsize
+        self._keys = np.empty(0, np.int64)
+        self._counts = np.empty(0, np.int64)
+        # counts from increment, which are merged into the arrays when needed.
+        self._pending = {}
+
+    def _add(self, keys, counts):
+        """Add *counts* to the cells with (row major) indexes *keys*."""
+        self._keys, self._counts = _add_counts(self._keys, self._counts, keys, counts)
+
+    def _flush(self):
+        if self._pending:
+            pending, self._pending = self._pending, {}
+            self._add(
+                np.fromiter(pending.keys(), np.int64, len(pending)),
+                np.fromiter(pending.values(), np.int64, len(pending)))
+
+    def increment(self, lon, lat):
+        """Increment the count in cell containing the point (*lon*, *lat*)."""
+        try:
+            row = self.nrow - int(floor((lat - self.minlat) / self.cellsize)) - 1
+            col =             int(floor((lon - self.minlon) / self.cellsize))
+            if 0 <= col < self.ncol and 0 <= row < self.nrow:
+                key = row * self.ncol + col
+                self._pending[key] = self._pending.get(key, 0) + 1
+            return row, col
+        except ValueError as e:
+            logger.error('value error: {} at ({:.2f}, {:.2f})'.format(e, lat, lon))
+
+    def _add_cells(self, rows, cols, counts):
+        self._add(rows.astype(np.int64) * self.ncol + cols, counts)
+
+    def increment_points(self, lons, lats):
+        """Increment the counts in the cells containing the points (*lons*,
+        *lats*), exactly as calling :py:meth:`increment` for each would, but in
+        one (vectorised) pass."""
+        keys, counts = np.unique(self._cell_indexes(lons, lats)[0], return_counts=True)
+        self._add(keys, counts)
+
+    def nonzero(self):
+        """The rows and columns of the cells with non-zero counts, in row major
+        order, and the counts in them."""
+        self._flush()
+        rows, cols = np.divmod(self._keys, self.ncol)
+        return rows, cols, self._counts
+
+    @property
+    def cells(self):
+        """The counts as a (dense) array. Note that this allocates the whole
+        raster."""
+        cells = np.zeros((self.nrow, self.ncol), int)
+        rows, cols, counts = self.nonzero()
+        cells[rows, cols] = counts
+        return cells
+
+    def convolve(self, kernel):
+        """Convolve the counts with *kernel*, giving the same values as
+        :py:meth:`Grid.convolve` would, but only evaluating them in the cells
+        the kernel reaches from occupied ones.
+
+        :return: A :py:class:`SparseGrid` with the same extent.
+        """
+        kernel = np.asarray(kernel)
+        rows, cols, counts = self.nonzero()
+
+        # convolution is correlation with the flipped kernel; for even sizes
+        # the centre moves, as it does in scipy.ndimage. Each occupied cell
+        # adds its count times the weight to the cell offset from it and to
+        # the cells which read it through reflection at the edges.
+        flipped = kernel[::-1, ::-1]
+        centre = [s // 2 - (1 - s % 2) for s in flipped.shape]
+        reach = max(max(c, s - c - 1) for c, s in zip(centre, flipped.shape))
+        near_edge = (rows < reach) | (rows >= self.nrow - reach) | \
+                    (cols < reach) | (cols >= self.ncol - reach)
+        erows, ecols, ecounts = rows[near_edge], cols[near_edge], counts[near_edge]
+
+        keys, values = [], []
+        for (dr, dc), w in np.ndenumerate(flipped):
+            if w == 0:
+                continue
+            dr, dc = dr - centre[0], dc - centre[1]
+            r, c = rows - dr, cols - dc
+            ok = (0 <= r) & (r < self.nrow) & (0 <= c) & (c < self.ncol)
+            # as the keys are sorted, so are these.
+            keys.append(self._keys[ok] - (dr * self.ncol + dc))
+            values.append(w * counts[ok])
+
+            # cells off the edges read the cells reflected back into the grid.
+            rs = self._reflected(erows, dr, self.nrow, reach)
+            cs = self._reflected(ecols, dc, self.ncol, reach)
+            for i, (r, rok) in enumerate(rs):
+                for j, (c, cok) in enumerate(cs):
+                    if i == len(rs) - 1 and j == len(cs) - 1:
+                        # not reflected, so counted above.
+                        continue
+                    ok = rok & cok
+                    keys.append(r[ok] * self.ncol + c[ok])
+                    values.append(w * ecounts[ok])
+
+        result = SparseGrid.__new__(SparseGrid)
+        result.__dict__.update(self.__dict__)
+        result._pending = {}
+        keys = np.concatenate([np.empty(0, np.int64)] + keys)
+        values = np.concatenate([np.empty(0)] + values)
+        if len(keys) == 0:
+            return result
+
+        # merging the sorted runs is cheap with a stable sort.
+        order = np.argsort(keys, kind='stable')
+        new_key = np.diff(keys[order], prepend=keys[order[0]] - 1) != 0
+        inverse = np.empty(len(keys), np.int64)
+        inverse[order] = np.cumsum(new_key) - 1
+
+        # add the values for each cell in the order of the kernel, as scipy
+        # does, so the sums are rounded the same way, then truncate them, as
+        # in the integer output of scipy.ndimage.convolve.
+        sums = np.zeros(np.count_nonzero(new_key))
+        np.add.at(sums, inverse, values)
+        sums = sums.astype(np.int64)
+        nz = sums != 0
+        result._keys = keys[order][new_key][nz]
+        result._counts = sums[nz]
+        return result
+
+    @staticmethod
+    def _reflected(idx, d, n, reach):
+        """The cells which read the cells *idx* (along an axis of length *n*)
+        at offset *d* (at most *reach*) through reflection at the edges and,
+        last, directly, with masks of which are in the grid.
+
+        Reflection repeats with period *2n*, so position *x* off the grid reads
+        the cell *idx* if *x* is *idx* or *-idx - 1* plus a multiple of *2n*.
+        When the axis is no longer than the reach, positions can be reflected
+        more than once."""
+        periods = reach // (2 * n) + 1
+        xs = [-idx - 1 + 2 * n * k for k in range(-periods, periods + 1)] + \
+             [idx + 2 * n * k for k in range(-periods, periods + 1) if k != 0] + \
+             [idx]
+        return [(x - d, (0 <= x - d) & (x - d < n)) for x in xs]
+
+    def _rows(self):
+        rows, cols, counts = self.nonzero()
+        bounds = np.searchsorted(rows, np.arange(self.nrow + 1))
+        row = np.zeros(self.ncol, int)
+        for r in range(self.nrow):
+            s, e = bounds[r], bounds[r+1]
+            if s == e:
+                yield None
+            else:
+                row[:] = 0
+                row[cols[s:e]] = counts[s:e]
+                yield row
+
+    def _max_count(self):
+        counts = self.nonzero()[2]
+        return int(counts.max()) if len(counts) else 0
+
+
+
+def new_grid(
+        minlat   = MINLAT,
+        minlon   = MINLON,
+        maxlat   = MAXLAT,
+        maxlon   = MAXLON,
+        cellsize = CELLSIZE,
+        na_value = NA_VALUE,
+        max_dense_cells = MAX_DENSE_CELLS):
+    """A :py:class:`Grid`, or a :py:class:`SparseGrid` if the raster would have
+    more than *max_dense_cells* cells."""
+    ncells = ceil((maxlon - minlon) / cellsize) * ceil((maxlat - minlat) / cellsize)
+    cls = Grid if ncells <= max_dense_cells else SparseGrid
+    return cls(minlat, minlon, maxlat, maxlon, cellsize, na_value)
+
+
+
+def load_grid(fn):
+    """Load a raster saved with :py:meth:`Grid.save_binary`.
+
+    :return: A :py:class:`Grid` whose counts are a (read only) memory map of
+        *fn*.
+    """
+    header = {}
+    with open(os.path.splitext(fn)[0] + '.hdr') as f:
+        for line in f:
+            if line.strip():
+                k, v = line.split(None, 1)
+                header[k.upper()] = v.strip()
+
+    nrow, ncol = int(header['NROWS']), int(header['NCOLS'])
+    cellsize = float(header['XDIM'])
+    dtype = np.dtype('<i{}'.format(int(header['NBITS']) // 8))
+
+    grid = Grid.__new__(Grid)
+    grid.nrow = nrow
+    grid.ncol = ncol
+    grid.cellsize = cellsize
+    grid.na_value = int(header.get('NODATA', NA_VALUE))
+    grid.minlon = float(header['ULXMAP']) - .5 * cellsize
+    grid.maxlat = float(header['ULYMAP']) + .5 * cellsize
+    grid.maxlon = grid.minlon + ncol * cellsize
+    grid.minlat = grid.maxlat - nrow * cellsize
+    grid.cells = np.memmap(fn, dtype, 'r', shape=(nrow, ncol))
+    return grid
+
+
+
+#: Seconds since the epoch of midnight on the Monday of the week of the epoch.
+_WEEK_START = -3 * 86400
+
+
+
+class HourOfWeekCube:
+    """Counts of points in each cell of a raster for each hour of the week.
+
+    This is a stack of 168 rasters (the first for the hour from midnight on
+    Monday) with the extent of *grid*, which are filled together. Only the
+    cells with non-zero counts are stored, as sorted indexes of (hour, row,
+    column) and the counts for each.
+
+    :param grid: A :py:class:`Grid` (or :py:class:`SparseGrid`) defining the
+        extent and cell size of the rasters. Its counts are not used. A
+        :py:class:`SparseGrid` with the default extent is used if this is
+        *None*.
+
+    :param utc_offset: The offset, in seconds, from UTC of the time zone in
+        which the hours are counted.
+    """
+
+    #: The number of hours in a week.
+    HOURS = 168
+
+    def __init__(self, grid=None, utc_offset=0):
+        self.grid = grid if grid is not None else SparseGrid()
+        self.utc_offset = utc_offset
+        self._keys = np.empty(0, np.int64)
+        self._counts = np.empty(0, np.int64)
+
+    @property
+    def shape(self):
+        """The shape of the cube as (hours, rows, columns)."""
+        return self.HOURS, self.grid.nrow, self.grid.ncol
+
+    def hours(self, times):
+        """The hours of the week of the times *times* (seconds since the
+        epoch)."""
+        seconds = np.asarray(times, dtype=float) + self.utc_offset - _WEEK_START
+        return (np.floor(seconds / 3600).astype(np.int64)) % self.HOURS
+
+    def _add(self, keys, counts):
+        self._keys, self._counts = _add_counts(self._keys, self._counts, keys, counts)
+
+    def increment_points(self, lons, lats, times):
+        """Increment the counts in the cells containing the points (*lons*,
+        *lats*) in the rasters for the hours of the week of *times* (seconds
+        since the epoch), in one (vectorised) pass. Points are assigned to cells
+        as by :py:meth:`Grid.increment`."""
+        cells, ok = self.grid._cell_indexes(lons, lats)
+        hours = self.hours(np.asarray(times)[ok])
+        keys, counts = np.unique(
+            hours * (self.grid.nrow * self.grid.ncol) + cells,
+            return_counts=True)
+        self._add(keys, counts)
+
+    def merge(self, other):
+        """Add the counts in *other*, which must have the same extent, to this
+        cube.
+
+        :return: This cube.
+        """
+        self.grid._check_extent(other.grid)
+        self._add(other._keys, other._counts)
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def nonzero(self):
+        """The hours, rows and columns of the cells with non-zero counts, in
+        that order, and the counts in them."""
+        hours, cells = np.divmod(self._keys, self.grid.nrow * self.grid.ncol)
+        rows, cols = np.divmod(cells, self.grid.ncol)
+        return hours, rows, cols, self._counts
+
+    def totals(self):
+        """The total count for each hour of the week."""
+        return np.bincount(
+            self._keys // (self.grid.nrow * self.grid.ncol),
+            self._counts,
+            self.HOURS).astype(np.int64)
+
+    def slice(self, hours):
+        """The counts over the hours of the week *hours*, which may be an hour,
+        a :py:class:`slice` or a sequence of hours.
+
+        :return: A :py:class:`SparseGrid` with the extent of the cube.
+        """
+        selected = np.zeros(self.HOURS, bool)
+        selected[hours] = True
+        ncells = self.grid.nrow * self.grid.ncol
+        keep = selected[self._keys // ncells]
+
+        g = self.grid
+        result = SparseGrid(
+            g.minlat, g.minlon, g.maxlat, g.maxlon, g.cellsize, g.na_value)
+        result._add(self._keys[keep] % ncells, self._counts[keep])
+        return result
+
+    def __getitem__(self, hours):
+        return self.slice(hours)
+
+    def save(self, fn):
+        """Save to the (*.npz*) file *fn*, which can be loaded with
+        :py:func:`load_cube`."""
+        g = self.grid
+        np.savez_compressed(
+            fn,
+            keys = self._keys,
+            counts = self._counts,
+            extent = np.array([g.minlat, g.minlon, g.maxlat, g.maxlon, g.cellsize]),
+            shape = np.array([g.nrow, g.ncol]),
+            na_value = g.na_value,
+            utc_offset = self.utc_offset)
+
+
+
+def load_cube(fn):
+    """Load a :py:class:`HourOfWeekCube` saved with
+    :py:meth:`HourOfWeekCube.save`."""
+    with np.load(fn) as data:
+        minlat, minlon, maxlat, maxlon, cellsize = data['extent'].tolist()
+        grid = SparseGrid(minlat, minlon, maxlat, maxlon, cellsize, int(data['na_value']))
+        # rather than recalculating them from the extent, which may round.
+        grid.nrow, grid.ncol = data['shape'].tolist()
+        grid.maxlat, grid.maxlon = maxlat, maxlon
+        cube = HourOfWeekCube(grid, int(data['utc_offset']))
+        cube._keys = data['keys']
+        cube._counts = data['counts']
+    return cube
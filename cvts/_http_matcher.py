@@ -0,0 +1,238 @@
+"""Asyncio client for Valhalla trace_attributes HTTP servers.
+
+Requests are spread over one or more servers (e.g. the prime_server/Valhalla
+instances provisioned by *ops/ansible/roles/mapmatcher*) using pooled
+keep-alive connections, with a bound on the number of requests in flight.
+"""
+
+import json
+import asyncio
+import logging
+from collections import deque
+from urllib.parse import urlsplit
+from typing import Any, Callable, Dict, Iterable, List, Optional
+from ._matcher import MatcherError
+from ._timer import stage
+
+
+
+logger = logging.getLogger(__name__)
+
+
+
+class _Endpoint:
+    """A server we can post requests to, along with its idle connections."""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        if parts.scheme != 'http':
+            raise ValueError('only http urls are supported, got: {}'.format(url))
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path or '/trace_attributes'
+        self.idle = []
+        self.in_flight = 0
+
+    async def connect(self):
+        if self.idle:
+            return self.idle.pop(), True
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        return (reader, writer), False
+
+    def release(self, conn):
+        self.idle.append(conn)
+
+    def close(self):
+        for _, writer in self.idle:
+            writer.close()
+        del self.idle[:]
+
+
+
+async def _read_response(reader):
+    """Read an HTTP response from *reader* returning the status, headers and
+    body."""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError('connection closed by server')
+    status = int(status_line.split()[1])
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        k, v = line.decode('latin-1').split(':', 1)
+        headers[k.strip().lower()] = v.strip()
+
+    if status < 200 or status in (204, 304):
+        # these never have a body.
+        body = b''
+
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+
+    elif headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                await reader.readline()
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        body = b''.join(chunks)
+
+    else:
+        # the body ends when the server closes the connection.
+        body = await reader.read()
+        headers['connection'] = 'close'
+
+    return status, headers, body
+
+
+
+class HttpMatcher:
+    """Client for one or more trace_attributes endpoints.
+
+    Each instance owns an event loop, so the synchronous :py:meth:`imap` can be
+    used from ordinary (e.g. multiprocessing worker) code. Connections are
+    kept alive and reused across calls.
+
+    :param urls: URLs of the trace_attributes endpoints, e.g.
+        *http://localhost:8002/trace_attributes*.
+
+    :param max_in_flight: Maximum number of requests that will be in flight at
+        any time.
+
+    :param timeout: Timeout, in seconds, for each request.
+    """
+
+    def __init__(
+            self,
+            urls: List[str],
+            max_in_flight: int = 8,
+            timeout: float = 300.):
+        self.endpoints = [_Endpoint(u) for u in urls]
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self._loop = asyncio.new_event_loop()
+        self._slots = None
+
+    async def _post(self, endpoint, body):
+        conn, reused = await endpoint.connect()
+        reader, writer = conn
+        try:
+            writer.write((
+                'POST {} HTTP/1.1\r\n'
+                'Host: {}:{}\r\n'
+                'Content-Type: application/json\r\n'
+                'Content-Length: {}\r\n'
+                'Connection: keep-alive\r\n\r\n').format(
+                    endpoint.path,
+                    endpoint.host,
+                    endpoint.port,
+                    len(body)).encode('latin-1') + body)
+            await writer.drain()
+            status, headers, data = await _read_response(reader)
+
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+            if reused:
+                # the server may have dropped an idle connection, so try again
+                # (once) on a fresh one.
+                return await self._post(endpoint, body)
+            raise
+
+        except BaseException:
+            writer.close()
+            raise
+
+        if headers.get('connection', '').lower() == 'close':
+            writer.close()
+        else:
+            endpoint.release(conn)
+
+        return status, data
+
+    async def match(self, trip: Dict[str, Any]) -> Dict[str, Any]:
+        """Post *trip* to the least busy endpoint and return the parsed
+        response.
+
+        :raises MatcherError: If the server responds with an error.
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+
+        async with self._slots:
+            endpoint = min(self.endpoints, key=lambda e: e.in_flight)
+            endpoint.in_flight += 1
+            try:
+                status, data = await asyncio.wait_for(
+                    self._post(endpoint, json.dumps(trip).encode()),
+                    self.timeout)
+            finally:
+                endpoint.in_flight -= 1
+
+        try:
+            result = json.loads(data) if data else {}
+        except ValueError:
+            # e.g., an error page from a proxy.
+            result = {'error': data[:200]}
+        if status != 200 or 'error' in result:
+            raise MatcherError('HTTP {}: {}'.format(
+                status, result.get('error', data[:200])))
+        return result
+
+    def _result(self, task):
+        try:
+            with stage('match'):
+                return self._loop.run_until_complete(task)
+        except Exception as e:
+            return e
+
+    def imap(
+            self,
+            items: Iterable[Any],
+            key: Callable[[Any], Dict[str, Any]] = None,
+            cached: Callable[[Any], Optional[Dict[str, Any]]] = None):
+        """Generator over *(item, result)* pairs, in the order of *items*.
+
+        Up to *max_in_flight* requests are kept in flight while the results
+        are consumed.
+
+        :param items: Iterable over trips (or things containing trips).
+
+        :param key: Function extracting the trip from an item. If *None*, the
+            items are assumed to be trips.
+
+        :param cached: Function returning a previously computed result for an
+            item, or *None* if a request is required.
+
+        :return: Generator over pairs of each item and either the parsed
+            response for it or the exception raised while getting it.
+        """
+        pending = deque()
+        for item in items:
+            result = None if cached is None else cached(item)
+            if result is None:
+                trip = item if key is None else key(item)
+                task = self._loop.create_task(self.match(trip))
+            else:
+                task = self._loop.create_future()
+                task.set_result(result)
+            pending.append((item, task))
+            if len(pending) >= self.max_in_flight:
+                item, task = pending.popleft()
+                yield item, self._result(task)
+
+        while pending:
+            item, task = pending.popleft()
+            yield item, self._result(task)
+
+    def close(self):
+        """Close all idle connections and the event loop."""
+        for e in self.endpoints:
+            e.close()
+        self._loop.run_until_complete(asyncio.sleep(0))
+        self._loop.close()
@@ -1,19 +1,30 @@
 """Intersect shapefiles with GNAF data."""
 
+import os
 from multiprocessing import Pool
 from typing import Tuple
 
 import numpy as np
 from nptyping import NDArray
+import shapely
 from shapely.geometry import box, Point, polygon
 from tqdm import tqdm
 
-from .settings import DEBUG
+from .settings import DEBUG, INTERSECT_BACKEND, IntersectBackend
 
 
 
 MULTI_CORE = not DEBUG
 
+#: Is shapely 2 (which has vectorised functions) available.
+_SHAPELY_2 = int(shapely.__version__.split('.')[0]) >= 2
+if not _SHAPELY_2:
+    from shapely import vectorized
+
+#: The (approximate) number of points intersected in each task by the
+#: *STRTREE* backend.
+STRTREE_CHUNK_SIZE = 200000
+
 
 
 def points_to_polys(
@@ -35,7 +46,10 @@ def points_to_polys(
 
     # Compute inds, but map back to keys
     keys = np.hstack((shapedata[0], [-1]))
-    meshblock_inds = _points_to_shapes(points, shapedata)
+    if INTERSECT_BACKEND == IntersectBackend.STRTREE:
+        meshblock_inds = _points_to_shapes_strtree(points, shapedata)
+    else:
+        meshblock_inds = _points_to_shapes(points, shapedata)
 
     return keys[meshblock_inds]
 
@@ -196,3 +210,103 @@ def _intercept_block(inps):
     BIDs = BID[i[intersects]]
 
     return (PIDs, BIDs)
+
+
+
+# polygons and their bounding boxes for the workers of the STRTREE backend.
+_polys = None
+_boxes = None
+_tree = None
+
+def _init_polys(polys, boxes):
+    global _polys, _boxes, _tree
+    _polys, _boxes = polys, boxes
+    if _SHAPELY_2:
+        _tree = shapely.STRtree(polys)
+
+
+
+def _points_to_shapes_strtree(
+        points: NDArray,
+        shapedata: Tuple[NDArray, polygon.Polygon, NDArray, NDArray]
+    ) -> NDArray[int]:
+    """Intersect points in *points* and geometries in *shapedata*, giving the
+    same result as :py:func:`_points_to_shapes`.
+
+    The points are split into chunks, which are intersected in a worker pool
+    by :py:func:`_intercept_chunk`.
+
+    :return: Index of the geometry containing each point in *points* (or -1
+        for points not in any).
+    """
+    keys, polys, boxes = shapedata
+    n = points.shape[0]
+    alloc = np.zeros(n, dtype=int) - 1
+    if n == 0 or len(polys) == 0:
+        return alloc
+
+    n_chunks = max(1, int(np.ceil(n / STRTREE_CHUNK_SIZE)))
+    starts = np.linspace(0, n, n_chunks + 1).astype(int)
+    chunks = ((s, points[s:e]) for s, e in zip(starts[:-1], starts[1:]))
+
+    if MULTI_CORE and n_chunks > 1:
+        workers = Pool(
+            min(n_chunks, os.cpu_count()),
+            initializer=_init_polys,
+            initargs=(polys, boxes))
+        work = workers.imap_unordered(_intercept_chunk, chunks)
+    else:
+        _init_polys(polys, boxes)
+        work = map(_intercept_chunk, chunks)
+
+    for pids, bids in tqdm(work, total=n_chunks):
+        # as in _points_to_shapes, a point in more than one geometry gets the
+        # last of them.
+        np.maximum.at(alloc, pids, bids)
+
+    if MULTI_CORE and n_chunks > 1:
+        workers.close()
+
+    return alloc
+
+
+
+def _intercept_chunk(inps):
+    """The indexes of the points in a chunk, offset by the index of the first,
+    and of the polygons which contain them.
+
+    Only pairs where the point is strictly inside the polygon's bounding box
+    (as stored, in single precision) are checked, as in
+    :py:func:`_intercept_block`.
+    """
+    offset, points = inps
+    x, y = points[:, 0], points[:, 1]
+    L, B, R, T = _boxes.T
+
+    if _SHAPELY_2:
+        pids, bids = _tree.query(shapely.points(x, y), predicate='within')
+        inside = (x[pids] > L[bids]) & (x[pids] < R[bids]) & \
+                 (y[pids] > B[bids]) & (y[pids] < T[bids])
+        return pids[inside] + offset, bids[inside]
+
+    # shortlist the points in each bounding box using the points sorted by
+    # longitude, then check them together.
+    order = np.argsort(x, kind='stable')
+    xs = x[order]
+    los = np.searchsorted(xs, L, 'right')
+    his = np.searchsorted(xs, R, 'left')
+    pids, bids = [], []
+    for bid, (lo, hi) in enumerate(zip(los.tolist(), his.tolist())):
+        if lo >= hi:
+            continue
+        cand = order[lo:hi]
+        cand = cand[(y[cand] > B[bid]) & (y[cand] < T[bid])]
+        if len(cand) == 0:
+            continue
+        cand = cand[vectorized.contains(_polys[bid], x[cand], y[cand])]
+        pids.append(cand)
+        bids.append(np.full(len(cand), bid))
+
+    if not pids:
+        return np.empty(0, int), np.empty(0, int)
+    return np.concatenate(pids) + offset, np.concatenate(bids)
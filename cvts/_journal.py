@@ -0,0 +1,103 @@
+"""Journals recording the progress made processing a vehicle.
+
+A journal is a file of JSON lines. The first describes the inputs the journal
+was written for and each of the others records a batch of rows that has been
+committed to the database. Lines are only appended (and synced to disk), so
+a journal can be read after a crash; a partially written last line is
+ignored.
+"""
+
+import os
+import json
+from typing import Any, Dict, Optional
+
+
+
+class JournalError(Exception): pass
+
+
+
+class Journal:
+    """The journal for a vehicle.
+
+    :param path: The path of the journal file.
+
+    :param inputs: Description of the inputs (e.g. the dates processed). A
+        journal is only resumed if it was written for the same inputs.
+    """
+
+    def __init__(self, path: str, inputs: Dict[str, Any]):
+        self.path = path
+        self.inputs = inputs
+        self._last_batch = 0
+        self._broken = False
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        """Read the journal, returning the last batch recorded in it or *None*
+        if there isn't one.
+
+        :raises JournalError: If batches were recorded for different inputs.
+        """
+        try:
+            with open(self.path) as jf:
+                lines = jf.read().split('\n')
+        except FileNotFoundError:
+            return None
+
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                break
+
+        if len(entries) < 2:
+            return None
+
+        if entries[0] != {'inputs': self.inputs}:
+            raise JournalError('journal {} was written for {}, not {}'.format(
+                self.path, entries[0], self.inputs))
+
+        last = entries[-1]
+        self._last_batch = last['batch']
+        return last
+
+    def start(self):
+        """Start a new journal, discarding any existing one."""
+        with open(self.path, 'w') as jf:
+            self._write(jf, {'inputs': self.inputs})
+        self._last_batch = 0
+        self._broken = False
+
+    def record(self, entry: Dict[str, Any]) -> bool:
+        """Record that a batch has been committed.
+
+        Batches must be recorded in order (i.e., *entry['batch']* must be one
+        more than the last batch recorded). If one is missed, because the
+        batch was not committed, nothing more is recorded so the journal
+        never skips rows that were lost.
+
+        :return: *True* if the batch was recorded.
+        """
+        if entry['batch'] != self._last_batch + 1:
+            self._broken = True
+        if self._broken:
+            return False
+
+        with open(self.path, 'a') as jf:
+            self._write(jf, entry)
+        self._last_batch = entry['batch']
+        return True
+
+    def remove(self):
+        """Remove the journal file."""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _write(jf, entry):
+        jf.write(json.dumps(entry) + '\n')
+        jf.flush()
+        os.fsync(jf.fileno())
@@ -0,0 +1,115 @@
+"""Content addressed, on disk cache of map matching results."""
+
+import os
+import json
+import gzip
+import logging
+from hashlib import sha256 as _hasher
+from typing import Any, Dict, Optional
+
+
+
+logger = logging.getLogger(__name__)
+
+
+
+class MatchCache:
+    """On disk cache of the output of Valhalla, keyed by the trips sent to it.
+
+    Results are stored as gzipped JSON files, named by the key, under *path*.
+    The least recently used results are removed when the total size of the
+    cache exceeds *max_bytes*. Several processes may share a cache. Each
+    keeps a running total of its size (from a scan of the cache when it first
+    writes to it, plus what it writes since) and only scans it again when that
+    exceeds *max_bytes*, so the cache can grow past *max_bytes* by what the
+    other processes write in the meantime.
+
+    :param path: The directory to store results in.
+
+    :param max_bytes: The maximum size of the cache in bytes.
+
+    :param version: Included in every key. Change it to invalidate the cache
+        (e.g. after the routing tiles have been rebuilt).
+    """
+
+    def __init__(self, path: str, max_bytes: int, version: str = ''):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.version = version
+        self._size = None
+
+    def key(self, trip: Dict[str, Any]) -> str:
+        """Hash of the shape of *trip* and the options (everything else in
+        *trip*)."""
+        h = _hasher(self.version.encode())
+        h.update(json.dumps(trip['shape']).encode())
+        h.update(json.dumps(
+            {k: v for k, v in trip.items() if k != 'shape'},
+            sort_keys=True).encode())
+        return h.hexdigest()
+
+    def _file_name(self, key):
+        return os.path.join(self.path, key[:2], key + '.json.gz')
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Get the result for *key* or *None* if it is not in the cache."""
+        fn = self._file_name(key)
+        try:
+            with gzip.open(fn, 'rt') as f:
+                result = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning('removing corrupt cache entry {}: {}'.format(fn, e))
+            try: os.remove(fn)
+            except OSError: pass
+            return None
+
+        # the modification time is used as the 'last used' time for eviction.
+        try: os.utime(fn)
+        except OSError: pass
+        return result
+
+    def put(self, key: str, result: Dict[str, Any]):
+        """Store *result* under *key*."""
+        fn = self._file_name(key)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        tmp = '{}.{}.tmp'.format(fn, os.getpid())
+        with gzip.open(tmp, 'wt') as f:
+            json.dump(result, f)
+        os.replace(tmp, fn)
+
+        if self._size is None:
+            self._size = self._scan()[1]
+        else:
+            self._size += os.path.getsize(fn)
+
+        if self._size > self.max_bytes:
+            self._evict()
+
+    def _scan(self):
+        entries = []
+        for root, _, files in os.walk(self.path):
+            for f in files:
+                if f.endswith('.json.gz'):
+                    try:
+                        st = os.stat(os.path.join(root, f))
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, os.path.join(root, f)))
+        return entries, sum(e[1] for e in entries)
+
+    def _evict(self):
+        entries, size = self._scan()
+        if size > self.max_bytes:
+            # remove the least recently used entries down to 90% of capacity.
+            target = .9 * self.max_bytes
+            for _, n_bytes, fn in sorted(entries):
+                if size <= target:
+                    break
+                try:
+                    os.remove(fn)
+                    size -= n_bytes
+                except OSError:
+                    pass
+        self._size = size
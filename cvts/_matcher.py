@@ -0,0 +1,160 @@
+"""Long lived map matching processes.
+
+Starting *valhalla_service* for every trip reloads the configuration and cold
+starts the tile cache each time. The classes here keep matcher processes
+running and feed them trips over pipes, one JSON document per line.
+"""
+
+import os
+import json
+import time
+import queue
+import select
+import logging
+import threading
+import subprocess
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+
+
+logger = logging.getLogger(__name__)
+
+
+
+class MatcherError(Exception): pass
+
+
+
+class Matcher:
+    """A long lived matcher process.
+
+    The process is started on first use and restarted if it dies.
+
+    :param command: The command (as a list of arguments) used to start the
+        process. See :py:data:`cvts.settings.VALHALLA_SERVICE_COMMAND`.
+
+    :param timeout: Seconds to wait for a response before the process is
+        killed and :py:class:`MatcherError` raised. Wait forever if *None*.
+    """
+
+    def __init__(self, command: List[str], timeout: Optional[float] = None):
+        self.command = command
+        self.timeout = timeout
+        self._proc = None
+        self._buf = b''
+
+    def _start(self):
+        logger.debug('starting matcher: {}'.format(' '.join(self.command)))
+        self._proc = subprocess.Popen(
+            self.command,
+            stdin  = subprocess.PIPE,
+            stdout = subprocess.PIPE,
+            stderr = subprocess.PIPE)
+        self._buf = b''
+        threading.Thread(
+            target = _log_lines,
+            args   = (self._proc.stderr, self._proc.pid),
+            daemon = True).start()
+
+    def _readline(self):
+        """Read a line from the process's stdout, waiting at most
+        :py:attr:`timeout` seconds. Returns an empty string if the process
+        exits first."""
+        fd = self._proc.stdout.fileno()
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while b'\n' not in self._buf:
+            wait = None if deadline is None else max(0., deadline - time.monotonic())
+            ready, _, _ = select.select([fd], [], [], wait)
+            if not ready:
+                self.close(kill=True)
+                raise MatcherError(
+                    'matcher process did not respond in {}s'.format(self.timeout))
+            chunk = os.read(fd, 1 << 16)
+            if not chunk:
+                return b''
+            self._buf += chunk
+        line, self._buf = self._buf.split(b'\n', 1)
+        return line
+
+    def match(self, trip: Dict[str, Any]) -> Dict[str, Any]:
+        """Send *trip* to the process and return the parsed response."""
+        if self._proc is None or self._proc.poll() is not None:
+            self._start()
+
+        try:
+            self._proc.stdin.write(json.dumps(trip).encode() + b'\n')
+            self._proc.stdin.flush()
+            line = self._readline()
+        except (BrokenPipeError, OSError) as e:
+            self.close()
+            raise MatcherError('matcher process failed: {}'.format(e))
+
+        if not line:
+            self.close()
+            raise MatcherError('matcher process exited')
+
+        result = json.loads(line)
+        if 'error' in result:
+            raise MatcherError(result['error'])
+        return result
+
+    def close(self, kill: bool = False):
+        """Stop the process (if it is running), killing it if *kill*."""
+        proc, self._proc = self._proc, None
+        if proc is None:
+            return
+        try:
+            if kill:
+                proc.kill()
+            proc.stdin.close()
+            proc.wait(timeout=5)
+        except Exception:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+
+
+
+def _log_lines(stream, pid):
+    """Log the lines written to *stream* (the stderr of matcher process
+    *pid*) until it is closed."""
+    with stream:
+        for line in stream:
+            line = line.decode(errors='replace').rstrip()
+            if line:
+                logger.info('matcher {}: {}'.format(pid, line))
+
+
+
+class MatcherPool:
+    """A pool of :py:class:`Matcher` instances that can be borrowed.
+
+    :param command: Passed to :py:class:`Matcher`.
+
+    :param size: The number of matchers in the pool.
+
+    :param timeout: Passed to :py:class:`Matcher`.
+    """
+
+    def __init__(self, command: List[str], size: int = 1, timeout: Optional[float] = None):
+        self._matchers = [Matcher(command, timeout) for _ in range(size)]
+        # LIFO so the most recently used (warmest) matcher is reused first.
+        self._idle = queue.LifoQueue()
+        for m in self._matchers:
+            self._idle.put(m)
+
+    @contextmanager
+    def borrow(self):
+        """Context manager yielding an idle :py:class:`Matcher`, blocking until
+        one is available."""
+        matcher = self._idle.get()
+        try:
+            yield matcher
+        finally:
+            self._idle.put(matcher)
+
+    def close(self):
+        """Stop all processes in the pool."""
+        for m in self._matchers:
+            m.close()
@@ -0,0 +1,33 @@
+"""Long lived trace_attributes service used by :py:class:`cvts._matcher.Matcher`.
+
+Reads one trace_attributes request per line from stdin and writes one JSON
+response per line to stdout until stdin is closed. Requires the Valhalla
+Python bindings (*pip install pyvalhalla*). Run as::
+
+    python -m cvts._matcher_service <valhalla-config-file>
+"""
+
+import sys
+import json
+
+
+
+def main(config_file):
+    from valhalla import Actor
+
+    actor = Actor(config_file)
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            result = actor.trace_attributes(line)
+        except Exception as e:
+            result = json.dumps({'error': '{}: {}'.format(
+                e.__class__.__name__, str(e))})
+        sys.stdout.write(result.replace('\n', ' ') + '\n')
+        sys.stdout.flush()
+
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
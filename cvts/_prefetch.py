@@ -0,0 +1,103 @@
+"""Loading of inputs ahead of when they are needed.
+
+This is used to read the raw data for the next vehicles in background threads
+while the current ones are being matched, so waiting for the disk (or a
+network file system) overlaps with other work.
+"""
+
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, Optional, Tuple
+
+
+
+logger = logging.getLogger(__name__)
+
+
+
+def _nbytes(result):
+    return getattr(result, 'nbytes', 0)
+
+
+
+def prefetch(
+        items: Iterable[Any],
+        load: Callable[[Any], Any],
+        n_ahead: int,
+        max_bytes: float,
+        nbytes: Callable[[Any], int] = _nbytes,
+        released: Optional[Any] = None) -> Iterator[Tuple[Any, Any]]:
+    """Generator over pairs of each item in *items* and the result of calling
+    *load* with it, in the order of *items*.
+
+    Up to *n_ahead* items are loaded at a time, in background threads. Loading
+    is paused while the results which have been loaded but not yet consumed
+    take more than *max_bytes*. The budget is checked before each load is
+    started, so it may be exceeded by the results of the loads in progress.
+
+    If *load* raises an exception, the result for the item is *None*, so the
+    consumer can decide what to do (e.g., try again itself).
+
+    :param nbytes: Callable returning the size, in bytes, of a result.
+
+    :param released: If given, results are consumed when their size is put
+        in this queue (e.g., a :py:class:`multiprocessing.SimpleQueue`),
+        rather than when they are yielded. This is for results which are
+        passed on (and held) elsewhere before they are used, such as those
+        sent to the processes of a pool, which put the size of each when they
+        start on it.
+    """
+    items = iter(items)
+    pending = deque()
+    lock = threading.Lock()
+    held = [0]
+
+    def release():
+        while True:
+            n = released.get()
+            if n is None:
+                return
+            with lock:
+                held[0] -= n
+
+    def done(future):
+        try:
+            n = nbytes(future.result())
+        except Exception:
+            return
+        with lock:
+            held[0] += n
+
+    def fill(executor):
+        while len(pending) < n_ahead and (not pending or held[0] < max_bytes):
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            future = executor.submit(load, item)
+            future.add_done_callback(done)
+            pending.append((item, future))
+
+    if released is not None:
+        threading.Thread(target=release, daemon=True).start()
+    try:
+        with ThreadPoolExecutor(max(1, n_ahead)) as executor:
+            fill(executor)
+            while pending:
+                item, future = pending.popleft()
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.debug('failed to prefetch {}: {}'.format(item, e))
+                    result = None
+                else:
+                    if released is None:
+                        with lock:
+                            held[0] -= nbytes(result)
+                fill(executor)
+                yield item, result
+    finally:
+        if released is not None:
+            released.put(None)
@@ -0,0 +1,101 @@
+"""Scheduling of vehicles over worker processes.
+
+Vehicles are dispatched in decreasing order of their estimated cost (the
+longest processing time first rule), so the biggest vehicles are not left
+running on their own at the end of a run.
+"""
+
+import os
+import heapq
+import logging
+from datetime import date
+from typing import Any, Dict, Iterable, List, Sequence
+from ._utils import _files_for_dates
+from .settings import RAW_DATA_FORMAT, RawDataFormat
+
+if RAW_DATA_FORMAT == RawDataFormat.GZIP:
+    from ._data_retrieval import vehicle_pings
+
+
+
+logger = logging.getLogger(__name__)
+
+
+
+def estimate_costs(
+        input_files: Dict[Any, Any],
+        dates: Iterable[date] = None) -> Dict[Any, float]:
+    """Estimate the cost of processing each vehicle in *input_files* (as
+    produced by :py:func:`cvts.vehicle_ids`) for *dates*.
+
+    For data from the lake, the cost is the number of pings recorded in the
+    *vehicle_days* table (which :py:class:`cvts.tasks.ListRawFiles` may
+    already have looked up). For CSV files it is the size of the files.
+
+    :return: Dictionary of costs keyed by the keys of *input_files*.
+    """
+    if RAW_DATA_FORMAT == RawDataFormat.GZIP:
+        if all(isinstance(v, dict) for v in input_files.values()):
+            return {k: float(sum(v.values())) for k, v in input_files.items()}
+        pings = vehicle_pings(dates).to_dict()
+        return {k: float(pings.get(int(k), 0)) for k in input_files}
+
+    costs = {}
+    for k, files in input_files.items():
+        if dates is not None:
+            files = _files_for_dates(files, dates)
+        costs[k] = float(sum(os.path.getsize(f) for f in files))
+    return costs
+
+
+
+def largest_first(costs: Dict[Any, float]) -> List[Any]:
+    """The keys of *costs* in decreasing order of cost."""
+    return sorted(costs, key=costs.get, reverse=True)
+
+
+
+def makespan(durations: Sequence[float], n_workers: int) -> float:
+    """The makespan of running jobs taking *durations*, in order, on
+    *n_workers* workers which each take the next job when they become free."""
+    finish = [0.] * min(n_workers, len(durations))
+    for d in durations:
+        heapq.heapreplace(finish, finish[0] + d)
+    return max(finish, default=0.)
+
+
+
+def report_makespan(
+        order: Sequence[Any],
+        costs: Dict[Any, float],
+        durations: Dict[Any, float],
+        n_workers: int,
+        elapsed: float) -> str:
+    """Compare the expected and actual makespan of a run.
+
+    The expected makespan is found by scaling the costs by the mean time taken
+    per unit cost over the run, so it is what would have been achieved had the
+    costs been exact.
+
+    :param order: The order the vehicles were dispatched in.
+
+    :param costs: The estimated costs of the vehicles.
+
+    :param durations: The time taken to process each vehicle.
+
+    :param n_workers: The number of worker processes.
+
+    :param elapsed: The time taken for the run.
+
+    :return: A description of the makespans.
+    """
+    total_cost = sum(costs[k] for k in order)
+    total_time = sum(durations.get(k, 0.) for k in order)
+    rate = total_time / total_cost if total_cost > 0 else 0.
+    expected = makespan([costs[k] * rate for k in order], n_workers)
+    lower = max(total_time / n_workers, max(durations.values(), default=0.))
+    msg = 'makespan: expected {:.1f}s, actual {:.1f}s (lower bound {:.1f}s, ' \
+        '{} vehicles on {} workers)'.format(
+            expected, elapsed, lower, len(order), n_workers)
+    logger.info(msg)
+    return msg
@@ -3,25 +3,45 @@ from typing import Dict, Union, Tuple
 import shapefile # intalled by pyshp
 import shapely.geometry
 from shapely.geometry import Polygon, MultiPolygon
+from ._geography_cache import GeographyCache
+from .settings import GEOGRAPHY_CACHE, GEOGRAPHY_CACHE_PATH
 
 
 
 status = print
 
+#: Included in the keys of cached geographies (see
+#: :py:class:`cvts._geography_cache.GeographyCache`). Change it when the way
+#: geographies are prepared (e.g., :py:func:`_shapedata`) changes.
+GEOGRAPHY_VERSION = '1'
+
 
 
 def read_shapefile(
         filename: str,
-        geometry_id_field: str) -> str:
+        geometry_id_field: str) -> Tuple:
     """Load the data from a shapefile.
 
+    If :py:data:`cvts.settings.GEOGRAPHY_CACHE` is set, the result is cached
+    (see :py:class:`cvts._geography_cache.GeographyCache`) and later calls for
+    the same shapefile and field load it from the cache.
+
     :param filename: The name of the shapefile.
 
     :param geometry_id_field: The field to extract from the shapefile. This
         should contain the identifier for the geometries.
 
-    :return: The name of the file the data in the shapefile was saved to."""
+    :return: A tuple containing the geometry IDs, polygons and bounding boxes
+        for the geography."""
+
+    if GEOGRAPHY_CACHE:
+        return GeographyCache(GEOGRAPHY_CACHE_PATH, GEOGRAPHY_VERSION).get(
+            filename, geometry_id_field, _read_shapefile)
+    return _read_shapefile(filename, geometry_id_field)
+
+
 
+def _read_shapefile(filename, geometry_id_field):
     sf = shapefile.Reader(filename)
     fields = {k: v for v, k in enumerate([x[0] for x in sf.fields[1:]])}
     col = fields[geometry_id_field]
@@ -66,7 +86,7 @@ def _shapedata(shapes: Dict[str, Union[Polygon, MultiPolygon]]) -> Tuple:
             keys.append(k)
             polys.append(_check_and_fix_poly(p))
         elif isinstance(p, MultiPolygon):
-            for q in p:
+            for q in p.geoms:
                 keys.append(k)
                 polys.append(_check_and_fix_poly(q)) # split into single polys
     status("{} polys.".format(len(keys)))
@@ -0,0 +1,234 @@
+"""Synthetic fleets of vehicles for tests and benchmarks.
+
+Each vehicle has a base near one of Vietnam's larger cities. On each day it
+leaves the base in the morning, drives to a few destinations, waiting at each,
+and returns. Pings are sent every *ping_interval* seconds (with some jitter)
+while it is out. Fleets can be written in either of the
+:py:class:`raw data formats<cvts.settings.RawDataFormat>`.
+"""
+
+import os
+import json
+from datetime import date, datetime, timezone
+from math import ceil
+from typing import Iterable
+import numpy as np
+import pandas as pd
+import shapefile # intalled by pyshp
+from sqlalchemy import create_engine
+from ._trace import make_trace, concatenate_traces
+
+
+
+#: Bounding box of Vietnam (min lon, min lat, max lon, max lat).
+VIETNAM_BBOX = (102.14, 8.18, 109.46, 23.39)
+
+#: Lon/lats of the cities vehicles are based near.
+CITIES = (
+    (105.85, 21.03),  # Hanoi
+    (106.68, 20.86),  # Hai Phong
+    (108.22, 16.05),  # Da Nang
+    (106.70, 10.78),  # Ho Chi Minh City
+    (105.78, 10.03))  # Can Tho
+
+#: Offset of local time from UTC, in seconds.
+_UTC_OFFSET = 7 * 3600
+
+_METERS_PER_DEGREE = 111320.
+
+
+
+def _clip(lon, lat):
+    return (
+        np.clip(lon, VIETNAM_BBOX[0], VIETNAM_BBOX[2]),
+        np.clip(lat, VIETNAM_BBOX[1], VIETNAM_BBOX[3]))
+
+
+
+def vehicle_day(
+        rng: np.random.Generator,
+        base: tuple,
+        day: date,
+        ping_interval: float = 15.) -> np.ndarray:
+    """The trace (see :py:mod:`cvts._trace`) for a vehicle, based at the
+    lon/lat *base*, on *day*."""
+    midnight = datetime(day.year, day.month, day.day, tzinfo=timezone.utc) \
+        .timestamp() - _UTC_OFFSET
+    # leave late enough that the whole day falls on the same UTC date, which
+    # is what the data lake is split by.
+    t = midnight + rng.uniform(8, 11) * 3600
+    here = np.array(base, dtype=float)
+    stops = [here + rng.normal(0, .05, 2) for _ in range(rng.integers(1, 6))] \
+        + [here]
+
+    parts = []
+    for there in stops:
+        # drive in a straight(ish) line.
+        there = np.array(_clip(*there))
+        dx = (there[0] - here[0]) * np.cos(np.radians(here[1]))
+        dy = there[1] - here[1]
+        dist = np.hypot(dx, dy) * _METERS_PER_DEGREE
+        speed = rng.uniform(20, 60) / 3.6
+        n = max(2, ceil(dist / speed / ping_interval))
+        ts = t + np.cumsum(rng.uniform(.8, 1.2, n) * ping_interval)
+        frac = np.minimum((ts - t) * speed / max(dist, 1.), 1.)[:, None]
+        pos = here + frac * (there - here) + rng.normal(0, 2e-5, (n, 2))
+        heading = (np.degrees(np.arctan2(dx, dy)) + rng.normal(0, 5, n)) % 360.
+        speeds = np.clip(speed * 3.6 + rng.normal(0, 5, n), 0, None)
+        speeds[frac[:, 0] >= 1.] = 0.
+        lon, lat = _clip(pos[:, 0], pos[:, 1])
+        parts.append(make_trace(lat, lon, ts, heading, speeds))
+        t = ts[-1]
+
+        # and wait.
+        n = int(rng.uniform(10, 90) * 60 / ping_interval)
+        ts = t + np.cumsum(rng.uniform(.8, 1.2, n) * ping_interval)
+        pos = there + rng.normal(0, 2e-5, (n, 2))
+        lon, lat = _clip(pos[:, 0], pos[:, 1])
+        parts.append(make_trace(lat, lon, ts, rng.uniform(0, 360, n), np.zeros(n)))
+        if n:
+            t = ts[-1]
+        here = there
+
+    return concatenate_traces(parts)
+
+
+
+def _fleet(n_vehicles, dates, ping_interval, seed):
+    """Generator over the ids and traces for each day of a fleet."""
+    rng = np.random.default_rng(seed)
+    for vid in range(1, n_vehicles + 1):
+        city = CITIES[rng.integers(len(CITIES))]
+        base = tuple(np.array(city) + rng.normal(0, .1, 2))
+        yield vid, [(d, vehicle_day(rng, base, d, ping_interval)) for d in dates]
+
+
+
+def write_csv_fleet(
+        raw_path: str,
+        n_vehicles: int,
+        dates: Iterable[date],
+        ping_interval: float = 15.,
+        seed: int = 0) -> int:
+    """Write a fleet in the CSV layout: a file *raw_path/YYYYMMDD/<rego>.csv*
+    for each vehicle and day.
+
+    :return: The number of points written.
+    """
+    n_points = 0
+    for vid, days in _fleet(n_vehicles, list(dates), ping_interval, seed):
+        rego = 'SYN{:06d}'.format(vid)
+        for d, trace in days:
+            day_path = os.path.join(raw_path, d.strftime('%Y%m%d'))
+            os.makedirs(day_path, exist_ok=True)
+            # yes, Longitude and Latitude are back to front.
+            pd.DataFrame({
+                'Index'      : np.arange(1, len(trace) + 1),
+                'PlateNumber': vid,
+                'Latitude'   : trace['lon'],
+                'Longitude'  : trace['lat'],
+                'speed'      : trace['speed'],
+                'Orientation': trace['heading'],
+                'VehicleType': 1,
+                'Weight'     : 1,
+                'Time'       : trace['time'].astype(np.int64)}).to_csv(
+                    os.path.join(day_path, rego + '.csv'), index=False)
+            n_points += len(trace)
+    return n_points
+
+
+
+def write_gzip_fleet(
+        raw_path: str,
+        lake_connection_string: str,
+        n_vehicles: int,
+        dates: Iterable[date],
+        ping_interval: float = 15.,
+        seed: int = 0) -> int:
+    """Write a fleet in the data lake layout: a file
+    *raw_path/MM/vehicle_<id>.zip* for each vehicle and month, along with the
+    *vehicles*, *vehicle_types* and *vehicle_days* tables of the reference
+    database at *lake_connection_string*.
+
+    :return: The number of points written.
+    """
+    n_points = 0
+    vehicles, vehicle_days = [], []
+    for vid, days in _fleet(n_vehicles, list(dates), ping_interval, seed):
+        vehicles.append((vid, 'SYN{:06d}'.format(vid), 1))
+        months = {}
+        for d, trace in days:
+            months.setdefault(d.month, []).append(trace)
+            ts = trace['time']
+            vehicle_days.append((vid, d, len(trace),
+                datetime.utcfromtimestamp(ts.min()),
+                datetime.utcfromtimestamp(ts.max()),
+                None))
+            n_points += len(trace)
+
+        for month, traces in months.items():
+            trace = concatenate_traces(traces)
+            month_path = os.path.join(raw_path, str(month).zfill(2))
+            os.makedirs(month_path, exist_ok=True)
+            file_name = 'vehicle_{}'.format(vid)
+            pd.DataFrame({
+                'datetime': trace['time'].astype(np.int64),
+                'speed'   : trace['speed'],
+                'lon'     : trace['lon'],
+                'lat'     : trace['lat'],
+                'heading' : trace['heading']}).to_csv(
+                    os.path.join(month_path, file_name + '.zip'),
+                    index       = False,
+                    compression = {
+                        'method': 'zip',
+                        'archive_name': file_name + '.csv'})
+
+    engine = create_engine(lake_connection_string)
+    with engine.begin() as conn:
+        pd.DataFrame(vehicles, columns=[
+            'vehicle_id', 'vehicle_id_string', 'vehicle_type_id']).to_sql(
+            'vehicles', conn, if_exists='replace', index=False)
+        pd.DataFrame([(1, 'Xe tải', 'Truck', 'Truck', 'Truck')], columns=[
+            'id', 'type_vn', 'type_en', 'group_name', 'vehicle_type']).to_sql(
+            'vehicle_types', conn, if_exists='replace', index=False)
+        pd.DataFrame(vehicle_days, columns=[
+            'vehicle_id', 'day', 'pings', 'min_time', 'max_time', 'geom']).to_sql(
+            'vehicle_days', conn, if_exists='replace', index=False)
+
+    return n_points
+
+
+
+def write_region_grid(
+        boundaries_path: str,
+        geometries_name: str,
+        cell_size: float = .5) -> int:
+    """Write a :term:`geography` covering :py:data:`VIETNAM_BBOX` with square
+    regions of *cell_size* degrees, with ids in the field *id*.
+
+    :return: The number of regions.
+    """
+    os.makedirs(boundaries_path, exist_ok=True)
+    w = shapefile.Writer(
+        os.path.join(boundaries_path, geometries_name),
+        shapeType=shapefile.POLYGON)
+    w.field('id', 'N')
+    n = 0
+    for x0 in np.arange(VIETNAM_BBOX[0], VIETNAM_BBOX[2], cell_size).tolist():
+        for y0 in np.arange(VIETNAM_BBOX[1], VIETNAM_BBOX[3], cell_size).tolist():
+            x1, y1 = x0 + cell_size, y0 + cell_size
+            n += 1
+            w.poly([[[x0, y0], [x0, y1], [x1, y1], [x1, y0], [x0, y0]]])
+            w.record(n)
+    w.close()
+
+    fields_path = os.path.join(boundaries_path, 'geography-geom-field-names.json')
+    fields = {}
+    if os.path.exists(fields_path):
+        with open(fields_path) as ff:
+            fields = json.load(ff)
+    fields[geometries_name] = 'id'
+    with open(fields_path, 'w') as ff:
+        json.dump(fields, ff)
+
+    return n
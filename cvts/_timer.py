@@ -1,4 +1,11 @@
+import os
+import socket
+import threading
 from timeit import default_timer
+from contextlib import contextmanager
+from collections import defaultdict
+from typing import Any, Dict, Iterable
+import numpy as np
 
 class Timer:
     def __init__(self, logger=None):
@@ -12,3 +19,132 @@ class Timer:
         self.elapsed = default_timer() - self.start
         if self.logger is not None:
             self.logger('\ttook: {} seconds'.format(self.elapsed))
+
+
+
+class StageMetrics:
+    """Time spent in each stage of processing (e.g., a vehicle) and counts of
+    the things processed (points, trips, bytes read, ...).
+
+    Stages and counts are recorded with :py:func:`stage` and :py:func:`tally`
+    while the metrics are active (see :py:func:`collect`)."""
+
+    def __init__(self, **info):
+        self.info = info
+        self.durations = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.total = 0.
+
+    def record(self) -> Dict[str, Any]:
+        """A JSON serialisable record of the metrics."""
+        return dict(
+            self.info,
+            worker    = '{}:{}'.format(socket.gethostname(), os.getpid()),
+            total     = self.total,
+            durations = dict(self.durations),
+            counts    = dict(self.counts))
+
+
+
+# the active metrics are per thread, so threads (e.g., those prefetching
+# traces) can collect metrics of their own.
+_local = threading.local()
+
+def _active():
+    return getattr(_local, 'metrics', None)
+
+@contextmanager
+def collect(**info):
+    """Context manager collecting the stages and counts recorded within it
+    (in the current thread) into a new :py:class:`StageMetrics`, which is
+    returned.
+
+    :param info: Fields to include in the record (e.g., the vehicle id).
+    """
+    outer = _active()
+    metrics = _local.metrics = StageMetrics(**info)
+    start = default_timer()
+    try:
+        yield metrics
+    finally:
+        metrics.total = default_timer() - start
+        _local.metrics = outer
+
+@contextmanager
+def stage(name):
+    """Context manager adding the time spent within it to the stage *name* of
+    the active metrics (if there are any)."""
+    metrics = _active()
+    if metrics is None:
+        yield
+        return
+    start = default_timer()
+    try:
+        yield
+    finally:
+        metrics.durations[name] += default_timer() - start
+
+def tally(name, n=1):
+    """Add *n* to the count *name* of the active metrics (if there are any)."""
+    metrics = _active()
+    if metrics is not None:
+        metrics.counts[name] += n
+
+def merge(record: Dict[str, Any]):
+    """Add the durations and counts in *record* (produced by
+    :py:meth:`StageMetrics.record`, e.g., in another thread) to the active
+    metrics (if there are any)."""
+    metrics = _active()
+    if metrics is not None:
+        for k, v in record['durations'].items():
+            metrics.durations[k] += v
+        for k, v in record['counts'].items():
+            metrics.counts[k] += v
+
+def timed_iter(name, iterable):
+    """Generator over *iterable* adding the time spent producing each item to
+    the stage *name*."""
+    it = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+        yield item
+
+
+
+def summarise(records: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """Summarise records produced by :py:meth:`StageMetrics.record`.
+
+    :return: Dictionary containing the number of records and, for each stage
+        (and the total), the 50th, 95th and 99th percentiles and the sum of
+        the durations for the records that include it. Also, for each worker,
+        the number of records, points and seconds and the points processed
+        per second.
+    """
+    stages = defaultdict(list)
+    workers = defaultdict(lambda: {'records': 0, 'points': 0, 'seconds': 0.})
+    n = 0
+    for r in records:
+        n += 1
+        stages['total'].append(r['total'])
+        for k, v in r['durations'].items():
+            stages[k].append(v)
+        w = workers[r['worker']]
+        w['records'] += 1
+        w['points']  += r['counts'].get('points', 0)
+        w['seconds'] += r['total']
+
+    def percentiles(ds):
+        p50, p95, p99 = np.percentile(ds, [50, 95, 99]).tolist()
+        return {'p50': p50, 'p95': p95, 'p99': p99, 'sum': float(np.sum(ds))}
+
+    for w in workers.values():
+        w['points_per_second'] = w['points'] / w['seconds'] if w['seconds'] else 0.
+
+    return {
+        'records': n,
+        'stages' : {k: percentiles(v) for k, v in stages.items()},
+        'workers': dict(workers)}
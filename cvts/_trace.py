@@ -0,0 +1,71 @@
+"""Columnar representation of GPS traces.
+
+A trace is a NumPy structured array with dtype :py:data:`TRACE_DTYPE`, one
+element per GPS ping. Traces are only converted to the list of dicts Valhalla
+expects (see :py:func:`trip_to_request`) when a trip is sent to it.
+"""
+
+from typing import Any, Dict
+import numpy as np
+
+
+
+#: Heading tolerance sent to Valhalla with every point.
+HEADING_TOLERANCE = 45
+
+#: dtype of a trace.
+TRACE_DTYPE = np.dtype([
+    ('lat',     np.float64),
+    ('lon',     np.float64),
+    ('time',    np.float64),
+    ('heading', np.float64),
+    ('speed',   np.float64)])
+
+
+
+def make_trace(lat, lon, time, heading, speed) -> np.ndarray:
+    """Create a trace from arrays (or sequences) for each of its fields."""
+    trace = np.empty(len(lat), dtype=TRACE_DTYPE)
+    trace['lat']     = lat
+    trace['lon']     = lon
+    trace['time']    = time
+    trace['heading'] = heading
+    trace['speed']   = speed
+    return trace
+
+
+
+def concatenate_traces(traces) -> np.ndarray:
+    """Concatenate an iterable of traces (which may be empty)."""
+    traces = list(traces)
+    if len(traces) == 0:
+        return np.empty(0, dtype=TRACE_DTYPE)
+    return np.concatenate(traces)
+
+
+
+def trip_to_request(trip: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert a trip, whose *shape* is a trace, to a request for Valhalla.
+
+    Each point in the shape of the request looks like::
+
+        {
+            'lat':     latitude,
+            'lon':     longitude,
+            'time':    timestamp,
+            'heading': heading,
+            'speed':   speed,
+            'heading_tolerance': 45,
+            'type':    'via'
+        }
+
+    where *type* is 'break' for the first and last points.
+    """
+    trace = trip['shape']
+    names = TRACE_DTYPE.names
+    shape = [dict(zip(names, p), heading_tolerance=HEADING_TOLERANCE, type='via') \
+        for p in zip(*(trace[k].tolist() for k in names))]
+    if len(shape):
+        shape[0]['type'] = 'break'
+        shape[-1]['type'] = 'break'
+    return dict(trip, shape=shape)
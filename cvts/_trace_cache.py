@@ -0,0 +1,133 @@
+"""On disk cache of raw data files converted to traces.
+
+Each source file (e.g., a month of pings for a vehicle from the data lake) is
+converted once to a trace (see :py:mod:`cvts._trace`) stored as a *.npy* file,
+with its rows grouped by (UTC) day, and an index giving the rows for each day.
+Loading the data for some days is then a slice of a memory mapped array rather
+than a parse of the whole source.
+"""
+
+import os
+import json
+import logging
+from datetime import date
+from typing import Callable, Dict, Iterable, Tuple
+import numpy as np
+
+
+
+logger = logging.getLogger(__name__)
+
+_SECONDS_PER_DAY = 86400
+
+_EPOCH = date(1970, 1, 1).toordinal()
+
+
+
+def _day(time):
+    """Days since the epoch (in UTC) of the timestamps *time*."""
+    return np.floor(time / _SECONDS_PER_DAY).astype(np.int64)
+
+
+
+class TraceCache:
+    """Cache of traces converted from source files.
+
+    A cached trace is used only while the modification time and size of its
+    source are unchanged. Several processes may share a cache.
+
+    :param path: The directory to store traces in.
+
+    :param root: The directory the source files are in. Cached traces are
+        stored at the same path, relative to *path*, as their sources are
+        relative to *root*.
+    """
+
+    def __init__(self, path: str, root: str):
+        self.path = path
+        self.root = root
+
+    def _file_names(self, source):
+        base = os.path.join(
+            self.path,
+            os.path.splitext(os.path.relpath(source, self.root))[0])
+        return base + '.npy', base + '.json'
+
+    def _index(self, source, index_file_name):
+        try:
+            with open(index_file_name) as jf:
+                index = json.load(jf)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        st = os.stat(source)
+        if index.get('mtime_ns') != st.st_mtime_ns or index.get('size') != st.st_size:
+            return None
+        return index
+
+    def get(
+            self,
+            source: str,
+            read: Callable[[str], np.ndarray]) -> Tuple[np.ndarray, Dict[int, Tuple[int, int]]]:
+        """The trace for *source* and its index, converting it first (by
+        calling *read* with *source*) if it is not in the cache.
+
+        :return: A tuple containing the (memory mapped) trace and a dictionary
+            mapping days (since the epoch) to the start and end of the rows for
+            each day.
+        """
+        trace_file_name, index_file_name = self._file_names(source)
+        index = self._index(source, index_file_name)
+        if index is not None:
+            try:
+                trace = np.load(trace_file_name, mmap_mode='r')
+            except (OSError, ValueError) as e:
+                logger.warning('ignoring corrupt cached trace {}: {}'.format(
+                    trace_file_name, e))
+            else:
+                if len(trace) == index['rows']:
+                    return trace, {int(d): tuple(r) for d, r in index['days'].items()}
+
+        return self._put(source, read, trace_file_name, index_file_name)
+
+    def _put(self, source, read, trace_file_name, index_file_name):
+        st = os.stat(source)
+        trace = read(source)
+
+        # group by day, keeping the order of the rows within each day.
+        days = _day(trace['time'])
+        order = np.argsort(days, kind='stable')
+        trace = trace[order]
+        days, starts, counts = np.unique(
+            days[order], return_index=True, return_counts=True)
+        index = {
+            'mtime_ns': st.st_mtime_ns,
+            'size'    : st.st_size,
+            'rows'    : len(trace),
+            'days'    : {str(d): [int(s), int(s + c)] for d, s, c in zip(
+                days.tolist(), starts.tolist(), counts.tolist())}}
+
+        # the index is written last, so a trace is only used once complete.
+        os.makedirs(os.path.dirname(trace_file_name), exist_ok=True)
+        tmp = '{}.{}.tmp'.format(trace_file_name, os.getpid())
+        with open(tmp, 'wb') as tf:
+            np.save(tf, trace)
+        os.replace(tmp, trace_file_name)
+        tmp = '{}.{}.tmp'.format(index_file_name, os.getpid())
+        with open(tmp, 'w') as jf:
+            json.dump(index, jf)
+        os.replace(tmp, index_file_name)
+
+        return trace, {int(d): tuple(r) for d, r in index['days'].items()}
+
+
+
+def day_slices(
+        trace: np.ndarray,
+        index: Dict[int, Tuple[int, int]],
+        dates: Iterable[date]) -> Iterable[np.ndarray]:
+    """Generator over the rows of *trace* for each of *dates*, using the
+    *index* returned by :py:meth:`TraceCache.get`."""
+    for d in dates:
+        start, end = index.get(d.toordinal() - _EPOCH, (0, 0))
+        yield trace[start:end]
@@ -0,0 +1,100 @@
+"""Vectorised calculation of edge traversals from map matched points.
+
+Each function works on arrays of the (successfully) matched points of a trip,
+in the order they occur in the trip.
+"""
+
+from datetime import datetime, timezone
+import numpy as np
+
+
+
+#: Local time offsets are looked up once for each interval of this many
+#: seconds. All time zones change their offsets on quarter hour boundaries.
+_OFFSET_INTERVAL = 15 * 60
+
+
+
+def _utc_offset(ts):
+    """Offset of local time from UTC, in seconds, at timestamp *ts*."""
+    return int((datetime.fromtimestamp(ts) - datetime.fromtimestamp(
+        ts, timezone.utc).replace(tzinfo=None)).total_seconds())
+
+
+
+def average_speeds(edge_index, edge_id, speed, time, min_speed):
+    """Mean speed on each edge from the points with speed above *min_speed*.
+
+    :return: Tuple of arrays containing, for each edge (in order of edge
+        index), the edge id (of the first point on the edge), the mean speed,
+        the number of points and the (truncated) mean time of the points.
+    """
+    moving = speed > min_speed
+    if not np.any(moving):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty.astype(np.uint64), empty.astype(float), empty, empty
+
+    _, first, inverse, counts = np.unique(
+        edge_index[moving],
+        return_index   = True,
+        return_inverse = True,
+        return_counts  = True)
+
+    return (
+        edge_id[moving][first],
+        np.bincount(inverse, weights=speed[moving]) / counts,
+        counts,
+        (np.bincount(inverse, weights=time[moving]) / counts).astype(np.int64))
+
+
+
+def missing_edges(edge_index, time):
+    """Edges skipped between successive points, with times interpolated
+    linearly between the times of the points.
+
+    :return: Tuple of arrays containing the index and (truncated) estimated
+        time of each missing edge.
+    """
+    # TODO: consider if we want to take account of the edge lengths here.
+    d = np.diff(edge_index)
+    jumps = d >= 2
+    d = d[jumps]
+    i1 = edge_index[:-1][jumps]
+    t1 = time[:-1][jumps]
+    tdiff = (time[1:] - time[:-1])[jumps]
+
+    n = d - 1
+    rep = np.repeat(np.arange(len(n)), n)
+    k = (np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n) + 1).astype(float)
+
+    return (
+        i1[rep] + k.astype(np.int64),
+        (t1[rep] + k * (1. / d[rep]) * tdiff[rep]).astype(np.int64))
+
+
+
+def time_fields(timestamps):
+    """Hour, day of week, day of year and week of year (all zero based) of
+    each timestamp in local time.
+
+    Days and weeks follow the ISO calendar, so weeks start on Monday and day
+    of year is *7 * week of year + day of week*.
+
+    :return: Tuple of four integer arrays.
+    """
+    ts = np.asarray(timestamps, dtype=np.int64)
+    buckets, inverse = np.unique(ts // _OFFSET_INTERVAL, return_inverse=True)
+    offsets = np.array([_utc_offset(int(b) * _OFFSET_INTERVAL) for b in buckets],
+        dtype=np.int64)
+    local = ts + offsets[inverse]
+
+    days = local // 86400
+    hour = (local // 3600) % 24
+    # 1970-01-01 was a Thursday.
+    dow = (days + 3) % 7
+    # ISO weeks belong to the year containing their Thursday.
+    thursday = days - dow + 3
+    year_start = thursday.astype('datetime64[D]').astype('datetime64[Y]') \
+        .astype('datetime64[D]').astype(np.int64)
+    woy = (thursday - year_start) // 7
+    return hour, dow, 7 * woy + dow, woy
@@ -1,13 +1,15 @@
 import os
-import csv
 import json
 from math import sqrt, radians, cos
 from typing import Dict, Any, Generator, Union, Iterable
-from functools import reduce
 from datetime import date
 from collections import defaultdict
+import numpy as np
+import pandas as pd
 from ._polyline import decode
 from ._base_locator import locate_base
+from ._trace import make_trace, concatenate_traces, trip_to_request
+from ._timer import stage, tally, timed_iter
 from .settings import (
     MIN_STOP_TIME,
     MIN_MOVING_SPEED,
@@ -60,86 +62,185 @@ def distance(x0, y0, x1, y1):
 
 
 
+def _distances(x0, y0, x1, y1):
+    """Vectorised version of :py:func:`distance`."""
+
+    yd = np.radians(y1 - y0)
+    xd = np.radians(x1 - x0) * np.cos(np.radians(y0) + .5*yd)
+    return EARTH_RADIUS * np.sqrt(yd*yd + xd*xd)
+
+
+
+#: Maximum number of vectorised passes :py:func:`_moved` makes before
+#: finishing with a loop. Each pass finds the next point that has moved away
+#: from each point that has moved.
+_MAX_MOVED_PASSES = 16
+
+#: :py:func:`_moved` also finishes with a loop once a pass leaves more than
+#: this fraction of the undecided points undecided.
+_MIN_MOVED_PASS_PROGRESS = .5
+
+
+
+def _moved(xs, ys, ss):
+    """Which points have moved.
+
+    A point has moved if its speed is above :py:data:`MIN_MOVING_SPEED` or it is
+    more than :py:data:`MIN_MOVE_DISTANCE` from the last point that moved (the
+    first point is treated as having moved). Points moving by speed are found
+    directly. Between them, chains of points moving by distance are found by
+    repeated vectorised passes; long chains (e.g., from devices that always
+    report a speed of zero) are finished in a loop.
+    """
+
+    n = len(xs)
+    idx = np.arange(n)
+    moved = ss > MIN_MOVING_SPEED
+    moved[0] = True
+    undecided = ~moved
+
+    for _ in range(_MAX_MOVED_PASSES):
+        if not np.any(undecided):
+            break
+
+        last = np.maximum.accumulate(np.where(moved, idx, 0))
+        cand = np.flatnonzero(undecided)
+        anchors = last[cand]
+        cand = cand[_distances(
+            xs[anchors], ys[anchors],
+            xs[cand], ys[cand]) > MIN_MOVE_DISTANCE]
+
+        # the first candidate after each point that moved has moved, points
+        # before it have not and points after it are compared to it next pass.
+        anchors, first = np.unique(last[cand], return_index=True)
+        moved[cand[first]] = True
+        cut = np.full(n, n)
+        cut[anchors] = cand[first]
+        n_undecided = np.count_nonzero(undecided)
+        undecided &= idx > cut[last]
+        if np.count_nonzero(undecided) > _MIN_MOVED_PASS_PROGRESS * n_undecided:
+            break
+
+    cand = np.flatnonzero(undecided)
+    if len(cand) == 0:
+        return moved
+
+    last = np.maximum.accumulate(np.where(moved, idx, 0))
+    xl, yl = xs.tolist(), ys.tolist()
+    a = 0
+    for i, la in zip(cand.tolist(), last[cand].tolist()):
+        a = max(a, la)
+        if distance(xl[a], yl[a], xl[i], yl[i]) > MIN_MOVE_DISTANCE:
+            moved[i] = True
+            a = i
+
+    return moved
+
+
+
 def _trip_slices(locs):
-    """Generator over sequential slices of *locs* that form trips."""
+    """Generator over the trips in the trace *locs*.
 
-    if len(locs) == 0:
-        yield locs
+    Yields pairs of the number of stationary points in the stop following the
+    trip and the trace of the trip.
 
-    else:
-        getter = lambda l: (l['time'], l['speed'], l['lat'], l['lon'], l)
-        zi = (getter(l) for l in locs)
-        last_moved_time, _, ly, lx, loc = next(zi)
-        next_chunk        = [loc]
-        stationary_points = []
-
-        for t, s, y, x, loc in zi:
-            has_moved = s > MIN_MOVING_SPEED or distance(lx, ly, x, y) > MIN_MOVE_DISTANCE
-
-            if has_moved:
-                if t - last_moved_time > MIN_STOP_TIME:
-                    nsp = len(stationary_points)
-                    if nsp > 0:
-                        next_chunk.append(stationary_points[0])
-                        yield nsp, next_chunk
-                        next_chunk = [stationary_points[-1], loc]
-
-                    else:
-                        yield nsp, next_chunk
-                        next_chunk = [loc]
+    A trip ends when a vehicle moves (see :py:func:`_moved`) more than
+    :py:data:`MIN_STOP_TIME` after it last moved. The trip then includes the
+    first stationary point of the stop and the next trip starts with the
+    last. Stationary points within a trip are dropped.
+    """
 
-                else:
-                    next_chunk.append(loc)
+    n = len(locs)
+    if n == 0:
+        yield 0, locs
+        return
 
-                del stationary_points[:]
-                lx, ly, last_moved_time = x, y, t
+    ts = locs['time']
+    moved = np.flatnonzero(_moved(locs['lon'], locs['lat'], locs['speed'])[1:]) + 1
+    prev = np.concatenate(([0], moved[:-1]))
+    n_stationary = moved - prev - 1
+    splits = np.flatnonzero(ts[moved] - ts[prev] > MIN_STOP_TIME)
 
-            else:
-                stationary_points.append(loc)
+    start = np.array([0])
+    first = 0
+    for s in splits.tolist():
+        nsp = int(n_stationary[s])
+        end = np.array([prev[s] + 1] if nsp > 0 else [], dtype=int)
+        yield nsp, locs[np.concatenate((start, moved[first:s], end))]
+        start = np.array([moved[s] - 1, moved[s]] if nsp > 0 else [moved[s]])
+        first = s + 1
+
+    last_moved = moved[-1] if len(moved) else 0
+    nsp = int(n - 1 - last_moved)
+    end = np.array([last_moved + 1] if nsp > 0 else [], dtype=int)
+    yield nsp, locs[np.concatenate((start, moved[first:], end))]
 
-        if len(next_chunk):
-            nsp = len(stationary_points)
-            if nsp > 0:
-                next_chunk.append(stationary_points[0])
-            yield nsp, next_chunk
+
+
+def _thin_indices(locs, min_distance, max_interval):
+    """Indices of the points in the trace *locs* to keep when thinning a trip.
+
+    A point is kept if it is at least *min_distance* meters from, or at least
+    *max_interval* seconds after, the last point kept. The first and last
+    points are always kept."""
+
+    n = len(locs)
+    if n < 3:
+        return list(range(n))
+
+    xs, ys, ts = (locs[k].tolist() for k in ('lon', 'lat', 'time'))
+    keep = [0]
+    lx, ly, lt = xs[0], ys[0], ts[0]
+    for i in range(1, n - 1):
+        x, y, t = xs[i], ys[i], ts[i]
+        if t - lt >= max_interval or distance(lx, ly, x, y) >= min_distance:
+            keep.append(i)
+            lx, ly, lt = x, y, t
+    keep.append(n - 1)
+    return keep
 
 
 
 def _loadcsv(csvfile):
-    """Load a raw GeoJSON file and start preparing it for input into Valhalla
-    (preparation is finalissed in :py:func:`_prepjson`)."""
+    """Load a raw CSV file as a trace (see :py:mod:`cvts._trace`)."""
+
+    tally('bytes_read', os.path.getsize(csvfile))
+    df = pd.read_csv(
+        csvfile,
+        usecols = ['Longitude', 'Latitude', 'Time', 'Orientation', 'speed'],
+        dtype   = float)
 
-    with open(csvfile, 'r') as cf:
-        reader = csv.DictReader(cf)
-        return [{
-            # yes, Longitude and Latitude are back to front.
-            'lat': float(row['Longitude']),
-            'lon': float(row['Latitude']),
-            'time': float(row['Time']),
-            'heading': float(row['Orientation']),
-            'speed': float(row['speed']),
-            'heading_tolerance': 45,
-            'type': 'via'} for row in reader]
+    # yes, Longitude and Latitude are back to front.
+    return make_trace(
+        lat     = df['Longitude'].values,
+        lon     = df['Latitude'].values,
+        time    = df['Time'].values,
+        heading = df['Orientation'].values,
+        speed   = df['speed'].values)
+
+
+
+def _trip(locs):
+    return {'shape': locs, 'costing': 'auto', 'shape_match': 'map_snap'}
 
 
 
 def _prepjson(locs, split_trips):
     """Finish preparing data for input into Valhalla and return the results as a
-    generator over trip(s)."""
+    generator over trip(s).
+
+    The shape of each trip is a trace, which is converted to what Valhalla
+    expects by :py:func:`cvts._trace.trip_to_request`."""
 
-    locs.sort(key=lambda l: l['time'])
+    locs = locs[np.argsort(locs['time'], kind='stable')]
     if split_trips:
         for n_stationary, clocs in _trip_slices(locs):
             if len(clocs) == 0:
                 continue
-            clocs[0]['type'] = 'break'
-            clocs[-1]['type'] = 'break'
-            yield n_stationary, {'shape': clocs, 'costing': 'auto', 'shape_match': 'map_snap'}
+            yield n_stationary, _trip(clocs)
 
     else:
-        locs[0]['type'] = 'break'
-        locs[-1]['type'] = 'break'
-        yield 0, {'shape': locs, 'costing': 'auto', 'shape_match': 'map_snap'}
+        yield 0, _trip(locs)
 
 
 
@@ -159,10 +260,57 @@ def gather_input_descriptors():
 
 
 
+def _files_for_dates(files: Iterable[str], dates: Iterable[date]):
+    """The CSV files in *files* containing data for *dates* (i.e., those in
+    directories named after the dates, formatted as *YYYYMMDD*)."""
+    date_strs = [d.strftime('%Y%m%d') for d in dates]
+    return [f for f in files if os.path.split(os.path.dirname(f))[-1] in date_strs]
+
+
+
+def load_trace(
+        input_descriptor: Union[str, Iterable[str]],
+        dates: Iterable[date] = None) -> np.ndarray:
+    """Load the raw data for a single vehicle.
+
+    :param input_descriptor: Either the name of a
+        :ref:`GPS data<gps-data>` file or an iterable of names of such files.
+
+    :param dates: The dates to load data for. If *None*, all data is loaded
+        (only supported for CSV files).
+
+    :return: A trace (see :py:mod:`cvts._trace`).
+    """
+    with stage('load'):
+        if RAW_DATA_FORMAT == RawDataFormat.CSV:
+            if isinstance(input_descriptor, str):
+                raw_locs = _loadcsv(input_descriptor)
+
+            elif dates is None:
+                raw_locs = concatenate_traces(_loadcsv(f) for f in input_descriptor)
+
+            else:
+                raw_locs = concatenate_traces(
+                    _loadcsv(f) for f in _files_for_dates(input_descriptor, dates))
+
+        elif RAW_DATA_FORMAT == RawDataFormat.GZIP:
+            if not (isinstance(input_descriptor, str) or isinstance(input_descriptor, int)):
+                raise Exception('rawfiles2jsonchunks can only accept or int ' \
+                    'for argument input_descriptor when loading from gzip, ' \
+                    'got: {}'.format(type(input_descriptor).__name__))
+
+            raw_locs = _load_gzips(str(input_descriptor), dates)
+
+    return raw_locs
+
+
+
 def rawfiles2jsonchunks(
         input_descriptor: Union[str, Iterable[str]],
         split_trips: bool,
-        dates: Iterable[date]) -> Generator[Dict[str, Any], None, None]:
+        dates: Iterable[date] = None,
+        raw_locs: np.ndarray = None,
+        find_base: bool = True) -> Generator[Dict[str, Any], None, None]:
     """Create a generator over all the data for a single vehicle from data in a
     csv or iterable of csvs.
 
@@ -172,46 +320,32 @@ def rawfiles2jsonchunks(
     :param split_trips: if `True`, then split into :term:`trips<trip>`,
         otherwise return all points as a single 'trip'.
 
-    :return: A geenerator over a dicts that contain information about each GPS
-        point. Each dict looks like::
-
-            {
-                'lat':     float(row['Longitude']),
-                'lon':     float(row['Latitude']),
-                'time':    float(row['Time']),
-                'heading': float(row['Orientation']),
-                'speed':   float(row['speed']),
-                'heading_tolerance': 45,
-                'type':    'via'
-            }
-    """
-    if RAW_DATA_FORMAT == RawDataFormat.CSV:
-        if isinstance(input_descriptor, str):
-            raw_locs = _loadcsv(input_descriptor)
+    :param dates: The dates to load data for. If *None*, all data is loaded
+        (only supported for CSV files).
 
-        elif dates is None:
-            raw_locs = reduce(lambda a, b: a + _loadcsv(b), input_descriptor, [])
+    :param raw_locs: The trace returned by :py:func:`load_trace` for
+        *input_descriptor* and *dates*, if it has already been loaded.
 
-        else:
-            date_strs = [d.strftime('%Y%m%d') for d in dates]
-            fls = [f for f in input_descriptor if \
-                os.path.split(os.path.dirname(f))[-1] in date_strs]
-            raw_locs = reduce(lambda a, b: a + _loadcsv(b), fls, [])
+    :param find_base: If `False`, the vehicle's base is not located (e.g.,
+        because it is already known) and *None* is returned in its place.
 
-    elif RAW_DATA_FORMAT == RawDataFormat.GZIP:
-        if not (isinstance(input_descriptor, str) or isinstance(input_descriptor, int)):
-            raise Exception('rawfiles2jsonchunks can only accept or int ' \
-                'for argument input_descriptor when loading from gzip, ' \
-                'got: {}'.format(type(input_descriptor).__name__))
+    :return: A tuple containing the location of the vehicle's base and a
+        generator over pairs of the number of stationary points following each
+        trip and the trip. The *shape* of each trip is a trace (see
+        :py:mod:`cvts._trace`) and can be converted to a request for Valhalla
+        with :py:func:`cvts._trace.trip_to_request`.
+    """
+    if raw_locs is None:
+        raw_locs = load_trace(input_descriptor, dates)
 
-        raw_locs = _load_gzips(str(input_descriptor), dates)
+    tally('points', len(raw_locs))
 
-    base = locate_base(
-        [ll['lon'] for ll in raw_locs],
-        [ll['lat'] for ll in raw_locs],
-        [ll['speed'] for ll in raw_locs])
+    base = None
+    if find_base:
+        with stage('locate_base'):
+            base = locate_base(raw_locs['lon'], raw_locs['lat'], raw_locs['speed'])
 
-    return base, _prepjson(raw_locs, split_trips)
+    return base, timed_iter('trip_slices', _prepjson(raw_locs, split_trips))
 
 
 
@@ -229,7 +363,7 @@ def rawfiles2jsonfile(
 
     _, chunks = rawfiles2jsonchunks(csv_file, False, None)
     with open(out_file, 'w') as jf:
-        json.dump(next(chunks)[1], jf, indent=4)
+        json.dump(trip_to_request(next(chunks)[1]), jf, indent=4)
 
 
 
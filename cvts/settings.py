@@ -1,4 +1,6 @@
 import os
+import sys
+import shlex
 import logging
 from enum import Enum
 from datetime import datetime as dt
@@ -7,8 +9,21 @@ class RawDataFormat(Enum):
     CSV   = 1
     GZIP  = 3
 
-def _bool_from_env(ev):
-    return os.environ.get(ev, 'False') not in ('0', 'False', 'false')
+class DbWriteMethod(Enum):
+    ORM  = 1
+    COPY = 2
+
+class MatcherBackend(Enum):
+    CLI     = 1
+    SERVICE = 2
+    HTTP    = 3
+
+class IntersectBackend(Enum):
+    TREE_SEARCH = 1
+    STRTREE     = 2
+
+def _bool_from_env(ev, default='False'):
+    return os.environ.get(ev, default) not in ('0', 'False', 'false')
 
 #: Are we debugging. Can be set via the environment variable *CVTS_DEBUG*.
 DEBUG = _bool_from_env('CVTS_DEBUG')
@@ -31,6 +46,54 @@ if _building:
 #: *CVTS_POSTGRES_CONNECTION_STRING*.
 POSTGRES_CONNECTION_STRING = os.environ.get('CVTS_POSTGRES_CONNECTION_STRING', None)
 
+#: How stops, trips and traversals are written to the database. *ORM* adds
+#: the objects for each vehicle to a session and *COPY* buffers rows from
+#: many vehicles and writes them with COPY (see
+#: :py:class:`cvts._bulk.BulkLoader`). Can be set via the environment
+#: variable *CVTS_DB_WRITE_METHOD*.
+DB_WRITE_METHOD = DbWriteMethod[
+    os.environ.get('CVTS_DB_WRITE_METHOD', 'ORM').upper()]
+
+#: The number of rows buffered before they are written when
+#: :py:data:`DB_WRITE_METHOD` is *COPY*. Can be set via the environment
+#: variable *CVTS_BULK_BATCH_ROWS*.
+BULK_BATCH_ROWS = int(os.environ.get('CVTS_BULK_BATCH_ROWS', '200000'))
+
+#: Should the outputs for each trip be written as soon as it has been matched,
+#: rather than once all trips for a vehicle have been matched. This bounds the
+#: memory used for a vehicle by the size of a trip, but a vehicle's rows are
+#: no longer written in a single transaction. Can be set via the environment
+#: variable *CVTS_STREAM_TRIPS*.
+STREAM_TRIPS = _bool_from_env('CVTS_STREAM_TRIPS')
+
+#: Should monthly files from the data lake be converted to traces and cached
+#: in :py:data:`TRACE_CACHE_PATH`, so that later runs read only the days they
+#: need. The cache is not bounded and takes 40 bytes per ping (several times
+#: the size of the compressed files it is built from), so it is off by
+#: default; delete :py:data:`TRACE_CACHE_PATH` to clear it. Can be set via the
+#: environment variable *CVTS_TRACE_CACHE*.
+TRACE_CACHE = _bool_from_env('CVTS_TRACE_CACHE')
+
+#: Should geographies read by :py:func:`cvts.read_shapefile` be cached in
+#: :py:data:`GEOGRAPHY_CACHE_PATH`, so that they are only prepared once. Each
+#: version of a shapefile that is read adds a file of about its size, and
+#: entries are never removed, so this is off by default; delete
+#: :py:data:`GEOGRAPHY_CACHE_PATH` to clear it. Can be set via the
+#: environment variable *CVTS_GEOGRAPHY_CACHE*.
+GEOGRAPHY_CACHE = _bool_from_env('CVTS_GEOGRAPHY_CACHE')
+
+#: The number of vehicles whose raw data each run of
+#: :py:class:`cvts.tasks.MatchToNetwork` loads ahead, in background threads,
+#: while earlier vehicles are being matched. Prefetching is not used if this
+#: is zero. Can be set via the environment variable *CVTS_PREFETCH_VEHICLES*.
+PREFETCH_VEHICLES = int(os.environ.get('CVTS_PREFETCH_VEHICLES', '0'))
+
+#: Approximate maximum number of bytes of prefetched raw data waiting to be
+#: matched. Can be set via the environment variable
+#: *CVTS_PREFETCH_MAX_BYTES*.
+PREFETCH_MAX_BYTES = int(float(os.environ.get(
+    'CVTS_PREFETCH_MAX_BYTES', '1e9')))
+
 _raw_format = os.environ.get('CVTS_RAW_DATA_FORMAT', 'GZIP').upper()
 
 #: The format the raw data is stored in.
@@ -49,6 +112,33 @@ _raw_dir_must_exist = RAW_DATA_FORMAT in \
 #: String used to denote stuff from the lake
 LAKE_FLAG = 'lake'
 
+#: Vehicles with fewer GPS pings than this on the dates being processed, as
+#: recorded in the data lake's *vehicle_days* table, are skipped. Can be set
+#: via the environment variable *CVTS_MIN_VEHICLE_PINGS*.
+MIN_VEHICLE_PINGS = int(os.environ.get('CVTS_MIN_VEHICLE_PINGS', '1'))
+
+#: If set, only pings on days when a vehicle's bounding box (as recorded in
+#: the data lake's *vehicle_days* table) intersects this box are counted when
+#: deciding which vehicles to process. Given as (min lon, min lat, max lon, max
+#: lat) and can be set, as a comma separated list, via the environment variable
+#: *CVTS_VEHICLE_BBOX*. This requires the data lake to be in PostGIS.
+VEHICLE_BBOX = tuple(float(x) for x in os.environ['CVTS_VEHICLE_BBOX'].split(',')) \
+    if os.environ.get('CVTS_VEHICLE_BBOX') else None
+
+#: Cell sizes, in degrees, of the rasters written by
+#: :py:class:`cvts.tasks.RasterCounts`. Can be set, as a comma separated list,
+#: via the environment variable *CVTS_RASTER_CELL_SIZES*.
+RASTER_CELL_SIZES = tuple(float(x) for x in os.environ.get(
+    'CVTS_RASTER_CELL_SIZES', '0.1,0.01,0.001').split(','))
+
+#: How :py:func:`cvts.points_to_polys` finds the polygons containing points.
+#: *TREE_SEARCH* recursively partitions the points and checks each candidate
+#: pair with shapely and *STRTREE* uses a bulk query of a spatial index of the
+#: polygons (or, with shapely 1, vectorised containment checks for each
+#: polygon). Can be set via the environment variable *CVTS_INTERSECT_BACKEND*.
+INTERSECT_BACKEND = IntersectBackend[
+    os.environ.get('CVTS_INTERSECT_BACKEND', 'TREE_SEARCH').upper()]
+
 #! The number of documents to process if in DEBUG mode.
 DEBUG_DOC_LIMIT   = 10
 
@@ -68,6 +158,20 @@ MIN_MOVE_DISTANCE = 50
 #: location.
 MIN_DISTANCE_BETWEEN_STOPS = 50
 
+#: Should trips be thinned before being sent to Valhalla. The edges of the
+#: points dropped are interpolated, by distance along the trip, between those
+#: of the points kept either side of them. Can be set via the environment
+#: variable *CVTS_THIN_TRACES*.
+THIN_TRACES = _bool_from_env('CVTS_THIN_TRACES')
+
+#: When thinning trips, the distance in meters from the last point kept below
+#: which a point is dropped (see also :py:data:`THIN_MAX_INTERVAL`).
+THIN_MIN_DISTANCE = 20
+
+#: When thinning trips, points at least this many seconds after the last point
+#: kept are kept regardless of how far they are from it.
+THIN_MAX_INTERVAL = 60
+
 #: Radius of the Earth in meters.
 EARTH_RADIUS      = 6371000
 
@@ -106,6 +210,21 @@ CONFIG_PATH     = _get_path('config')
 #: Root directory for outputs.
 OUT_PATH        = _get_path('output')
 
+#: Root directory for caches.
+CACHE_PATH      = _get_path('cache')
+
+#: Directory for the :py:class:`cache<cvts._match_cache.MatchCache>` of map
+#: matching results.
+MATCH_CACHE_PATH = os.path.join(CACHE_PATH, 'match')
+
+#: Directory for the :py:class:`cache<cvts._trace_cache.TraceCache>` of raw
+#: data converted to traces.
+TRACE_CACHE_PATH = os.path.join(CACHE_PATH, 'trace')
+
+#: Directory for the :py:class:`cache<cvts._geography_cache.GeographyCache>`
+#: of geographies prepared for intersecting.
+GEOGRAPHY_CACHE_PATH = os.path.join(CACHE_PATH, 'geography')
+
 #: Output directory for :ref:`trip outputs<trip-output>`.
 SEQ_PATH        = os.path.join(OUT_PATH, 'seq')
 
@@ -118,11 +237,66 @@ SRC_DEST_PATH   = os.path.join(OUT_PATH, 'src_dest')
 #: Output directory for :ref:`speed outputs<speed-output>`.
 SPEED_PATH      = os.path.join(OUT_PATH, 'speed')
 
+#: Output directory for metrics on the performance of the pipeline.
+METRICS_PATH    = os.path.join(OUT_PATH, 'metrics')
+
 #: Path to Valhalla configuration file.
 VALHALLA_CONFIG_FILE = os.path.join(CONFIG_PATH, 'valhalla.json')
 
+#: How trips are sent to Valhalla. *CLI* starts a new *valhalla_service*
+#: process for each trip, *SERVICE* feeds trips to a pool of long lived
+#: matcher processes (see :py:data:`VALHALLA_SERVICE_COMMAND`) and *HTTP*
+#: posts them to the servers listed in :py:data:`VALHALLA_URLS`. Can be set
+#: via the environment variable *CVTS_MATCHER_BACKEND*.
+MATCHER_BACKEND = MatcherBackend[
+    os.environ.get('CVTS_MATCHER_BACKEND', 'CLI').upper()]
+
+#: Command used to start a long lived matcher process. The process must read
+#: one trace_attributes request per line from stdin and write one JSON
+#: response per line to stdout. Can be set via the environment variable
+#: *CVTS_VALHALLA_SERVICE_COMMAND*.
+VALHALLA_SERVICE_COMMAND = shlex.split(os.environ.get(
+    'CVTS_VALHALLA_SERVICE_COMMAND',
+    '{} -m cvts._matcher_service {}'.format(
+        shlex.quote(sys.executable),
+        shlex.quote(VALHALLA_CONFIG_FILE))))
+
+#: The number of long lived matcher processes each worker keeps. Can be set
+#: via the environment variable *CVTS_VALHALLA_SERVICE_PROCESSES*.
+VALHALLA_SERVICE_PROCESSES = int(os.environ.get(
+    'CVTS_VALHALLA_SERVICE_PROCESSES', '1'))
+
+#: Seconds to wait for a long lived matcher process to respond to a trip
+#: before it is killed (and the trip fails). Can be set via the environment
+#: variable *CVTS_VALHALLA_SERVICE_TIMEOUT*.
+VALHALLA_SERVICE_TIMEOUT = float(os.environ.get(
+    'CVTS_VALHALLA_SERVICE_TIMEOUT', '300'))
+
+#: URLs of the trace_attributes endpoints used by the *HTTP* backend. Can be
+#: set (as a comma separated list) via the environment variable
+#: *CVTS_VALHALLA_URLS*.
+VALHALLA_URLS = [u.strip() for u in os.environ.get(
+    'CVTS_VALHALLA_URLS',
+    'http://localhost:8002/trace_attributes').split(',') if u.strip()]
+
+#: The maximum number of requests each worker keeps in flight when using the
+#: *HTTP* backend. Can be set via the environment variable
+#: *CVTS_VALHALLA_MAX_IN_FLIGHT*.
+VALHALLA_MAX_IN_FLIGHT = int(os.environ.get('CVTS_VALHALLA_MAX_IN_FLIGHT', '8'))
+
+#: Maximum size, in bytes, of the cache of map matching results. The cache is
+#: not used if this is zero. Can be set via the environment variable
+#: *CVTS_MATCH_CACHE_MAX_BYTES*.
+MATCH_CACHE_MAX_BYTES = int(float(os.environ.get(
+    'CVTS_MATCH_CACHE_MAX_BYTES', '0')))
+
+#: Included in the keys of the cache of map matching results. Change this (via
+#: the environment variable *CVTS_MATCH_CACHE_VERSION*) when the routing tiles
+#: or the Valhalla configuration change.
+MATCH_CACHE_VERSION = os.environ.get('CVTS_MATCH_CACHE_VERSION', '')
+
 if not _building:
-    for p in (CONFIG_PATH, OUT_PATH, SEQ_PATH, STOP_PATH, SRC_DEST_PATH, SPEED_PATH):
+    for p in (CONFIG_PATH, OUT_PATH, CACHE_PATH, SEQ_PATH, STOP_PATH, SRC_DEST_PATH, SPEED_PATH, METRICS_PATH):
         if not os.path.exists(p):
             os.makedirs(p)
 
@@ -142,8 +316,10 @@ if __name__ == '__main__':
         'BOUNDARIES_PATH',
         'CONFIG_PATH',
         'OUT_PATH',
+        'CACHE_PATH',
         'SEQ_PATH',
         'STOP_PATH',
         'SRC_DEST_PATH',
         'SPEED_PATH',
+        'METRICS_PATH',
         'VALHALLA_CONFIG_FILE')) + ';CVTS_RAW_DATA_FORMAT=' + _raw_format)
@@ -1,4 +1,13 @@
 """Luigi tasks."""
 
-from ._valhalla import ListRawFiles, MatchToNetwork
-from ._regiondensity import RegionCounts, RasterCounts, SourceDestinationCounts
+from ._valhalla import (
+    ListRawFiles,
+    LocateBases,
+    MatchToNetwork,
+    MergeShards,
+    SummariseMatchMetrics)
+from ._regiondensity import (
+    HourOfWeekCounts,
+    RegionCounts,
+    RasterCounts,
+    SourceDestinationCounts)
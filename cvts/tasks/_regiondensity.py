@@ -12,13 +12,14 @@ from .. import (
     read_shapefile,
     points_to_polys,
     distance)
-from .._grid import Grid
+from .._grid import CELLSIZE, HourOfWeekCube, new_grid
 from ..settings import (
     OUT_PATH,
     STOP_PATH,
     SRC_DEST_PATH,
     BOUNDARIES_PATH,
-    MIN_DISTANCE_BETWEEN_STOPS)
+    MIN_DISTANCE_BETWEEN_STOPS,
+    RASTER_CELL_SIZES)
 from ._valhalla import MatchToNetwork
 
 logger = logging.getLogger(__name__)
@@ -45,7 +46,8 @@ POINTS_GEOM_COUNTS_CSV_FILE_POSTFIX = 'points_geom_counts.csv'
 
 
 def _ends(end, start):
-    """Generator over stop points at the intersection of two trips.
+    """Generator over stop points, with their times, at the intersection of
+    two trips.
 
     Given trips, use just one point if the end of the first trip is close enough
     to the beginning of the next trip, otherwise, use both the end of the first
@@ -56,20 +58,19 @@ def _ends(end, start):
     of missing data.
     """
 
-    x1, y1 = start['lon'], start['lat']
-    x0, y0 =   end['lon'],     end['lat']
+    x1, y1 = start['loc']['lon'], start['loc']['lat']
+    x0, y0 =   end['loc']['lon'],   end['loc']['lat']
     d = distance(x0, y0, x1, y1)
-    yield x0, y0
+    yield x0, y0, end['time']
     if d > MIN_DISTANCE_BETWEEN_STOPS:
-        yield x1, y1
+        yield x1, y1, start['time']
 
-def _do_stops(filename):
-    """Generator over the stop points for all trips taken by a vehicle.
+def _do_timed_stops(filename):
+    """Generator over the stop points, with the times the vehicle arrived at
+    (or, for the first, left) them, for all trips taken by a vehicle.
 
     See :py:func:`_ends` for how the end/start of successive trips is handled.
     """
-    rego = os.path.splitext(os.path.basename(filename))[0]
-
     with open(filename) as fin:
         stops = json.load(fin)
 
@@ -79,15 +80,23 @@ def _do_stops(filename):
     except StopIteration:
         return
     p0 = t0['start']['loc']
-    yield p0['lon'], p0['lat']
+    yield p0['lon'], p0['lat'], t0['start']['time']
     for t1 in stopiter:
-        for e in _ends(t0['end']['loc'], t1['start']['loc']):
+        for e in _ends(t0['end'], t1['start']):
             yield e
         t0 = t1
     p0 = t0['start']['loc']
     p1 = t0['end']['loc']
     if distance(p0['lon'], p0['lat'], p1['lon'], p1['lat']) > MIN_DISTANCE_BETWEEN_STOPS:
-        yield p1['lon'], p1['lat']
+        yield p1['lon'], p1['lat'], t0['end']['time']
+
+def _do_stops(filename):
+    """Generator over the stop points for all trips taken by a vehicle.
+
+    See :py:func:`_ends` for how the end/start of successive trips is handled.
+    """
+    for lon, lat, _ in _do_timed_stops(filename):
+        yield lon, lat
 
 def _do_source_dest(filename):
     """Generator over the source/dest points for a trip."""
@@ -118,6 +127,29 @@ _source_dests = partial(_do_source_dest, SRC_DEST_PATH, 'src_dest')
 
 
 
+def _raster_counts(cellsizes, points):
+    """Grids, with cell sizes *cellsizes*, of the counts of *points*."""
+    grids = [new_grid(cellsize=cellsize) for cellsize in cellsizes]
+    for grid in grids:
+        grid.increment_points(points[:,0], points[:,1])
+    return grids
+
+
+
+def _hour_of_week_counts(cellsize, filenames):
+    """A :py:class:`cvts._grid.HourOfWeekCube`, with cell size *cellsize*, of
+    the counts of the stop points in the sequence files *filenames*."""
+    points = [p for fn in filenames for p in _do_timed_stops(fn)]
+    cube = HourOfWeekCube(
+        new_grid(cellsize=cellsize),
+        TZ.utcoffset(None).total_seconds())
+    if points:
+        points = np.array(points)
+        cube.increment_points(points[:,0], points[:,1], points[:,2])
+    return cube
+
+
+
 def _name_to_name_with_geom(metric_name, geog_name, postfix):
     return os.path.join(
         OUT_PATH,
@@ -151,7 +183,7 @@ class _LocationPoints(luigi.Task):
 
     def run(self):
         """:meta private:"""
-        with open(self.input()['seq'].fn, 'rb') as sf:
+        with open(self.input().fn, 'rb') as sf:
             all_seq_files = pickle.load(sf)
 
         with Pool() as p:
@@ -308,10 +340,26 @@ class SourceDestinationCounts(_CountsTask):
 
 
 class RasterCounts(luigi.Task):
-    """Counts the number of stop points in each cell of a raster."""
+    """Counts the number of stop points in each cell of rasters with each of
+    the cell sizes in :py:data:`cvts.settings.RASTER_CELL_SIZES`.
+
+    Each raster is saved as *grid_points_<cellsize>.bil* (see
+    :py:meth:`cvts._grid.Grid.save_binary`), and the one with the default
+    cell size (:py:data:`cvts._grid.CELLSIZE`), which is always produced, is
+    also saved as the ASCII grid *grid_points.asc*. The points are split
+    between workers, each of which counts its points at every cell size, and
+    the workers' grids are then summed. Fine rasters are stored sparsely (see
+    :py:func:`cvts._grid.new_grid`).
+    """
 
     ASCII_GRID_FILE_NAME = os.path.join(OUT_PATH, 'grid_points.asc')
 
+    @staticmethod
+    def file_name(cellsize):
+        """The name of the (binary) file the raster with cell size *cellsize*
+        is saved in."""
+        return os.path.join(OUT_PATH, 'grid_points_{}.bil'.format(cellsize))
+
     def requires(self):
         """:meta private:"""
         return _LocationPoints(_stops)
@@ -322,12 +370,74 @@ class RasterCounts(luigi.Task):
         with open(self.input().fn, 'rb') as inf:
             stop_points = pickle.load(inf)
 
-        # construct and save the grid counts
-        grid = Grid()
-        for p in stop_points:
-            grid.increment(*p)
-        grid.save(self.output().fn)
+        cellsizes = sorted(set(RASTER_CELL_SIZES) | {CELLSIZE})
+
+        # count the points in each worker and sum the grids
+        n_workers = os.cpu_count()
+        grids = None
+        with Pool(n_workers) as p:
+            for partial in p.imap_unordered(
+                    _partial(_raster_counts, cellsizes),
+                    np.array_split(stop_points, n_workers)):
+                if grids is None:
+                    grids = partial
+                else:
+                    for grid, part in zip(grids, partial):
+                        grid += part
+
+        for cellsize, grid in zip(cellsizes, grids):
+            grid.save_binary(self.file_name(cellsize))
+
+        # this is the output, so is saved last.
+        grids[cellsizes.index(CELLSIZE)].save(self.output().fn)
 
     def output(self):
         """:meta private:"""
         return luigi.LocalTarget(self.ASCII_GRID_FILE_NAME)
+
+
+
+class HourOfWeekCounts(luigi.Task):
+    """Counts the number of stop points in each cell of a raster for each hour
+    of the week (in Vietnam), giving a :py:class:`cvts._grid.HourOfWeekCube`
+    saved as *stop_hour_of_week_<cellsize>.npz* (see
+    :py:func:`cvts._grid.load_cube`).
+
+    The stop points are those used by :py:class:`RasterCounts`, with the
+    times the vehicles arrived at them. The sequence files are split between
+    workers, each of which fills a cube, and the cubes are then summed.
+    """
+
+    #: The cell size of the rasters.
+    cellsize = luigi.FloatParameter(default = CELLSIZE)
+
+    def requires(self):
+        """:meta private:"""
+        return MatchToNetwork()
+
+    def run(self):
+        """:meta private:"""
+        with open(self.input().fn, 'rb') as sf:
+            all_seq_files = pickle.load(sf)
+
+        n_chunks = 4 * os.cpu_count()
+        cube = None
+        with Pool() as p:
+            for partial in tqdm(p.imap_unordered(
+                    _partial(_hour_of_week_counts, self.cellsize),
+                    [all_seq_files[i::n_chunks] for i in range(n_chunks)]),
+                    total = n_chunks):
+                if cube is None:
+                    cube = partial
+                else:
+                    cube += partial
+
+        # write to a temporary file as numpy adds the extension.
+        tmp = self.output().fn + '.tmp.npz'
+        cube.save(tmp)
+        os.replace(tmp, self.output().fn)
+
+    def output(self):
+        """:meta private:"""
+        return luigi.LocalTarget(os.path.join(
+            OUT_PATH, 'stop_hour_of_week_{}.npz'.format(self.cellsize)))
@@ -3,19 +3,19 @@ import json
 import pickle
 import tempfile
 import logging
+from hashlib import sha256
 from glob import glob
-from multiprocessing import Pool
-from hashlib import sha256 as _hasher
-from functools import reduce
-from datetime import datetime
+from itertools import count, islice, repeat
+from multiprocessing import Pool, SimpleQueue
+from multiprocessing.util import Finalize
 import numpy as np
-import pandas as pd
 from sqlalchemy import create_engine
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, joinedload
 from tqdm import tqdm
 import luigi
 from .. import (
     distance,
+    load_trace,
     rawfiles2jsonchunks,
     json2geojson,
     NoRawDataException,
@@ -25,13 +25,49 @@ from ..settings import (
     DEBUG_DOC_LIMIT,
     OUT_PATH,
     SEQ_PATH,
+    METRICS_PATH,
     POSTGRES_CONNECTION_STRING,
+    DB_WRITE_METHOD,
+    BULK_BATCH_ROWS,
+    STREAM_TRIPS,
+    PREFETCH_VEHICLES,
+    PREFETCH_MAX_BYTES,
     VALHALLA_CONFIG_FILE,
+    VALHALLA_SERVICE_COMMAND,
+    VALHALLA_SERVICE_PROCESSES,
+    VALHALLA_SERVICE_TIMEOUT,
+    VALHALLA_URLS,
+    VALHALLA_MAX_IN_FLIGHT,
+    MATCH_CACHE_PATH,
+    MATCH_CACHE_MAX_BYTES,
+    MATCH_CACHE_VERSION,
+    MATCHER_BACKEND,
+    THIN_TRACES,
+    THIN_MIN_DISTANCE,
+    THIN_MAX_INTERVAL,
     LAKE_FLAG,
+    MIN_VEHICLE_PINGS,
+    VEHICLE_BBOX,
+    DbWriteMethod,
+    MatcherBackend,
     RawDataFormat,
     RAW_DATA_FORMAT)
 from ..models import Vehicle, Base, Stop, Trip, Traversal
-from .._base_locator import EmptyCellsException
+from .._utils import _distances, _thin_indices, _files_for_dates
+from .._trace import HEADING_TOLERANCE, trip_to_request
+from .._base_locator import EmptyCellsException, MAX_STATIONARY_SPEED, locate_bases
+from .._bulk import BulkLoader
+from .._journal import Journal, JournalError
+from .._prefetch import prefetch
+from .._scheduling import estimate_costs, largest_first, report_makespan
+from .._timer import Timer, collect, merge, stage, summarise, tally
+from .._traversals import average_speeds, missing_edges, time_fields
+from .._matcher import MatcherPool
+from .._http_matcher import HttpMatcher
+from .._match_cache import MatchCache
+
+if RAW_DATA_FORMAT == RawDataFormat.GZIP:
+    from .._data_retrieval import vehicle_days
 
 
 
@@ -51,12 +87,20 @@ MM_KEYS = POINT_KEYS + \
 NAS = (NA_VALUE,) * len(EDGE_KEYS)
 TRAVERSAL_KEYS = ('edge_id', 'edge_index', 'status', 'speed', 'time')
 TRAVERSAL_INDS = [MM_KEYS.index(k) for k in TRAVERSAL_KEYS]
+STATUS_IND = MM_KEYS.index('status')
+EDGE_ID_IND = MM_KEYS.index('edge_id')
+
+#: Points moving at or below this speed (in km/h) are not used when
+#: calculating the average speed on an edge.
+#TODO: Do we want to check 'valhalla_speed' also/instead
+MIN_TRAVERSAL_SPEED = 6
 
 
 
-def _getpointattrs(point):
-    """Get output attributes from input point."""
-    return tuple(point[k] for k in POINT_KEYS)
+def _getpointattrs(trace):
+    """Get output attributes for each point in *trace*."""
+    return zip(*(trace[k].tolist() for k in POINT_KEYS[:-1]),
+        repeat(HEADING_TOLERANCE))
 
 
 
@@ -90,6 +134,160 @@ def _run_valhalla(rego, trip, trip_index):
 
 
 
+# created lazily so each worker process gets its own matchers.
+_matchers = None
+def _get_matchers():
+    global _matchers
+    if _matchers is None:
+        _matchers = MatcherPool(
+            VALHALLA_SERVICE_COMMAND,
+            VALHALLA_SERVICE_PROCESSES,
+            VALHALLA_SERVICE_TIMEOUT)
+    return _matchers
+
+_http_matcher = None
+def _get_http_matcher():
+    global _http_matcher
+    if _http_matcher is None:
+        _http_matcher = HttpMatcher(VALHALLA_URLS, VALHALLA_MAX_IN_FLIGHT)
+    return _http_matcher
+
+_match_cache = MatchCache(
+    MATCH_CACHE_PATH,
+    MATCH_CACHE_MAX_BYTES,
+    MATCH_CACHE_VERSION) if MATCH_CACHE_MAX_BYTES > 0 else None
+
+
+
+def _match(rego, trip, trip_index):
+    """Match *trip* using the backend specified by
+    :py:data:`cvts.settings.MATCHER_BACKEND`."""
+    if MATCHER_BACKEND == MatcherBackend.SERVICE:
+        with _get_matchers().borrow() as matcher:
+            return matcher.match(trip)
+
+    return _run_valhalla(rego, trip, trip_index)
+
+
+
+def _thin_trip(trip):
+    """Thin the points in *trip*, returning the thinned trip and, for every
+    point in *trip*, the index in the thinned trip of the last point kept at
+    or before it and the fraction of the distance along *trip* from that
+    point to the next point kept (as a pair of arrays)."""
+    shape = trip['shape']
+    keep = _thin_indices(shape, THIN_MIN_DISTANCE, THIN_MAX_INTERVAL)
+    if len(keep) == len(shape):
+        return trip, None
+
+    along = np.concatenate(([0.], np.cumsum(_distances(
+        shape['lon'][:-1], shape['lat'][:-1], shape['lon'][1:], shape['lat'][1:]))))
+    keep = np.array(keep)
+    last = np.cumsum(np.isin(np.arange(len(shape)), keep)) - 1
+    start = along[keep[last]]
+    length = along[keep[np.minimum(last + 1, len(keep) - 1)]] - start
+    fraction = np.divide(along - start, length,
+        out=np.zeros(len(shape)), where=length > 0)
+    thinned = dict(trip, shape=shape[keep])
+    return thinned, (last, fraction)
+
+
+
+def _unthin(snapped, mapping):
+    """Expand the matched points in *snapped* (the output of Valhalla for a
+    thinned trip) to all points of the original trip (*mapping* is the second
+    output of :py:func:`_thin_trip`). Dropped points take the match of the last
+    point kept before them, but with the edge interpolated between those of
+    the points kept either side of them (so it is only approximate)."""
+    mps = snapped['matched_points']
+    last, fraction = mapping
+    kept = np.diff(last, prepend=-1) > 0
+
+    def dropped(m, fraction):
+        mp = dict(mps[m], type='thinned')
+        ei = mp.get('edge_index')
+        next_ei = mps[m + 1].get('edge_index') if m + 1 < len(mps) else None
+        if ei is not None and next_ei is not None:
+            mp['edge_index'] = ei + int(round(fraction * (next_ei - ei)))
+        return mp
+
+    snapped = dict(snapped)
+    snapped['matched_points'] = [mps[m] if k else dropped(m, f) \
+        for m, k, f in zip(last.tolist(), kept.tolist(), fraction.tolist())]
+    return snapped
+
+
+
+def _snap_trips(rego, trips):
+    """Generator over pairs of the items in *trips* (pairs of the number of
+    stationary points and the trip) and the output from Valhalla for the trip
+    (or the exception raised while trying to get it).
+
+    If :py:data:`cvts.settings.THIN_TRACES` is set, trips are thinned before
+    being sent to Valhalla and the matched points are expanded back to the
+    points of the original trip. If the cache of map matching results is
+    enabled, it is checked before sending each trip to Valhalla and successful
+    results are added to it."""
+    cache = _match_cache
+    hits = set()
+
+    def prepare(item):
+        trip, mapping = _thin_trip(item[1]) if THIN_TRACES else (item[1], None)
+        request = trip_to_request(trip)
+        return item, request, mapping, \
+            None if cache is None else cache.key(request)
+
+    def lookup(prepared):
+        key = prepared[3]
+        if key is None:
+            return None
+        result = cache.get(key)
+        if result is not None:
+            hits.add(key)
+        return result
+
+    prepared_trips = (prepare(item) for item in trips)
+
+    if MATCHER_BACKEND == MatcherBackend.HTTP:
+        results = _get_http_matcher().imap(
+            prepared_trips,
+            key    = lambda prepared: prepared[1],
+            cached = lookup)
+
+    else:
+        def match_all():
+            for trip_index, prepared in enumerate(prepared_trips):
+                snapped = lookup(prepared)
+                if snapped is None:
+                    try:
+                        with stage('match'):
+                            snapped = _match(rego, prepared[1], trip_index)
+                    except Exception as e:
+                        snapped = e
+                yield prepared, snapped
+        results = match_all()
+
+    for (item, _, mapping, key), snapped in results:
+        if isinstance(snapped, Exception):
+            yield item, snapped
+            continue
+
+        if key is not None:
+            if key in hits:
+                hits.discard(key)
+            else:
+                cache.put(key, snapped)
+
+        if mapping is not None:
+            try:
+                snapped = _unthin(snapped, mapping)
+            except Exception as e:
+                snapped = e
+
+        yield item, snapped
+
+
+
 try:
     # this breaks the documentation build
     _engine = create_engine(POSTGRES_CONNECTION_STRING)
@@ -100,92 +298,156 @@ def _init_db_connections():
     global _engine, _session_maker
     _engine.dispose()
 
-def write_to_db(vehicle, base, stops, trips, travs):
-    with Session(_engine) as session, session.begin():
+_bulk_loader = None
+def _get_bulk_loader():
+    global _bulk_loader
+    if _bulk_loader is None:
+        _bulk_loader = BulkLoader(_engine, BULK_BATCH_ROWS)
+        # write whatever is left when a worker process exits.
+        Finalize(None, _flush_db, exitpriority=10)
+    return _bulk_loader
+
+def _flush_db():
+    """Write any rows buffered by the bulk loader."""
+    if _bulk_loader is not None:
+        try:
+            _bulk_loader.flush()
+        except Exception:
+            logger.exception('bulk load failed')
+
+def write_to_db(vehicle, base, stops, trips, travs, on_commit=None):
+    """Write the outputs for a vehicle to the database, calling *on_commit*
+    once they have been committed (which, when using the bulk loader, may be
+    after rows from later vehicles have been written)."""
+    if DB_WRITE_METHOD == DbWriteMethod.COPY:
+        _get_bulk_loader().add(vehicle, base, stops, trips, travs, on_commit)
+        return
+
+    # don't expire the objects so their ids can be used after the commit.
+    with Session(_engine, expire_on_commit=False) as session, session.begin():
         session.add(vehicle)
-        session.add(base)
+        if base is not None: session.add(base)
         for stop in stops: session.add(stop)
         for trip in trips: session.add(trip)
         for trav in travs: session.add(trav)
 
+    if on_commit is not None:
+        on_commit()
 
 
-def _get_vehicle(vehicle_etl_id):
-    with Session(_engine, expire_on_commit=False) as session, session.begin():
-        return session.query(Vehicle).filter_by(etl_id=vehicle_etl_id).one()
-
-
-
-def _average_speed(rego, results):
-    df = pd.DataFrame({k:r[i] for k, i in zip(
-        TRAVERSAL_KEYS, TRAVERSAL_INDS)} for r in results)
-    df.drop(df[(df.status == 'failure') | (df.edge_id == NA_VALUE)].index, inplace=True)
 
-    if df.shape[0] == 0:
-        return None, None
-
-    df['edge_id'] = df['edge_id'].astype(np.uint64)
-
-    # average speed
-    def ave_speed(df):
-        return pd.Series({
-            'edge_id'  : df['edge_id'].iloc[0],
-            'speed'    : np.average(df['speed']),
-            'weight'   : df.shape[0],
-            'timestamp': int(np.average(df['time']))})
-
-    #TODO: Do we want to check 'valhalla_speed' also/instead
-    speed = df[df.speed > 6].groupby(
-        ['edge_index']).apply(ave_speed).reset_index(drop=True)
-
-    # missing edges and estimated times
-    def edge_times(i1, i2, t1, t2):
-        # TODO: consider if we want to take account of the edge lengths here.
-        d = int(i2 - i1)
-        if d < 2: return []
-        dfrac = 1. / float(d)
-        tdiff = float(t2 - t1)
-        return [(
-            int(i1 + i + 1),
-            int(t1 + (float(i)+1.) * dfrac * tdiff)) for i in range(d-1)]
-
-    eds = reduce(
-        lambda a, n: a + edge_times(*n),
-        zip(
-            df['edge_index'].iloc[ :-1],
-            df['edge_index'].iloc[1:  ],
-            df['time'].iloc[ :-1],
-            df['time'].iloc[1:  ]),
-        [])
-
-    if len(speed) != 0:
-        speed["rego"] = rego
-        return eds, speed
-
-    return eds, None
-
-
-
-def _process_trips(rego, trips, seq_file_name, vehicle, base):
-    def run_trip(trip, trip_index):
+def _get_vehicle(vehicle_etl_id=None, vehicle_id=None, rego=None):
+    # the base is loaded with the vehicle, so whether it has one can be checked
+    # without another query.
+    with Session(_engine, expire_on_commit=False) as session, session.begin():
+        if vehicle_id is not None:
+            return session.get(Vehicle, vehicle_id, options=[joinedload(Vehicle.base)])
+        query = session.query(Vehicle).options(joinedload(Vehicle.base))
+        if rego is not None:
+            return query.filter_by(rego=rego).one_or_none()
+        return query.filter_by(etl_id=vehicle_etl_id).one()
+
+def _write_bases(bases):
+    """Write *bases*, a dictionary of (lon, lat) pairs keyed by rego (for CSV
+    data) or ETL id (for data from the lake), to the database, replacing any
+    bases the vehicles already have. For CSV data, vehicles which are not in
+    the database are added."""
+    with Session(_engine) as session, session.begin():
+        if RAW_DATA_FORMAT == RawDataFormat.GZIP:
+            vehicles = {v.etl_id: v for v in session.query(Vehicle)}
+        else:
+            vehicles = {v.rego: v for v in session.query(Vehicle)}
+
+        existing = [vehicles[k].id for k in bases if k in vehicles]
+        for i in range(0, len(existing), 1000):
+            session.query(Base) \
+                .filter(Base.vehicle_id.in_(existing[i:i+1000])) \
+                .delete(synchronize_session=False)
+
+        for key, (lon, lat) in bases.items():
+            vehicle = vehicles.get(key)
+            if vehicle is None:
+                if RAW_DATA_FORMAT == RawDataFormat.GZIP:
+                    logger.warning('no vehicle with etl_id: {}'.format(key))
+                    continue
+                vehicle = Vehicle(rego = key)
+            session.add(Base(vehicle=vehicle, lon=lon, lat=lat))
+
+
+
+def _traversals(results, edge_ids):
+    """Calculate the edge traversals for a trip.
+
+    :param results: The map matched points for the trip (as produced by
+        *run_trip* in :py:func:`_process_trips`).
+
+    :param edge_ids: The ids of the edges Valhalla matched the trip to.
+
+    :return: *None* if no points were matched, otherwise a dictionary of
+        arrays, with one element for each traversal, keyed by the names of the
+        columns of :py:class:`cvts.models.Traversal`. Edges with points moving
+        faster than :py:data:`MIN_TRAVERSAL_SPEED` get their average speed and
+        edges skipped between matched points get an estimated time and no
+        speed.
+    """
+    matched = [[r[i] for i in TRAVERSAL_INDS] for r in results \
+        if r[STATUS_IND] != 'failure' and r[EDGE_ID_IND] != NA_VALUE]
+
+    if len(matched) == 0:
+        return None
+
+    edge_id, edge_index, _, speed, time = zip(*matched)
+    edge_id    = np.array(edge_id, dtype=np.uint64)
+    edge_index = np.array(edge_index, dtype=np.int64)
+    speed      = np.array(speed, dtype=float)
+    time       = np.array(time, dtype=float)
+
+    s_edge, s_speed, s_count, s_time = average_speeds(
+        edge_index, edge_id, speed, time, MIN_TRAVERSAL_SPEED)
+    m_index, m_time = missing_edges(edge_index, time)
+    m_edge = np.array(edge_ids, dtype=np.uint64)[m_index] if len(m_index) \
+        else np.zeros(0, dtype=np.uint64)
+
+    timestamp = np.concatenate((s_time, m_time))
+    hour, dow, doy, woy = time_fields(timestamp)
+
+    return {
+        'edge'     : np.concatenate((s_edge, m_edge)),
+        'timestamp': timestamp,
+        'hour'     : hour,
+        'dow'      : dow,
+        'doy'      : doy,
+        'woy'      : woy,
+        'speed'    : np.concatenate((s_speed, np.full(len(m_index), np.nan))),
+        'count'    : np.concatenate((s_count, np.ones(len(m_index), dtype=np.int64)))}
+
+
+
+def _process_trips(rego, trips, seq_file_name, vehicle, base, journal, resume=None):
+    """Match the trips of a vehicle and write the outputs for them.
+
+    Each batch of rows committed is recorded in *journal*. If *resume* (the
+    last batch recorded in the journal by an earlier run) is given, the trips
+    before the batch's *next_trip* are skipped and the seq file written by the
+    earlier run is continued.
+    """
+    def run_trip(trip, trip_index, snapped):
         try:
+            shape = trip['shape']
             trip_data = {
                 'trip_index': trip_index,
                 'start': {
-                    'time': int(trip['shape'][ 0]['time']),
+                    'time': int(shape['time'][ 0]),
                     'loc' : {
-                        'lat': trip['shape'][ 0]['lat'],
-                        'lon': trip['shape'][ 0]['lon']}},
+                        'lat': float(shape['lat'][ 0]),
+                        'lon': float(shape['lon'][ 0])}},
                 'end':   {
-                    'time': int(trip['shape'][-1]['time']),
+                    'time': int(shape['time'][-1]),
                     'loc': {
-                        'lat': trip['shape'][-1]['lat'],
-                        'lon': trip['shape'][-1]['lon']}}}
-
-            try:
-                snapped = _run_valhalla(rego, trip, trip_index)
+                        'lat': float(shape['lat'][-1]),
+                        'lon': float(shape['lon'][-1])}}}
 
-            except:
+            if isinstance(snapped, Exception):
                 raise Exception('valhalla failure')
 
             # convert the output from Valhalla into our outputs (seq files).
@@ -198,10 +460,10 @@ def _process_trips(rego, trips, seq_file_name, vehicle, base):
             match_props = ((p.get('edge_index'), p['type']) for p \
                 in snapped['matched_points'])
 
-            return trip_data, [_getpointattrs(p) + \
+            return trip_data, [p + \
                 ('success', trip_index) + \
                 (_getedgeattrs(edges[ei]) if ei is not None else NAS) + \
-                (ei, mt,) for p, (ei, mt) in zip(trip['shape'], match_props)]
+                (ei, mt,) for p, (ei, mt) in zip(_getpointattrs(shape), match_props)]
 
         except Exception as e:
             e_str = '{}: {}'.format(e.__class__.__name__, str(e))
@@ -210,115 +472,183 @@ def _process_trips(rego, trips, seq_file_name, vehicle, base):
             trip_data['way_ids']  = []
             trip_data['status']   = 'failure'
             trip_data['message']  = e_str
-            return trip_data, [_getpointattrs(p) + \
+            return trip_data, [p + \
                 ('failure', trip_index) + \
                 NAS + \
-                (NA_VALUE, e_str) for p in trip['shape']]
+                (NA_VALUE, e_str) for p in _getpointattrs(trip['shape'])]
+
+    part_file_name = seq_file_name + '.part'
+
+    # a run can only be resumed from a batch written while streaming.
+    stream = STREAM_TRIPS or resume is not None
 
     try:
-        with open(seq_file_name , 'w') as seqfile:
-
-            def gen_stop(td1, td2, n_stationary):
-                start_ll = (
-                    td1['end']['loc']['lon'],
-                    td1['end']['loc']['lat'])
-                end_ll = (
-                    td2['start']['loc']['lon'],
-                    td2['start']['loc']['lat'])
-                distance_between_start_and_end = distance(
-                    start_ll[0], start_ll[1],
-                    end_ll[0], end_ll[1])
-                start_time = td1['end']['time']
-                end_time   = td2['start']['time']
-
-                return Stop(
-                    vehicle = vehicle,
-                    start_time = start_time,
-                    end_time = end_time,
-                    n_stationary = n_stationary,
-                    start_end_dist = distance_between_start_and_end,
-                    start_lon = start_ll[0],
-                    start_lat = start_ll[1],
-                    end_lon = end_ll[0],
-                    end_lat = end_ll[1])
-
-            def gen_trip(stop1, stop2):
-                return Trip(
-                    vehicle = vehicle,
-                    start   = stop1,
-                    end     = stop2)
-
-            def gen_traversals(result, trip, edge_ids):
-                def times(ts):
-                    d  = datetime.fromtimestamp(int(ts))
-                    _, week, day = d.isocalendar()
-                    week -= 1
-                    day  -= 1
-                    return ts, d.hour, day, 7*week + day, week
-
-                missing_inds_and_ts, speeds =  _average_speed(rego, result)
-                if speeds is not None:
-                    for index, line in speeds.iterrows():
-                        ts, hour, dow, doy, woy = times(line['timestamp'])
-                        yield Traversal(
-                            vehicle   = vehicle,
-                            trip      = trip,
-                            edge      = line['edge_id'],
-                            timestamp = ts,
-                            hour      = hour,
-                            dow       = dow,
-                            doy       = doy,
-                            woy       = woy,
-                            speed     = line['speed'],
-                            count     = line['weight'])
-
-                if missing_inds_and_ts is not None:
-                    for index, time in missing_inds_and_ts:
-                        ts, hour, dow, doy, woy = times(time)
-                        yield Traversal(
-                            vehicle   = vehicle,
-                            trip      = trip,
-                            edge      = edge_ids[index],
-                            timestamp = ts,
-                            hour      = hour,
-                            dow       = dow,
-                            doy       = doy,
-                            woy       = woy,
-                            speed     = None,
-                            count     = 1)
-
-            results = [(run_trip(trip, ti), n_stationary) for \
-                    ti, (n_stationary, trip) in enumerate(trips)]
-
-            n_stationary = [r[1]    for r in results]
-            trip_data    = [r[0][0] for r in results]
-            mm           = [r[0][1] for r in results]
-            edge_ids     = [td['edge_ids'] for td in trip_data]
-
-            # stops
-            s0 = Stop(
-                vehicle    = vehicle,
-                end_time   = trip_data[0]['start']['time'],
-                end_lon    = trip_data[0]['start']['loc']['lon'],
-                end_lat    = trip_data[0]['start']['loc']['lat'])
-            sn = Stop(
-                vehicle    = vehicle,
-                start_time = trip_data[-1]['end']['time'],
-                start_lon  = trip_data[-1]['end']['loc']['lon'],
-                start_lat  = trip_data[-1]['end']['loc']['lat'])
-            stops  = [s0] + [gen_stop(td1, td2, ns) for td1, td2, ns in zip(
-                trip_data[:-1], trip_data[1:], n_stationary[1:])] + [sn]
-
-            # trips
-            trips = [gen_trip(s1, s2) for s1, s2 in zip(
-                stops[:-1], stops[1:])]
-
-            # traversals
-            traversals = [t for ms, ts, es in zip(mm, trips, edge_ids) \
-                for t in gen_traversals(ms, ts, es)]
-
-            write_to_db(vehicle, base, stops, trips, traversals)
-            json.dump(trip_data, seqfile)
+        if resume is None:
+            journal.start()
+            seqfile = open(part_file_name, 'w')
+            seqfile.write('[')
+            first_trip, resume_stop = 0, None
+        else:
+            # drop whatever was written after the last batch committed.
+            if os.path.getsize(part_file_name) < resume['seq']:
+                raise JournalError('{} is shorter than recorded in {}'.format(
+                    part_file_name, journal.path))
+            os.truncate(part_file_name, resume['seq'])
+            seqfile = open(part_file_name, 'a')
+            first_trip = resume['next_trip']
+            resume_stop = None if resume['stop'] is None else Stop(id=resume['stop'])
+
+        def first_stop(td):
+            return Stop(
+                end_time   = td['start']['time'],
+                end_lon    = td['start']['loc']['lon'],
+                end_lat    = td['start']['loc']['lat'],
+                **owner)
+
+        def last_stop(td):
+            return Stop(
+                start_time = td['end']['time'],
+                start_lon  = td['end']['loc']['lon'],
+                start_lat  = td['end']['loc']['lat'],
+                **owner)
+
+        def gen_stop(td1, td2, n_stationary):
+            start_ll = (
+                td1['end']['loc']['lon'],
+                td1['end']['loc']['lat'])
+            end_ll = (
+                td2['start']['loc']['lon'],
+                td2['start']['loc']['lat'])
+            distance_between_start_and_end = distance(
+                start_ll[0], start_ll[1],
+                end_ll[0], end_ll[1])
+            start_time = td1['end']['time']
+            end_time   = td2['start']['time']
+
+            return Stop(
+                start_time = start_time,
+                end_time = end_time,
+                n_stationary = n_stationary,
+                start_end_dist = distance_between_start_and_end,
+                start_lon = start_ll[0],
+                start_lat = start_ll[1],
+                end_lon = end_ll[0],
+                end_lat = end_ll[1],
+                **owner)
+
+        def gen_traversals(result, trip, edge_ids):
+            travs = _traversals(result, edge_ids)
+            if travs is None:
+                return
+
+            cols = {k: v.tolist() for k, v in travs.items()}
+            speeds = [None if np.isnan(v) else v for v in cols.pop('speed')]
+            for i, speed in enumerate(speeds):
+                yield Traversal(
+                    **owner,
+                    trip    = trip,
+                    speed   = speed,
+                    **{k: v[i] for k, v in cols.items()})
+
+        # the rows waiting to be written.
+        stops, trips_out, traversals = [], [], []
+
+        def add_trip(start, end, mm, edge_ids):
+            if start.id is None:
+                trip = Trip(start=start, end=end, **owner)
+                stops.append(start)
+            else:
+                # the stop has already been written. Refer to it by id so that
+                # the rows for earlier trips are not kept alive through it.
+                trip = Trip(start_id=start.id, end=end, **owner)
+            stops.append(end)
+            trips_out.append(trip)
+            n = len(traversals)
+            with stage('traversals'):
+                traversals.extend(gen_traversals(mm, trip, edge_ids))
+            tally('trips')
+            tally('traversals', len(traversals) - n)
+
+        batches = count(1 if resume is None else resume['batch'] + 1)
+
+        def write(next_trip=None, stop=None, time=None, on_done=None):
+            # write the rows waiting to be written, recording the batch in the
+            # journal once they have been committed. If *on_done* is given,
+            # this is the last batch and it is called once it is recorded.
+            nonlocal base
+            entry = {
+                'batch'    : next(batches),
+                'next_trip': next_trip,
+                'time'     : time,
+                'seq'      : None,
+                'complete' : on_done is not None}
+            if not seqfile.closed:
+                # the trips before *next_trip* must be in the seq file on resume.
+                seqfile.flush()
+                os.fsync(seqfile.fileno())
+                entry['seq'] = seqfile.tell()
+
+            def on_commit():
+                entry['vehicle'] = vehicle.id
+                entry['stop'] = None if stop is None else stop.id
+                if journal.record(entry) and on_done is not None:
+                    on_done()
+
+            with stage('write_db'):
+                write_to_db(vehicle, base, stops, trips_out, traversals, on_commit)
+            base = None
+            del stops[:], trips_out[:], traversals[:]
+
+        # each trip is kept until the next one has been matched, as the stop
+        # between them is needed to finish it.
+        prev = None
+        with seqfile:
+            if stream and resume is None:
+                # write the vehicle (and base) first, so the rows for each trip
+                # can refer to it by id.
+                write(next_trip=0)
+            owner = {'vehicle_id': vehicle.id} if stream else {'vehicle': vehicle}
+
+            for ti, ((n_stationary, trip), snapped) in enumerate(_snap_trips(
+                    rego, islice(trips, first_trip, None)), first_trip):
+                trip_data, mm = run_trip(trip, ti, snapped)
+                if trip_data['status'] == 'failure':
+                    tally('failed_trips')
+                if prev is not None:
+                    prev_data, prev_mm, prev_stop = prev
+                    stop = gen_stop(prev_data, trip_data, n_stationary)
+                    add_trip(prev_stop, stop, prev_mm, prev_data['edge_ids'])
+                    if stream:
+                        write(ti, stop, trip_data['start']['time'])
+                elif resume_stop is not None:
+                    if trip_data['start']['time'] != resume['time']:
+                        raise JournalError('trip {} does not match {}'.format(
+                            ti, journal.path))
+                    stop = resume_stop
+                else:
+                    stop = first_stop(trip_data)
+
+                if ti > 0:
+                    seqfile.write(', ')
+                json.dump(trip_data, seqfile)
+                prev = trip_data, mm, stop
+            seqfile.write(']')
+
+        if prev is None:
+            raise ValueError('no trips')
+
+        prev_data, prev_mm, prev_stop = prev
+        add_trip(prev_stop, last_stop(prev_data), prev_mm, prev_data['edge_ids'])
+
+        # the seq file marks the vehicle as done, so only create it once the
+        # outputs are in the database.
+        def done():
+            os.replace(part_file_name, seq_file_name)
+            journal.remove()
+        write(on_done=done)
+
+    except JournalError:
+        raise
 
     except Exception as e:
         logger.exception('processing {} failed...'.format(rego))
@@ -328,13 +658,73 @@ def _process_trips(rego, trips, seq_file_name, vehicle, base):
 
 
 
-def _process_files(dates, fns):
-    rego_or_id  = fns[0]
-    input_files = fns[1]
-
+def _input_descriptor(rego_or_id, input_files, dates):
+    """The input descriptor (see :py:func:`cvts.rawfiles2jsonchunks`) and dates
+    to load for a vehicle from its entry in the output of
+    :py:class:`ListRawFiles`."""
     if isinstance(input_files, str):
         if input_files == LAKE_FLAG:
             input_files = rego_or_id
+    elif isinstance(input_files, dict):
+        # the days the vehicle has pings on (see ListRawFiles), so the loader
+        # only reads those.
+        dates = sorted(input_files)
+        input_files = rego_or_id
+    return input_files, dates
+
+
+
+def _load(arg):
+    """Load the raw data for a vehicle ahead of processing it (see
+    :py:func:`cvts._prefetch.prefetch`).
+
+    :return: *None* if the vehicle has been processed, otherwise a tuple
+        containing the trace and the metrics recorded loading it.
+    """
+    dates, (rego_or_id, input_files) = arg
+    if os.path.exists(os.path.join(SEQ_PATH, '{}.json'.format(rego_or_id))):
+        return None
+    input_files, load_dates = _input_descriptor(rego_or_id, input_files, dates)
+    with collect() as metrics:
+        raw_locs = load_trace(input_files, load_dates)
+    return raw_locs, metrics.record()
+
+
+
+def _stationary_points(arg):
+    """The points at which a vehicle was stationary, for
+    :py:class:`LocateBases`.
+
+    :return: A tuple containing the vehicle's key, and arrays of the
+        longitudes and latitudes of the points.
+    """
+    dates, (rego_or_id, input_files) = arg
+    input_files, load_dates = _input_descriptor(rego_or_id, input_files, dates)
+    try:
+        raw_locs = load_trace(input_files, load_dates)
+    except NoRawDataException:
+        return rego_or_id, np.empty(0), np.empty(0)
+    raw_locs = raw_locs[raw_locs['speed'] <= MAX_STATIONARY_SPEED]
+    return rego_or_id, raw_locs['lon'], raw_locs['lat']
+
+
+
+def _loaded_nbytes(loaded):
+    return 0 if loaded is None else loaded[0].nbytes
+
+
+
+def _process_files(dates, fns, loaded=None):
+    """Process a vehicle.
+
+    :param loaded: The output of :py:func:`_load` for the vehicle, if its raw
+        data was loaded ahead of time.
+
+    :raises JournalError: If the vehicle's journal (or the seq file written
+        with it) does not match its inputs, so it cannot be resumed.
+    """
+    rego_or_id  = fns[0]
+    input_files, load_dates = _input_descriptor(rego_or_id, fns[1], dates)
 
     seq_file_name = os.path.join(SEQ_PATH, '{}.json'.format(rego_or_id))
 
@@ -342,20 +732,55 @@ def _process_files(dates, fns):
         logger.debug('skipping: {} (done)'.format(rego_or_id))
         return
 
+    journal = Journal(
+        os.path.join(SEQ_PATH, '{}.journal'.format(rego_or_id)),
+        {'dates': None if dates is None else [d.isoformat() for d in dates]})
+
     # Can't do this in the block above if we want to check that we must proceed
     # first.
     try:
-        base, trips = rawfiles2jsonchunks(input_files, True, dates)
-
-        if RAW_DATA_FORMAT == RawDataFormat.GZIP:
+        resume = journal.load()
+        if resume is not None and resume['complete']:
+            # the outputs were committed, but the seq file was not moved into
+            # place.
+            os.replace(seq_file_name + '.part', seq_file_name)
+            journal.remove()
+            return
+
+        raw_locs = None
+        if loaded is not None:
+            raw_locs, record = loaded
+            merge(record)
+            tally('prefetched')
+
+        if resume is not None:
+            # the vehicle and base were written by the run being resumed.
+            logger.info('resuming {} from trip {}'.format(
+                rego_or_id, resume['next_trip']))
+            vehicle = _get_vehicle(vehicle_id = resume['vehicle'])
+        elif RAW_DATA_FORMAT == RawDataFormat.GZIP:
             # in the case, the db was populated previously
             vehicle = _get_vehicle(vehicle_etl_id = rego_or_id)
         else:
-            vehicle = Vehicle(rego = rego_or_id)
-
-        base = Base(vehicle=vehicle, lon=base[0], lat=base[1])
-
-        _process_trips(rego_or_id, trips, seq_file_name, vehicle, base)
+            vehicle = _get_vehicle(rego = rego_or_id) or \
+                Vehicle(rego = rego_or_id)
+
+        # only locate the base if the vehicle does not have one (e.g., written
+        # by LocateBases).
+        find_base = resume is None and vehicle.base is None
+        base, trips = rawfiles2jsonchunks(
+            input_files, True, load_dates, raw_locs=raw_locs, find_base=find_base)
+        if find_base:
+            base = Base(vehicle=vehicle, lon=base[0], lat=base[1])
+
+        _process_trips(rego_or_id, trips, seq_file_name, vehicle, base,
+            journal, resume)
+
+    except JournalError as e:
+        # the rows committed by the earlier run are in the database, so the
+        # vehicle cannot just be processed again from the start (nor skipped,
+        # as it would be on every later run).
+        raise JournalError('cannot resume {}: {}'.format(rego_or_id, str(e))) from e
 
     except EmptyCellsException as e:
         logger.warning('failed to locate base ({}) for: {}'.format(
@@ -368,22 +793,96 @@ def _process_files(dates, fns):
 
 
 
+def _in_shard(key, shard, n_shards):
+    """Is the vehicle with *key* in shard *shard* of *n_shards*? Vehicles are
+    assigned to shards by a hash of their key, which is the same on every
+    host."""
+    digest = sha256(str(key).encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % n_shards == shard
+
+
+
+def _shard_file_name(file_name, shard, n_shards):
+    """The name of the version of *file_name* for a shard."""
+    if n_shards == 1:
+        return file_name
+    root, ext = os.path.splitext(file_name)
+    return '{}_{}_of_{}{}'.format(root, shard, n_shards, ext)
+
+
+
+def _dates_file_name(file_name, dates):
+    """The version of *file_name* for *dates*, named by a digest of them (as
+    there may be many)."""
+    if dates is None:
+        return file_name
+    digest = sha256(','.join(str(d) for d in dates).encode()).hexdigest()
+    root, ext = os.path.splitext(file_name)
+    return '{}_{}{}'.format(root, digest[:16], ext)
+
+
+
+# the queue the workers put the size of each prefetched trace in when they
+# start on it (see MatchToNetwork.run).
+_started = None
+def _init_worker(started=None):
+    global _started
+    _started = started
+    _init_db_connections()
+
+
+
 # workaround for multiprocessing pickling limitations
 def lproc(arg):
-    return _process_files(arg[0], arg[1])
+    if _started is not None:
+        _started.put(_loaded_nbytes(arg[2]))
+    with collect(vehicle = str(arg[1][0])) as metrics:
+        _process_files(*arg)
+    return arg[1][0], metrics.record()
 
 
 #-------------------------------------------------------------------------------
 # Luigi tasks
 #-------------------------------------------------------------------------------
 class ListRawFiles(luigi.Task):
-    """Gather information about input files."""
+    """Gather information about input files.
 
-    pickle_file_name = os.path.join(OUT_PATH, 'raw_files.pkl')
+    Vehicles with no data on *dates* are skipped. For data from the lake,
+    this uses the *vehicle_days* table, which also gives the days each vehicle
+    has data on (see :py:data:`cvts.settings.MIN_VEHICLE_PINGS` and
+    :py:data:`cvts.settings.VEHICLE_BBOX`).
+
+    If *n_shards* is greater than one, only the vehicles in shard *shard* are
+    listed (see :py:class:`MatchToNetwork`)."""
+
+    dates            = luigi.Parameter(default = None)
+    shard            = luigi.IntParameter(default = 0)
+    n_shards         = luigi.IntParameter(default = 1)
+
+    @property
+    def pickle_file_name(self):
+        """:meta private:"""
+        return _shard_file_name(
+            _dates_file_name(os.path.join(OUT_PATH, 'raw_files.pkl'), self.dates),
+            self.shard,
+            self.n_shards)
 
     def run(self):
         """:meta private:"""
         input_files = vehicle_ids()
+        if self.n_shards > 1:
+            input_files = {k: v for k, v in input_files.items() \
+                if _in_shard(k, self.shard, self.n_shards)}
+
+        n_vehicles = len(input_files)
+        if RAW_DATA_FORMAT == RawDataFormat.GZIP:
+            days = vehicle_days(self.dates, MIN_VEHICLE_PINGS, VEHICLE_BBOX)
+            input_files = {k: days[k] for k in input_files if k in days}
+        elif self.dates is not None:
+            input_files = {k: v for k, v in input_files.items() \
+                if len(_files_for_dates(v, self.dates)) > 0}
+        logger.info('{} of {} vehicles have data to process'.format(
+            len(input_files), n_vehicles))
 
         with open(self.output().fn, 'wb') as pf:
             pickle.dump(input_files, pf)
@@ -395,14 +894,28 @@ class ListRawFiles(luigi.Task):
 
 
 class MatchToNetwork(luigi.Task):
-    """Match trips to the network."""
+    """Match trips to the network.
+
+    The fleet can be split over several hosts (sharing the same database,
+    matcher and output directories) by running shard *shard* of *n_shards* on
+    each. Each shard lists the seq files for its vehicles in its own manifest
+    and :py:class:`MergeShards` combines them."""
 
-    pickle_file_name = os.path.join(OUT_PATH, 'seq_files.pkl')
     dates            = luigi.Parameter(default = None)
+    shard            = luigi.IntParameter(default = 0)
+    n_shards         = luigi.IntParameter(default = 1)
+
+    @property
+    def pickle_file_name(self):
+        """:meta private:"""
+        return _shard_file_name(
+            os.path.join(OUT_PATH, 'seq_files.pkl'),
+            self.shard,
+            self.n_shards)
 
     def requires(self):
         """:meta private:"""
-        return ListRawFiles()
+        return ListRawFiles(self.dates, self.shard, self.n_shards)
 
     def run(self):
         """:meta private:"""
@@ -418,21 +931,209 @@ class MatchToNetwork(luigi.Task):
                 enumerate(input_files.items()) if i < DEBUG_DOC_LIMIT)
 
             work = map(lproc, input_files_subset)
-            # wrap in list so we wait for jobby to finish.
-            list(tqdm(work, total=DEBUG_DOC_LIMIT, smoothing=1))
+            self._record_metrics(tqdm(work, total=DEBUG_DOC_LIMIT, smoothing=1))
+            _flush_db()
         else:
-            input_files_gen = ((self.dates, v) for v in input_files.items())
-
-            with Pool(initializer = _init_db_connections) as workers:
-                work = workers.imap_unordered(lproc, input_files_gen)
-                # wrap in list so we wait for jobby to finish.
-                list(tqdm(work, total=len(input_files), smoothing=1))
+            # dispatch the most expensive vehicles first, one at a time.
+            try:
+                costs = estimate_costs(input_files, self.dates)
+            except Exception:
+                logger.exception('failed to estimate costs of vehicles')
+                costs = {k: 0. for k in input_files}
+            for k in costs:
+                if os.path.exists(os.path.join(SEQ_PATH, '{}.json'.format(k))):
+                    costs[k] = 0.
+            order = largest_first(costs)
+            input_files_gen = ((self.dates, (k, input_files[k])) for k in order)
+            started = None
+            if PREFETCH_VEHICLES > 0:
+                # load the raw data for the next vehicles while the current
+                # ones are matched. The pool takes the traces as soon as they
+                # are loaded and holds them until they are sent to a worker,
+                # so they count against the budget until a worker starts on
+                # them.
+                started = SimpleQueue()
+                input_files_gen = (arg + (loaded,) for arg, loaded in prefetch(
+                    input_files_gen,
+                    _load,
+                    PREFETCH_VEHICLES,
+                    PREFETCH_MAX_BYTES,
+                    _loaded_nbytes,
+                    started))
+
+            n_workers = os.cpu_count()
+            with Timer() as timer, Pool(
+                    n_workers,
+                    initializer = _init_worker,
+                    initargs = (started,)) as workers:
+                work = workers.imap_unordered(lproc, input_files_gen, chunksize=1)
+                durations = self._record_metrics(
+                    tqdm(work, total=len(input_files), smoothing=1))
+                # let the workers exit cleanly so they flush buffered rows.
+                workers.close()
+                workers.join()
+
+            report_makespan(order, costs, durations, n_workers, timer.elapsed)
 
         # list the (seq) output files
-        seq_output_files = glob(os.path.join(SEQ_PATH, '*'))
+        if self.n_shards > 1:
+            # other shards may be writing to the same directory.
+            seq_output_files = [f for f in (os.path.join(
+                SEQ_PATH, '{}.json'.format(k)) for k in input_files) \
+                if os.path.exists(f)]
+        else:
+            seq_output_files = glob(os.path.join(SEQ_PATH, '*.json'))
         with open(self.output().fn, 'wb') as pf:
             pickle.dump(seq_output_files, pf)
 
     def output(self):
         """:meta private:"""
         return luigi.LocalTarget(self.pickle_file_name)
+
+    @property
+    def metrics_file_name(self):
+        """The file the metrics for each vehicle are written to."""
+        return _shard_file_name(
+            _dates_file_name(os.path.join(METRICS_PATH, 'match.jsonl'), self.dates),
+            self.shard,
+            self.n_shards)
+
+    def _record_metrics(self, work):
+        # write the metrics for each vehicle as it finishes and return the
+        # time taken for each. Those of an earlier (e.g., failed) run are
+        # replaced, so the summary only covers one run.
+        durations = {}
+        with open(self.metrics_file_name, 'w') as mf:
+            for key, record in work:
+                mf.write(json.dumps(record) + '\n')
+                mf.flush()
+                durations[key] = record['total']
+        return durations
+
+
+
+class LocateBases(luigi.Task):
+    """Locate the base of every vehicle with data on *dates* and write them to
+    the database, replacing any bases the vehicles already have.
+
+    The bases of all vehicles are located at once (see
+    :py:func:`cvts._base_locator.locate_bases`), which is much faster than
+    doing it one vehicle at a time. :py:class:`MatchToNetwork` does not locate
+    (or write) bases for vehicles which already have one, so this can be run
+    before it.
+    """
+
+    dates            = luigi.Parameter(default = None)
+
+    def requires(self):
+        """:meta private:"""
+        return ListRawFiles(self.dates)
+
+    def run(self):
+        """:meta private:"""
+        with open(self.input().fn, 'rb') as input_files_file:
+            input_files = pickle.load(input_files_file)
+
+        with Pool(os.cpu_count()) as workers:
+            points = list(tqdm(
+                workers.imap_unordered(
+                    _stationary_points,
+                    ((self.dates, item) for item in input_files.items())),
+                total = len(input_files)))
+
+        keys = [p[0] for p in points]
+        lons = np.concatenate([np.empty(0)] + [p[1] for p in points])
+        ids, base_lons, base_lats = locate_bases(
+            np.repeat(np.arange(len(points)), [len(p[1]) for p in points]),
+            lons,
+            np.concatenate([np.empty(0)] + [p[2] for p in points]),
+            np.zeros(len(lons)))
+
+        bases = {keys[i]: (lon, lat) for i, lon, lat in zip(
+            ids.tolist(), base_lons.tolist(), base_lats.tolist()) if not np.isnan(lon)}
+        logger.info('located bases for {} of {} vehicles'.format(
+            len(bases), len(input_files)))
+        _write_bases(bases)
+
+        with open(self.output().fn, 'wb') as pf:
+            pickle.dump(bases, pf)
+
+    def output(self):
+        """:meta private:"""
+        return luigi.LocalTarget(
+            _dates_file_name(os.path.join(OUT_PATH, 'bases.pkl'), self.dates))
+
+
+
+class MergeShards(luigi.Task):
+    """Combine the manifests of the shards of :py:class:`MatchToNetwork` into
+    the manifest it writes when run unsharded, so tasks that depend on it can
+    be run once all shards are finished."""
+
+    dates            = luigi.Parameter(default = None)
+    n_shards         = luigi.IntParameter()
+
+    def requires(self):
+        """:meta private:"""
+        return [MatchToNetwork(
+            dates = self.dates, shard = shard, n_shards = self.n_shards) \
+            for shard in range(self.n_shards)]
+
+    def run(self):
+        """:meta private:"""
+        seq_output_files = []
+        for target in self.input():
+            with open(target.fn, 'rb') as pf:
+                seq_output_files.extend(pickle.load(pf))
+
+        with open(self.output().fn, 'wb') as pf:
+            pickle.dump(seq_output_files, pf)
+
+    def output(self):
+        """:meta private:"""
+        return MatchToNetwork().output()
+
+
+
+class SummariseMatchMetrics(luigi.Task):
+    """Summarise the metrics recorded for each vehicle by
+    :py:class:`MatchToNetwork` for *dates* (in shard *shard* of *n_shards*, or
+    all of them if *shard* is not given), giving percentiles of the time spent
+    in each stage and the points processed per second by each worker (see
+    :py:func:`cvts._timer.summarise`)."""
+
+    dates            = luigi.Parameter(default = None)
+    shard            = luigi.OptionalIntParameter(default = None)
+    n_shards         = luigi.IntParameter(default = 1)
+
+    def requires(self):
+        """:meta private:"""
+        shards = range(self.n_shards) if self.shard is None else [self.shard]
+        return [MatchToNetwork(
+            dates = self.dates, shard = shard, n_shards = self.n_shards) \
+            for shard in shards]
+
+    def run(self):
+        """:meta private:"""
+        def records():
+            for task in self.requires():
+                with open(task.metrics_file_name) as mf:
+                    for line in mf:
+                        if line.strip():
+                            yield json.loads(line)
+
+        summary = summarise(records())
+        for name, ps in summary['stages'].items():
+            logger.info('{}: p50 {p50:.3f}s, p95 {p95:.3f}s, p99 {p99:.3f}s'.format(
+                name, **ps))
+
+        with open(self.output().fn, 'w') as sf:
+            json.dump(summary, sf, indent=2)
+
+    def output(self):
+        """:meta private:"""
+        return luigi.LocalTarget(_shard_file_name(
+            _dates_file_name(
+                os.path.join(METRICS_PATH, 'match_summary.json'), self.dates),
+            'all' if self.shard is None else self.shard,
+            self.n_shards))
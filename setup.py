@@ -27,6 +27,8 @@ setup(
         'sqlalchemy',
         'tqdm'],
     extras_require={
+        "valhalla": [
+            "pyvalhalla"],
         "dev": [
             "ipython",
             "pyinstrument",
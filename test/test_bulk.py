@@ -0,0 +1,151 @@
+"""Tests of :py:class:`cvts._bulk.BulkLoader`.
+
+These need a PostgreSQL database, given by the environment variable
+*CVTS_TEST_POSTGRES_CONNECTION_STRING*, in which they create (and drop)
+schemas.
+"""
+
+import os
+import uuid
+from contextlib import contextmanager
+from multiprocessing import Pool
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+from cvts.models import DBase, Vehicle, Base, Stop, Trip, Traversal
+from cvts._bulk import BulkLoader, BULK_MODELS
+from cvts.tasks import _valhalla
+
+CONNECTION_STRING = os.environ.get('CVTS_TEST_POSTGRES_CONNECTION_STRING')
+
+pytestmark = pytest.mark.skipif(CONNECTION_STRING is None,
+    reason='CVTS_TEST_POSTGRES_CONNECTION_STRING not set')
+
+def _engine(schema):
+    return create_engine(CONNECTION_STRING,
+        connect_args={'options': '-csearch_path={}'.format(schema)})
+
+@contextmanager
+def _schema():
+    """Make a schema containing the tables and an engine that uses it."""
+    name = 'cvts_test_' + uuid.uuid4().hex[:8]
+    admin = create_engine(CONNECTION_STRING)
+    with admin.begin() as conn:
+        conn.execute(text('CREATE SCHEMA {}'.format(name)))
+    engine = _engine(name)
+    DBase.metadata.create_all(engine)
+    try:
+        yield name, engine
+    finally:
+        engine.dispose()
+        with admin.begin() as conn:
+            conn.execute(text('DROP SCHEMA {} CASCADE'.format(name)))
+        admin.dispose()
+
+@pytest.fixture
+def schema():
+    with _schema() as s:
+        yield s
+
+@pytest.fixture
+def other_schema():
+    with _schema() as s:
+        yield s
+
+def _vehicle(i, n_stops=4):
+    """Objects for a vehicle, linked through relationships as they are in
+    :py:func:`cvts.tasks._valhalla._process_trips`."""
+    vehicle = Vehicle(rego='rego{}'.format(i), etl_id=i)
+    base = Base(vehicle=vehicle, lon=105. + i, lat=10.)
+    stops = [Stop(
+        vehicle=vehicle,
+        n_stationary=j,
+        start_time=1000 * j,
+        end_time=1000 * j + 500,
+        start_end_dist=.5 * j,
+        start_lat=10. + j, start_lon=105.,
+        end_lat=10., end_lon=105. + j) for j in range(n_stops)]
+    trips = [Trip(vehicle=vehicle, start=s, end=e) \
+        for s, e in zip(stops[:-1], stops[1:])]
+    travs = [Traversal(
+        vehicle=vehicle,
+        trip=trip,
+        edge=2**63 - 1 - k,
+        timestamp=1000 * j + k,
+        hour=k, dow=j, doy=j + k, woy=1,
+        speed=None if k == 1 else 30. + k,
+        count=1.) for j, trip in enumerate(trips) for k in range(3)]
+    return vehicle, base, stops, trips, travs
+
+def _rows(engine):
+    with engine.connect() as conn:
+        return {m.__tablename__: conn.execute(text(
+            'SELECT * FROM {} ORDER BY id'.format(m.__tablename__))).all() \
+            for m in (Vehicle,) + BULK_MODELS}
+
+def test_matches_orm(schema, other_schema, monkeypatch):
+    (_, orm_engine), (_, bulk_engine) = schema, other_schema
+
+    # there is no engine when CVTS_POSTGRES_CONNECTION_STRING is not set.
+    monkeypatch.setattr(_valhalla, '_engine', orm_engine, raising=False)
+    monkeypatch.setattr(_valhalla, 'DB_WRITE_METHOD', _valhalla.DbWriteMethod.ORM)
+    for i in range(5):
+        _valhalla.write_to_db(*_vehicle(i, n_stops=i + 2))
+
+    # small blocks and batches so that ids are reserved (and rows written)
+    # several times.
+    committed = []
+    loader = BulkLoader(bulk_engine, batch_rows=40, id_block=3)
+    for i in range(5):
+        loader.add(*_vehicle(i, n_stops=i + 2), on_commit=lambda i=i: committed.append(i))
+    assert 0 < len(committed) < 5
+    loader.flush()
+    assert committed == list(range(5))
+
+    orm_rows, bulk_rows = _rows(orm_engine), _rows(bulk_engine)
+    assert len(orm_rows['traversals']) == 3 * sum(range(1, 6))
+    assert bulk_rows == orm_rows
+
+def test_ids_reserved(schema):
+    _, engine = schema
+    with Session(engine) as session, session.begin():
+        session.add(Stop(n_stationary=0))
+
+    loader = BulkLoader(engine, id_block=10)
+    vehicle, base, stops, trips, travs = _vehicle(0, n_stops=3)
+    loader.add(vehicle, base, stops, trips, travs)
+    assert [s.id for s in stops] == [2, 3, 4]
+    assert [t.id for t in trips] == [1, 2]
+
+    # ids already handed out by the sequence are not reused.
+    with Session(engine) as session, session.begin():
+        stop = Stop(n_stationary=0)
+        session.add(stop)
+        session.flush()
+        assert stop.id == 12
+    loader.flush()
+
+    rows = _rows(engine)
+    assert [(t.start_id, t.end_id) for t in rows['trips']] == [(2, 3), (3, 4)]
+    assert [t.trip_id for t in rows['traversals']] == [1, 1, 1, 2, 2, 2]
+
+def _add_in_worker(schema):
+    # as in a pool worker running _process_files.
+    _valhalla._engine = _engine(schema)
+    _valhalla._bulk_loader = None
+    _valhalla.DB_WRITE_METHOD = _valhalla.DbWriteMethod.COPY
+    _valhalla.write_to_db(*_vehicle(0))
+    return _valhalla._bulk_loader._n_rows
+
+def test_flush_at_exit(schema):
+    name, engine = schema
+    pool = Pool(1)
+    n_rows = pool.apply(_add_in_worker, (name,))
+    assert n_rows > 0
+    assert _rows(engine)['traversals'] == []
+    pool.close()
+    pool.join()
+
+    rows = _rows(engine)
+    assert len(rows['vehicles']) == 1
+    assert sum(len(rows[m.__tablename__]) for m in BULK_MODELS) == n_rows
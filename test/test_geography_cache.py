@@ -0,0 +1,47 @@
+import shapefile
+from cvts._geography_cache import GeographyCache
+from cvts._shapes import _read_shapefile
+from cvts._synthetic import write_region_grid
+
+
+
+def _reader(calls):
+    def read(filename, field):
+        calls.append((filename, field))
+        return _read_shapefile(filename, field)
+    return read
+
+def test_geography_cache(tmp_path):
+    # glob patterns in the path are matched literally.
+    boundaries = tmp_path / 'bound[a-z]ries'
+    write_region_grid(str(boundaries), 'grid', 1.)
+    shp = str(boundaries / 'grid.shp')
+    cache = GeographyCache(str(tmp_path / 'cache'))
+    calls = []
+
+    keys, polys, boxes = cache.get(shp, 'id', _reader(calls))
+    cached = cache.get(shp, 'id', _reader(calls))
+    assert len(calls) == 1
+    assert (cached[0] == keys).all()
+    assert cached[2].dtype == boxes.dtype and (cached[2] == boxes).all()
+    assert all(a.equals_exact(b, 0) for a, b in zip(cached[1], polys))
+
+    # other files with the same name are not part of the shapefile.
+    (boundaries / 'grid.qix').write_bytes(b'index')
+    (boundaries / 'grid.shp.xml').write_text('<metadata/>')
+    cache.get(shp, 'id', _reader(calls))
+    assert len(calls) == 1
+
+    # a different version is read again.
+    GeographyCache(str(tmp_path / 'cache'), '2').get(shp, 'id', _reader(calls))
+    assert len(calls) == 2
+
+    # a different field or changed shapefile is read again.
+    with shapefile.Writer(str(boundaries / 'grid')) as w:
+        w.field('id', 'N')
+        w.field('other', 'N')
+        w.poly([[[105., 10.], [105., 11.], [106., 11.], [105., 10.]]])
+        w.record(1, 2)
+    cache.get(shp, 'id', _reader(calls))
+    cache.get(shp, 'other', _reader(calls))
+    assert len(calls) == 4
@@ -0,0 +1,126 @@
+from pytest import approx
+import numpy as np
+from cvts._grid import Grid, SparseGrid
+
+EXTENT = dict(minlat=10., minlon=105., maxlat=10.5, maxlon=105.7, cellsize=.05)
+
+def _grids(seed=0):
+    rng = np.random.default_rng(seed)
+    # include points on and outside of the edges.
+    lons = rng.uniform(104.95, 105.75, 2000)
+    lats = rng.uniform(9.95, 10.55, 2000)
+    dense, sparse = Grid(**EXTENT), SparseGrid(**EXTENT)
+    dense.increment_many(lons[:1000], lats[:1000])
+    sparse.increment_many(lons[:1000], lats[:1000])
+    for lon, lat in zip(lons[1000:].tolist(), lats[1000:].tolist()):
+        assert dense.increment(lon, lat) == sparse.increment(lon, lat)
+    return dense, sparse
+
+def test_sparse_grid_counts():
+    dense, sparse = _grids()
+    assert (sparse.cells == dense.cells).all()
+    rows, cols, counts = sparse.nonzero()
+    assert (counts > 0).all()
+    assert counts.sum() == dense.cells.sum()
+
+def test_sparse_grid_convolve():
+    dense, sparse = _grids(1)
+    for kernel in (
+            [[.5, 1., .5], [1., 2., 1.], [.5, 1., .5]],
+            [[1, 2], [3, 4]],
+            [[.3, .7, 1.1, .2, .9]]):
+        assert (sparse.convolve(kernel).cells == dense.convolve(np.array(kernel))).all()
+
+def test_sparse_grid_convolve_small():
+    # grids no longer than the kernel's reach, which reflect more than once.
+    rng = np.random.default_rng(5)
+    for nrow, ncol in ((1, 1), (1, 12), (2, 7), (9, 1), (3, 4)):
+        dense = Grid(0., 0., nrow, ncol, 1.)
+        dense.increment_points(rng.uniform(0, ncol, 30), rng.uniform(0, nrow, 30))
+        sparse = SparseGrid(0., 0., nrow, ncol, 1.).merge(dense)
+        for kernel in (
+                [[.5, 1., .5], [1., 2., 1.], [.5, 1., .5]],
+                [[1, 2], [3, 4]],
+                rng.uniform(0., 1., (7, 7)),
+                rng.uniform(0., 1., (1, 6))):
+            assert (sparse.convolve(kernel).cells == dense.convolve(np.array(kernel))).all()
+
+def test_sparse_grid_save(tmp_path):
+    dense, sparse = _grids(2)
+    dense.save(str(tmp_path / 'dense.asc'))
+    sparse.save(str(tmp_path / 'sparse.asc'))
+    assert (tmp_path / 'dense.asc').read_text() == (tmp_path / 'sparse.asc').read_text()
+
+def test_increment_points():
+    rng = np.random.default_rng(3)
+    lons = np.concatenate((rng.uniform(104.95, 105.75, 1000), [105., 105.7, 105.3]))
+    lats = np.concatenate((rng.uniform(9.95, 10.55, 1000), [10.2, 10.2, 10.]))
+    for cls in (Grid, SparseGrid):
+        expected = Grid(**EXTENT)
+        for lon, lat in zip(lons.tolist(), lats.tolist()):
+            expected.increment(lon, lat)
+        grid = cls(**EXTENT)
+        grid.increment_points(lons, lats)
+        assert (grid.cells == expected.cells).all()
+
+def test_merge():
+    rng = np.random.default_rng(4)
+    lons, lats = rng.uniform(105., 105.7, 1000), rng.uniform(10., 10.5, 1000)
+    whole = Grid(**EXTENT)
+    whole.increment_points(lons, lats)
+    for cls in (Grid, SparseGrid):
+        parts = [Grid(**EXTENT), SparseGrid(**EXTENT), cls(**EXTENT)]
+        for part, ls in zip(parts, np.array_split(np.arange(1000), 3)):
+            part.increment_points(lons[ls], lats[ls])
+        merged = parts[2]
+        merged += parts[0]
+        merged += parts[1]
+        assert (merged.cells == whole.cells).all()
+
+def test_save_binary(tmp_path):
+    from cvts._grid import load_grid
+    dense, sparse = _grids(5)
+    for grid, name in ((dense, 'dense.bil'), (sparse, 'sparse.bil')):
+        grid.save_binary(str(tmp_path / name))
+        loaded = load_grid(str(tmp_path / name))
+        assert isinstance(loaded.cells, np.memmap)
+        assert (loaded.cells == dense.cells).all()
+        assert (loaded.nrow, loaded.ncol) == (dense.nrow, dense.ncol)
+        assert loaded.minlon == approx(dense.minlon)
+        assert loaded.minlat == approx(dense.minlat)
+        assert loaded.cellsize == dense.cellsize
+
+def test_hour_of_week_cube(tmp_path):
+    from datetime import datetime, timezone
+    from cvts._grid import HourOfWeekCube, load_cube
+    rng = np.random.default_rng(6)
+    lons, lats = rng.uniform(104.95, 105.75, 2000), rng.uniform(9.95, 10.55, 2000)
+    times = rng.uniform(1.5e9, 1.6e9, 2000)
+    cube = HourOfWeekCube(Grid(**EXTENT), 7 * 3600)
+
+    # 2020-04-06 was a Monday.
+    monday = datetime(2020, 4, 6, tzinfo=timezone.utc).timestamp() - 7 * 3600
+    assert cube.hours([monday, monday + 3599, monday + 3600, monday - 1]).tolist() \
+        == [0, 0, 1, 167]
+
+    for part in np.array_split(np.arange(2000), 2):
+        other = HourOfWeekCube(SparseGrid(**EXTENT), 7 * 3600)
+        other.increment_points(lons[part], lats[part], times[part])
+        cube += other
+
+    hours = cube.hours(times)
+    for hs in (3, slice(8, 12), [0, 167]):
+        selected = np.zeros(168, bool)
+        selected[hs] = True
+        expected = Grid(**EXTENT)
+        expected.increment_points(lons[selected[hours]], lats[selected[hours]])
+        assert (cube[hs].cells == expected.cells).all()
+
+    everything = Grid(**EXTENT)
+    everything.increment_points(lons, lats)
+    assert cube.totals().sum() == everything.cells.sum()
+
+    cube.save(str(tmp_path / 'cube.npz'))
+    loaded = load_cube(str(tmp_path / 'cube.npz'))
+    assert (loaded[:].cells == everything.cells).all()
+    assert loaded.totals().tolist() == cube.totals().tolist()
@@ -0,0 +1,114 @@
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pytest import raises
+from cvts._http_matcher import HttpMatcher
+from cvts._matcher import MatcherError
+
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        with server.lock:
+            server.clients.add(self.client_address)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+
+        trip = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(.01)
+        if trip.get('respond_without_length'):
+            with server.lock:
+                server.in_flight -= 1
+            self._respond_without_length(trip['respond_without_length'])
+            return
+        if len(trip['shape']):
+            status, body = 200, {'n_points': len(trip['shape'])}
+        else:
+            status, body = 400, {'error': 'no shape'}
+
+        with server.lock:
+            server.in_flight -= 1
+
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _respond_without_length(self, status):
+        self.send_response(status)
+        if status != 204:
+            # the body is ended by closing the connection.
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        if status != 204:
+            self.wfile.write(b'<html>server error</html>')
+
+    def log_message(self, *args):
+        pass
+
+def _stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+    server.lock = threading.Lock()
+    server.clients = set()
+    server.in_flight = 0
+    server.max_in_flight = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}/trace_attributes'.format(
+        server.server_address[1])
+
+def test_http_matcher_order_and_bounds():
+    server, url = _stub_server()
+    matcher = HttpMatcher([url], max_in_flight=4)
+    try:
+        trips = [(i, {'shape': [{}] * (i + 1)}) for i in range(40)]
+        results = list(matcher.imap(trips, key=lambda t: t[1]))
+        assert [r[0][0] for r in results] == list(range(40))
+        assert [r[1]['n_points'] for r in results] == list(range(1, 41))
+        assert server.max_in_flight <= 4
+        # connections are kept alive and reused
+        assert len(server.clients) <= 4
+    finally:
+        matcher.close()
+        server.shutdown()
+
+def test_http_matcher_error():
+    server, url = _stub_server()
+    matcher = HttpMatcher([url], max_in_flight=2)
+    try:
+        (_, result), = matcher.imap([{'shape': []}])
+        assert isinstance(result, MatcherError)
+        with raises(MatcherError):
+            matcher._loop.run_until_complete(matcher.match({'shape': []}))
+    finally:
+        matcher.close()
+        server.shutdown()
+
+def test_http_matcher_no_content_length():
+    server, url = _stub_server()
+    matcher = HttpMatcher([url], max_in_flight=1, timeout=5.)
+    run = matcher._loop.run_until_complete
+    try:
+        t0 = time.time()
+        # a response without a body is not waited on...
+        with raises(MatcherError, match='HTTP 204'):
+            run(matcher.match({'shape': [{}], 'respond_without_length': 204}))
+        assert time.time() - t0 < 2.
+        # ... and its connection is kept alive.
+        assert run(matcher.match({'shape': [{}]})) == {'n_points': 1}
+        assert len(server.clients) == 1
+
+        # others are read until the server closes the connection.
+        with raises(MatcherError, match='HTTP 500: .*server error'):
+            run(matcher.match({'shape': [{}], 'respond_without_length': 500}))
+        assert run(matcher.match({'shape': [{}]})) == {'n_points': 1}
+        assert len(server.clients) == 2
+    finally:
+        matcher.close()
+        server.shutdown()
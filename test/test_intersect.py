@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from shapely.geometry import Polygon, MultiPolygon, box
+from cvts import _intersect
+from cvts._shapes import _shapedata
+
+def _geography():
+    shapes = {}
+    for i in range(10):
+        for j in range(6):
+            shapes[i * 10 + j] = box(105. + .1 * i, 10. + .1 * j, 105.1 + .1 * i, 10.1 + .1 * j)
+    # overlapping the squares, with a hole.
+    shapes[1000] = Polygon(
+        [(105.05, 10.05), (105.55, 10.12), (105.3, 10.45)],
+        [[(105.25, 10.15), (105.35, 10.15), (105.3, 10.25)]])
+    shapes[1001] = MultiPolygon([
+        box(105.62, 10.32, 105.78, 10.41),
+        Polygon([(105.81, 10.01), (105.99, 10.03), (105.9, 10.19)])])
+    return _shapedata(shapes)
+
+@pytest.mark.parametrize('shapely_2', [False, True])
+def test_strtree_backend(monkeypatch, shapely_2):
+    # the branch of _intercept_chunk for shapely 1 can also be run with
+    # shapely 2 (which still has shapely.vectorized), but not vice versa.
+    if shapely_2 and not _intersect._SHAPELY_2:
+        pytest.skip('shapely 2 is not installed')
+    if not shapely_2 and _intersect._SHAPELY_2:
+        from shapely import vectorized
+        monkeypatch.setattr(_intersect, 'vectorized', vectorized, raising=False)
+    monkeypatch.setattr(_intersect, '_SHAPELY_2', shapely_2)
+
+    rng = np.random.default_rng(0)
+    points = np.column_stack((
+        rng.uniform(104.95, 106.05, 20000),
+        rng.uniform(9.95, 10.65, 20000)))
+    shapedata = _geography()
+
+    expected = _intersect._points_to_shapes(points, shapedata)
+    monkeypatch.setattr(_intersect, 'STRTREE_CHUNK_SIZE', 3000)
+    got = _intersect._points_to_shapes_strtree(points, shapedata)
+
+    assert (got == expected).all()
+    assert (got >= 0).mean() > .7
+    # points in overlaps get the last polygon.
+    assert (shapedata[0][got] >= 1000).sum() > 0
@@ -1,5 +1,6 @@
 from pytest import approx
-from cvts._base_locator import locate_base
+import numpy as np
+from cvts._base_locator import locate_base, EmptyCellsException
 from cvts import rawfiles2jsonchunks
 
 def test_locate_base():
@@ -19,3 +20,31 @@ def test_locate_base_2():
     print(res)
     assert res[0] == approx(108.18927950)
     assert res[1] == approx( 11.08898850)
+
+def test_locate_bases():
+    from cvts._base_locator import locate_bases
+    rng = np.random.default_rng(0)
+    ids, lons, lats = [], [], []
+    for vid in range(50):
+        n = rng.integers(20, 200)
+        # points on a lattice give plenty of ties between cells.
+        centre = rng.uniform((102., 8.), (109., 23.))
+        pts = centre + rng.integers(-5, 6, (n, 2)) * .001
+        ids.append(np.full(n, vid))
+        lons.append(pts[:, 0])
+        lats.append(pts[:, 1])
+    ids, lons, lats = (np.concatenate(x) for x in (ids, lons, lats))
+    speeds = rng.choice([0., 10.], len(ids), p=[.8, .2])
+    speeds[ids == 7] = 10. # never stationary
+
+    got_ids, got_lons, got_lats = locate_bases(ids, lons, lats, speeds)
+    assert got_ids.tolist() == list(range(50))
+    for vid in range(50):
+        w = ids == vid
+        try:
+            lon, lat = locate_base(lons[w], lats[w], speeds[w])
+        except EmptyCellsException:
+            assert np.isnan(got_lons[vid]) and np.isnan(got_lats[vid])
+        else:
+            assert got_lons[vid] == lon
+            assert got_lats[vid] == lat
@@ -0,0 +1,95 @@
+import os
+import gzip
+from cvts._match_cache import MatchCache
+
+def _trip(i):
+    return {'shape': [{'lon': 105. + i, 'lat': 10.}], 'costing': 'auto'}
+
+def _result(i):
+    return {'edges': [{'id': i}], 'pad': 'x' * 200}
+
+def test_hits_and_misses(tmp_path):
+    cache = MatchCache(str(tmp_path), 1e9)
+    key = cache.key(_trip(0))
+    assert cache.get(key) is None
+    cache.put(key, _result(0))
+    assert cache.get(key) == _result(0)
+
+    # the options and version are part of the key.
+    assert cache.key(dict(_trip(0), costing='truck')) != key
+    assert MatchCache(str(tmp_path), 1e9, 'v2').key(_trip(0)) != key
+    assert cache.get(cache.key(_trip(1))) is None
+
+def test_lru_eviction(tmp_path):
+    cache = MatchCache(str(tmp_path), 1e9)
+    keys = [cache.key(_trip(i)) for i in range(10)]
+    for i, key in enumerate(keys):
+        cache.put(key, _result(i))
+        os.utime(cache._file_name(key), (1000 + i, 1000 + i))
+
+    # reading an entry makes it the most recently used.
+    assert cache.get(keys[0]) == _result(0)
+
+    entries, size = cache._scan()
+    sizes = {fn: n for _, n, fn in entries}
+    cache.max_bytes = size - 1
+    cache._evict()
+
+    # the oldest entries are removed, down to 90% of the capacity.
+    kept = [k for k in keys if os.path.exists(cache._file_name(k))]
+    assert keys[0] in kept
+    removed = [k for k in keys if k not in kept]
+    assert removed == keys[1:1 + len(removed)]
+    assert 0 < sum(sizes[cache._file_name(k)] for k in kept) <= .9 * cache.max_bytes
+    assert cache._size <= .9 * cache.max_bytes
+
+def _count_scans(cache):
+    scans = [0]
+    scan = cache._scan
+    def counting_scan():
+        scans[0] += 1
+        return scan()
+    cache._scan = counting_scan
+    return scans
+
+def test_eviction_on_put(tmp_path):
+    cache = MatchCache(str(tmp_path), 2000)
+    scans = _count_scans(cache)
+    for i in range(40):
+        cache.put(cache.key(_trip(i)), _result(i))
+    assert cache._scan()[1] <= 2000
+    # the cache is only scanned when it is (thought to be) full.
+    assert 1 < scans[0] < 40
+
+def test_scan_once(tmp_path):
+    cache = MatchCache(str(tmp_path), 1e9)
+    for i in range(10):
+        cache.put(cache.key(_trip(i)), _result(i))
+
+    # a new process only scans the cache when it first writes to it.
+    cache = MatchCache(str(tmp_path), 1e9)
+    scans = _count_scans(cache)
+    for i in range(10, 50):
+        cache.put(cache.key(_trip(i)), _result(i))
+    assert scans[0] == 1
+    assert cache._size == cache._scan()[1]
+
+def test_corrupt_entries(tmp_path):
+    cache = MatchCache(str(tmp_path), 1e9)
+    for i, corrupt in enumerate((
+            b'not gzip at all',
+            # truncated
+            gzip.compress(b'{"edges": [1, 2, 3]}' * 100)[:40],
+            # valid gzip, invalid JSON
+            gzip.compress(b'{"edges": '))):
+        key = cache.key(_trip(i))
+        fn = cache._file_name(key)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with open(fn, 'wb') as f:
+            f.write(corrupt)
+        assert cache.get(key) is None
+        assert not os.path.exists(fn)
+
+        # and can be replaced.
+        cache.put(key, _result(i))
+        assert cache.get(key) == _result(i)
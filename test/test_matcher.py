@@ -0,0 +1,80 @@
+import sys
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pytest import raises
+from cvts._matcher import Matcher, MatcherPool, MatcherError
+
+FAKE = [sys.executable, '-m', 'cvts._fake_matcher']
+
+def _trip(i):
+    return {'shape': [
+        {'lon': 105. + .01 * i, 'lat': 10.},
+        {'lon': 105. + .01 * i, 'lat': 10.01}]}
+
+def test_responses_in_order():
+    matcher = Matcher(FAKE)
+    try:
+        for i in range(20):
+            result = matcher.match(_trip(i))
+            assert result['matched_points'][0]['lon'] == 105. + .01 * i
+    finally:
+        matcher.close()
+
+def test_pool():
+    pool = MatcherPool(FAKE, 3)
+    def match(i):
+        with pool.borrow() as matcher:
+            return matcher.match(_trip(i))['matched_points'][0]['lon']
+    try:
+        with ThreadPoolExecutor(6) as executor:
+            lons = list(executor.map(match, range(30)))
+        assert lons == [105. + .01 * i for i in range(30)]
+    finally:
+        pool.close()
+
+def test_restart_after_exit():
+    matcher = Matcher(FAKE)
+    try:
+        matcher.match(_trip(0))
+        matcher._proc.kill()
+        matcher._proc.wait()
+        assert matcher.match(_trip(1))['matched_points'][0]['lon'] == 105.01
+    finally:
+        matcher.close()
+
+def test_exit_while_matching():
+    matcher = Matcher([sys.executable, '-c', 'import sys; sys.stdin.readline()'])
+    with raises(MatcherError, match='exited'):
+        matcher.match(_trip(0))
+    assert matcher._proc is None
+
+def test_error_response():
+    matcher = Matcher(FAKE)
+    try:
+        with raises(MatcherError, match='at least two points'):
+            matcher.match({'shape': [{'lon': 105., 'lat': 10.}]})
+        # and the process is still usable.
+        matcher.match(_trip(0))
+    finally:
+        matcher.close()
+
+def test_timeout():
+    matcher = Matcher([sys.executable, '-c', 'import time; time.sleep(60)'], timeout=.5)
+    t0 = time.monotonic()
+    with raises(MatcherError, match='did not respond'):
+        matcher.match(_trip(0))
+    assert time.monotonic() - t0 < 10
+    assert matcher._proc is None
+
+def test_stderr_logged(caplog):
+    matcher = Matcher([sys.executable, '-c',
+        'import sys; sys.stderr.write("tile missing\\n"); sys.stderr.flush(); sys.stdin.readline()'])
+    with caplog.at_level(logging.INFO, logger='cvts._matcher'):
+        with raises(MatcherError):
+            matcher.match(_trip(0))
+        for _ in range(50):
+            if 'tile missing' in caplog.text:
+                break
+            time.sleep(.1)
+    assert 'tile missing' in caplog.text
@@ -0,0 +1,69 @@
+import time
+import queue
+import threading
+import numpy as np
+from cvts._prefetch import prefetch
+
+
+
+def test_order_and_failures():
+    def load(i):
+        if i == 3:
+            raise ValueError(i)
+        time.sleep(.001 * (10 - i))
+        return np.full(i, i)
+
+    out = list(prefetch(range(10), load, 4, 1e9))
+    assert [i for i, _ in out] == list(range(10))
+    assert out[3][1] is None
+    assert all(len(r) == i for i, r in out if i != 3)
+
+def _concurrency(max_bytes):
+    lock = threading.Lock()
+    running, most = [0], [0]
+
+    def load(i):
+        with lock:
+            running[0] += 1
+            most[0] = max(most[0], running[0])
+        time.sleep(.01)
+        with lock:
+            running[0] -= 1
+        return np.zeros(100, dtype=np.uint8)
+
+    assert len(list(prefetch(range(10), load, 4, max_bytes))) == 10
+    return most[0]
+
+def test_budget():
+    assert _concurrency(1e9) > 1
+    # a load is only started while less than max_bytes are held.
+    assert _concurrency(0) == 1
+
+def test_no_budget_still_loads_one():
+    out = list(prefetch(range(3), lambda i: np.zeros(10), 2, 0))
+    assert len(out) == 3
+
+def _loads_after(n, released):
+    loaded = []
+    def load(i):
+        loaded.append(i)
+        time.sleep(.02)
+        return np.zeros(100, dtype=np.uint8)
+
+    gen = prefetch(range(10), load, 3, 50, released=released)
+    for _ in range(n):
+        next(gen)
+        time.sleep(.05)
+    n_loaded = len(loaded)
+    if released is not None:
+        for _ in range(n):
+            released.put(100)
+    assert len(list(gen)) == 10 - n
+    return n_loaded
+
+def test_released():
+    # the results taken hold the budget until they are released, so only
+    # the next item is loaded (as there would otherwise be none)...
+    assert _loads_after(3, queue.SimpleQueue()) == 4
+    # ... rather than as many as can be loaded ahead.
+    assert _loads_after(3, None) == 6
@@ -0,0 +1,115 @@
+import os
+import sys
+import logging
+from itertools import count
+from datetime import date
+import pytest
+from sqlalchemy import create_engine, text
+from cvts.models import DBase
+from cvts._journal import JournalError
+from cvts._matcher import MatcherPool
+from cvts._synthetic import write_csv_fleet
+from cvts import _utils
+from cvts.tasks import _valhalla
+
+FAKE = [sys.executable, '-m', 'cvts._fake_matcher']
+
+DATES = [date(2020, 4, 5), date(2020, 4, 6)]
+
+TABLES = ('vehicles', 'bases', 'stops', 'trips', 'traversals')
+
+@pytest.fixture(scope='module')
+def vehicle(tmp_path_factory):
+    """The rego and raw files of a synthetic vehicle."""
+    raw = tmp_path_factory.mktemp('raw')
+    write_csv_fleet(str(raw), 1, DATES, seed=5)
+    return 'SYN000001', sorted(str(f) for f in raw.glob('*/SYN000001.csv'))
+
+@pytest.fixture
+def run(tmp_path, monkeypatch):
+    """Function that processes a vehicle into a fresh database and seq
+    directory (named by *name*), returning the rows written and the seq
+    file. If *fail_every* is given, every *fail_every*th write to the
+    database fails. *bases* are written (as by LocateBases) first."""
+    matchers = MatcherPool(FAKE)
+    monkeypatch.setattr(_valhalla, 'MATCHER_BACKEND', _valhalla.MatcherBackend.SERVICE)
+    monkeypatch.setattr(_valhalla, '_matchers', matchers)
+    monkeypatch.setattr(_valhalla, '_match_cache', None)
+    monkeypatch.setattr(_valhalla, 'DB_WRITE_METHOD', _valhalla.DbWriteMethod.ORM)
+
+    def run(name, vehicle, stream, fail_every=None, bases=None):
+        seq_path = tmp_path / name
+        seq_path.mkdir()
+        engine = create_engine('sqlite:///{}'.format(tmp_path / (name + '.sqlite')))
+        DBase.metadata.create_all(engine)
+        # there is no engine when CVTS_POSTGRES_CONNECTION_STRING is not set.
+        monkeypatch.setattr(_valhalla, '_engine', engine, raising=False)
+        monkeypatch.setattr(_valhalla, 'SEQ_PATH', str(seq_path))
+        monkeypatch.setattr(_valhalla, 'STREAM_TRIPS', stream)
+        if bases is not None:
+            _valhalla._write_bases(bases)
+
+        if fail_every is not None:
+            # as if the database went away while writing every *fail_every*th
+            # batch. The vehicle is processed again until it is done.
+            calls = count(1)
+            write_to_db = _valhalla.write_to_db
+            def failing_write_to_db(*args, **kwargs):
+                if next(calls) % fail_every == 0:
+                    raise IOError('lost connection')
+                return write_to_db(*args, **kwargs)
+            monkeypatch.setattr(_valhalla, 'write_to_db', failing_write_to_db)
+
+        seq_file = seq_path / (vehicle[0] + '.json')
+        for _ in range(20):
+            _valhalla._process_files(DATES, vehicle)
+            if seq_file.exists():
+                break
+        assert not (seq_path / (vehicle[0] + '.journal')).exists()
+
+        with engine.connect() as conn:
+            rows = {t: conn.execute(text(
+                'SELECT * FROM {} ORDER BY id'.format(t))).all() for t in TABLES}
+        with open(seq_file) as sf:
+            return rows, sf.read()
+
+    yield run
+    matchers.close()
+
+def test_stream_matches_batch(vehicle, run):
+    rows, seq = run('batch', vehicle, False)
+    assert len(rows['trips']) > 2
+    assert len(rows['traversals']) > 0
+    assert run('stream', vehicle, True) == (rows, seq)
+
+def test_resume(vehicle, run, caplog):
+    rows, seq = run('batch', vehicle, False)
+    with caplog.at_level(logging.INFO):
+        assert run('resumed', vehicle, True, fail_every=3) == (rows, seq)
+    assert 'resuming {}'.format(vehicle[0]) in caplog.text
+
+def test_stored_base(vehicle, run, monkeypatch):
+    rows, _ = run('located', vehicle, False)
+    assert len(rows['bases']) == 1
+
+    # a vehicle with a base is not located again.
+    def locate_base(*args):
+        raise AssertionError('locate_base called')
+    monkeypatch.setattr(_utils, 'locate_base', locate_base)
+    rows, _ = run('stored', vehicle, False, bases={vehicle[0]: (105.5, 21.5)})
+    assert [(b.vehicle_id, b.lon, b.lat) for b in rows['bases']] == [(1, 105.5, 21.5)]
+    assert len(rows['vehicles']) == 1
+    assert len(rows['trips']) > 2
+
+def test_resume_mismatch(vehicle, run, monkeypatch):
+    # the seq file being resumed is shorter than recorded in the journal.
+    process_trips = _valhalla._process_trips
+    def truncating_process_trips(rego, trips, seq_file_name, *args):
+        if args[-1] is not None:
+            os.truncate(seq_file_name + '.part', 1)
+        return process_trips(rego, trips, seq_file_name, *args)
+    monkeypatch.setattr(_valhalla, '_process_trips', truncating_process_trips)
+
+    # the vehicle fails (rather than being skipped by every later run).
+    with pytest.raises(JournalError, match='cannot resume {}'.format(vehicle[0])):
+        run('mismatch', vehicle, True, fail_every=3)
@@ -0,0 +1,50 @@
+from datetime import date
+from pytest import approx
+from cvts import _scheduling
+from cvts._scheduling import estimate_costs, largest_first, makespan
+from cvts.settings import RawDataFormat
+
+def _write(path, n_bytes):
+    path.parent.mkdir(exist_ok=True)
+    path.write_bytes(b'x' * n_bytes)
+    return str(path)
+
+def test_estimate_costs_csv(tmp_path):
+    input_files = {
+        'a': [_write(tmp_path / '20200405' / 'a.csv', 100),
+              _write(tmp_path / '20200406' / 'a.csv', 50)],
+        'b': [_write(tmp_path / '20200406' / 'b.csv', 70)]}
+    assert estimate_costs(input_files) == {'a': 150., 'b': 70.}
+    assert estimate_costs(input_files, [date(2020, 4, 5)]) == {'a': 100., 'b': 0.}
+
+def test_estimate_costs_vehicle_days(monkeypatch):
+    # the pings per day listed by ListRawFiles.
+    monkeypatch.setattr(_scheduling, 'RAW_DATA_FORMAT', RawDataFormat.GZIP)
+    input_files = {
+        1: {date(2020, 4, 5): 10, date(2020, 4, 6): 5},
+        2: {date(2020, 4, 6): 7}}
+    assert estimate_costs(input_files) == {1: 15., 2: 7.}
+
+def test_largest_first():
+    assert largest_first({'a': 1., 'b': 3., 'c': 2.}) == ['b', 'c', 'a']
+    assert largest_first({}) == []
+
+def test_makespan():
+    assert makespan([], 4) == 0.
+    assert makespan([3., 1., 2.], 1) == approx(6.)
+    # more workers than jobs.
+    assert makespan([3., 1., 2.], 5) == approx(3.)
+    # the 2 and 1 go on the worker that finished the 1 first.
+    assert makespan([4., 1., 2., 1.], 2) == approx(4.)
+    assert makespan([1., 1., 1., 1., 4.], 2) == approx(6.)
+
+def test_largest_first_makespan():
+    # a skewed fleet, with a few vehicles much bigger than the rest, in the
+    # order they happen to be listed.
+    costs = {i: 1. for i in range(40)}
+    costs.update({40: 12., 41: 10., 42: 9.})
+    in_order = makespan([costs[k] for k in costs], 4)
+    ordered = makespan([costs[k] for k in largest_first(costs)], 4)
+    assert ordered < in_order
+    # which is optimal here (the total is 71 on 4 workers).
+    assert ordered == approx(18.)
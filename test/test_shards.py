@@ -0,0 +1,72 @@
+import os
+import sys
+import pickle
+from collections import Counter
+from datetime import date
+import pytest
+import luigi
+from sqlalchemy import create_engine
+from cvts.models import DBase
+from cvts._synthetic import write_csv_fleet
+from cvts.tasks import _valhalla, MatchToNetwork, MergeShards
+from cvts.tasks._valhalla import _in_shard
+
+FAKE = [sys.executable, '-m', 'cvts._fake_matcher']
+
+DATES = [date(2020, 4, 5), date(2020, 4, 6)]
+
+def test_in_shard():
+    keys = list(range(1000)) + ['SYN{:06d}'.format(i) for i in range(1000)]
+    for n_shards in (1, 2, 3, 7):
+        shards = [[k for k in keys if _in_shard(k, s, n_shards)] \
+            for s in range(n_shards)]
+        # each vehicle is in exactly one shard...
+        assert Counter(k for s in shards for k in s) == Counter(keys)
+        # ... and they are roughly the same size.
+        assert min(len(s) for s in shards) > .8 * len(keys) / n_shards
+
+@pytest.fixture(scope='module')
+def fleet(tmp_path_factory):
+    raw = tmp_path_factory.mktemp('raw')
+    write_csv_fleet(str(raw), 8, DATES, seed=7)
+    input_files = {}
+    for f in sorted(raw.glob('*/*.csv')):
+        input_files.setdefault(f.stem, []).append(str(f))
+    return input_files
+
+def _run(task, work, fleet, monkeypatch):
+    """Run *task* in the work directory *work*, returning the seq files
+    listed in the manifest of MatchToNetwork and their contents."""
+    for name in ('output', 'seq', 'metrics'):
+        (work / name).mkdir(parents=True)
+    engine = create_engine('sqlite:///{}?timeout=60'.format(work / 'cvts.sqlite'))
+    DBase.metadata.create_all(engine)
+    monkeypatch.setattr(_valhalla, '_engine', engine, raising=False)
+    monkeypatch.setattr(_valhalla, 'OUT_PATH', str(work / 'output'))
+    monkeypatch.setattr(_valhalla, 'SEQ_PATH', str(work / 'seq'))
+    monkeypatch.setattr(_valhalla, 'METRICS_PATH', str(work / 'metrics'))
+    monkeypatch.setattr(_valhalla, 'vehicle_ids', lambda: dict(fleet))
+    assert luigi.build([task], local_scheduler=True, log_level='WARNING')
+
+    with open(MatchToNetwork(DATES).output().fn, 'rb') as pf:
+        seq_files = pickle.load(pf)
+    contents = {}
+    for fn in seq_files:
+        with open(fn) as sf:
+            contents[os.path.basename(fn)] = sf.read()
+    assert len(contents) == len(seq_files)
+    return contents
+
+def test_merge_shards(fleet, tmp_path, monkeypatch):
+    monkeypatch.setattr(_valhalla, 'MATCHER_BACKEND', _valhalla.MatcherBackend.SERVICE)
+    monkeypatch.setattr(_valhalla, 'VALHALLA_SERVICE_COMMAND', FAKE)
+    monkeypatch.setattr(_valhalla, '_match_cache', None)
+
+    unsharded = _run(MatchToNetwork(DATES), tmp_path / 'unsharded', fleet, monkeypatch)
+    assert sorted(unsharded) == sorted('{}.json'.format(k) for k in fleet)
+    assert _run(MergeShards(DATES, 3), tmp_path / 'sharded', fleet, monkeypatch) == unsharded
+
+    # and the work was split between the shards.
+    for shard in range(3):
+        with open(MatchToNetwork(DATES, shard, 3).output().fn, 'rb') as pf:
+            assert 0 < len(pickle.load(pf)) < len(fleet)
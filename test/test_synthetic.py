@@ -0,0 +1,34 @@
+from datetime import date
+import numpy as np
+from pytest import approx
+from cvts import rawfiles2jsonchunks, json2geojson
+from cvts._trace import trip_to_request
+from cvts._synthetic import VIETNAM_BBOX, vehicle_day, write_csv_fleet
+from cvts._fake_matcher import trace_attributes
+
+
+
+def test_vehicle_day():
+    trace = vehicle_day(np.random.default_rng(1), (105.85, 21.03), date(2020, 4, 5))
+    assert len(trace) > 0
+    assert np.all(np.diff(trace['time']) > 0)
+    assert np.all((trace['lon'] >= VIETNAM_BBOX[0]) & (trace['lon'] <= VIETNAM_BBOX[2]))
+    assert np.all((trace['lat'] >= VIETNAM_BBOX[1]) & (trace['lat'] <= VIETNAM_BBOX[3]))
+
+def test_fleet_through_fake_matcher(tmp_path):
+    dates = [date(2020, 4, 5), date(2020, 4, 6)]
+    assert write_csv_fleet(str(tmp_path), 2, dates, seed=3) > 0
+
+    files = sorted(str(f) for f in tmp_path.glob('*/SYN000001.csv'))
+    assert len(files) == 2
+    _, trips = rawfiles2jsonchunks(files, True, dates)
+    trips = [trip_to_request(t) for _, t in trips]
+    assert len(trips) > 1
+
+    for trip in trips:
+        res = trace_attributes(trip)
+        assert res == trace_attributes(trip)
+        assert len(res['matched_points']) == len(trip['shape'])
+        line = json2geojson(res, True)['features'][0]['geometry']['coordinates']
+        assert line[0] == approx(
+            [trip['shape'][0]['lon'], trip['shape'][0]['lat']], abs=1e-5)
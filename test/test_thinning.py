@@ -0,0 +1,87 @@
+import numpy as np
+from cvts._trace import make_trace, trip_to_request
+from cvts._utils import _thin_indices
+from cvts._fake_matcher import trace_attributes
+from cvts.tasks import _valhalla
+from cvts.tasks._valhalla import _thin_trip, _unthin
+
+def _trace():
+    # crawl (~1m per ping) for a while, drive (~100m per ping), then wait
+    # (no movement, but long enough to exceed the maximum interval).
+    lon = np.concatenate((
+        105. + np.arange(30) * 1e-5,
+        105.0003 + np.arange(1, 21) * 1e-3,
+        np.full(15, 105.0203)))
+    n = len(lon)
+    time = np.arange(n) * 10.
+    return make_trace(np.full(n, 10.), lon, time, np.zeros(n), np.zeros(n))
+
+def test_thin_indices():
+    trace = _trace()
+    keep = _thin_indices(trace, 20, 60)
+    assert keep[0] == 0 and keep[-1] == len(trace) - 1
+    assert keep == sorted(set(keep))
+    # every driving point is kept, crawling and waiting points only every
+    # max_interval seconds.
+    assert all(i in keep for i in range(30, 50))
+    assert len([i for i in keep if i < 30]) <= 30 * 10 // 60 + 2
+    assert len(keep) < len(trace)
+
+    assert _thin_indices(trace[:2], 20, 60) == [0, 1]
+    assert _thin_indices(trace[:1], 20, 60) == [0]
+
+def test_unthin():
+    trip = {'shape': _trace()}
+    thinned, mapping = _thin_trip(trip)
+    keep = _thin_indices(trip['shape'], 20, 60)
+    assert len(thinned['shape']) == len(keep) < len(trip['shape'])
+    assert (thinned['shape'] == trip['shape'][keep]).all()
+
+    snapped = _unthin(trace_attributes(trip_to_request(thinned)), mapping)
+    mps = snapped['matched_points']
+    assert len(mps) == len(trip['shape'])
+
+    # kept points have their own match; dropped points take the match of the
+    # last kept point before them, with an edge between those of the kept
+    # points either side.
+    last = None
+    for i, (mp, t) in enumerate(zip(mps, trip['shape'])):
+        if i in keep:
+            assert mp['type'] == 'matched'
+            assert (mp['lon'], mp['lat']) == (t['lon'], t['lat'])
+            last = mp
+        else:
+            nxt = mps[min(k for k in keep if k > i)]
+            assert mp['type'] == 'thinned'
+            assert (mp['lon'], mp['lat']) == (last['lon'], last['lat'])
+            assert last['edge_index'] <= mp['edge_index'] <= nxt['edge_index']
+
+def test_unthin_interpolates_edges(monkeypatch):
+    # keep only every fifth point (every minute) while driving across edges,
+    # then wait.
+    monkeypatch.setattr(_valhalla, 'THIN_MIN_DISTANCE', 10000)
+    lon = np.concatenate((105.0001 + np.arange(21) * 1e-3, np.full(8, 105.0201)))
+    n = len(lon)
+    trip = {'shape': make_trace(
+        np.full(n, 10.), lon, np.arange(n) * 12., np.zeros(n), np.zeros(n))}
+    thinned, mapping = _thin_trip(trip)
+    assert _thin_indices(trip['shape'], 10000, 60) == [0, 5, 10, 15, 20, 25, 28]
+    edges = [mp['edge_index'] for mp in \
+        trace_attributes(trip_to_request(thinned))['matched_points']]
+    assert edges == [0, 1, 2, 3, 4, 4, 4]
+
+    # dropped points take the edge of the nearer kept point.
+    mps = _unthin(trace_attributes(trip_to_request(thinned)), mapping)['matched_points']
+    assert [mp['edge_index'] for mp in mps] == \
+        sum(([e] * 3 + [e + 1] * 2 for e in range(4)), []) + [4] * 9
+    # and are at most one edge (grid cell) from those matched without thinning.
+    truth = trace_attributes(trip_to_request(trip))
+    true_ids = [truth['edges'][mp['edge_index']]['id'] for mp in truth['matched_points']]
+    ids = [e['id'] for e in trace_attributes(trip_to_request(thinned))['edges']]
+    assert max(abs(ids[mp['edge_index']] - t) for mp, t in zip(mps, true_ids)) \
+        == 1000000
+
+def test_nothing_to_thin():
+    trace = _trace()[30:50]
+    trip = {'shape': trace}
+    assert _thin_trip(trip) == (trip, None)
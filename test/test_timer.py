@@ -0,0 +1,109 @@
+import json
+import threading
+from datetime import date
+from pytest import approx
+from cvts import _timer
+from cvts._timer import collect, stage, tally, merge, summarise
+from cvts.tasks import _valhalla, MatchToNetwork, SummariseMatchMetrics
+
+DATES = [date(2020, 4, 5), date(2020, 4, 6)]
+
+class Clock:
+    """A clock that only moves when told to."""
+    def __init__(self):
+        self.now = 0.
+    def __call__(self):
+        return self.now
+    def advance(self, seconds):
+        self.now += seconds
+
+def _record(worker, total, points, **durations):
+    return {'worker': worker, 'total': total,
+        'durations': durations, 'counts': {'points': points}}
+
+def _run_in_thread(f, *args):
+    t = threading.Thread(target=f, args=args)
+    t.start()
+    t.join()
+
+def test_collect_and_merge(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(_timer, 'default_timer', clock)
+
+    def outside():
+        with stage('match'):
+            tally('points', 100)
+
+    def in_thread(out):
+        # e.g., prefetching the trace.
+        with collect() as metrics:
+            with stage('load'):
+                clock.advance(3.)
+            tally('points', 10)
+        out.append(metrics.record())
+
+    with collect(vehicle='a') as metrics:
+        with stage('load'):
+            clock.advance(2.)
+        with stage('match'):
+            clock.advance(1.)
+            # other threads have their own (here, no) active metrics.
+            _run_in_thread(outside)
+        tally('points', 5)
+        records = []
+        _run_in_thread(in_thread, records)
+        merge(records[0])
+
+    record = metrics.record()
+    assert record['vehicle'] == 'a'
+    assert record['total'] == approx(6.)
+    assert record['durations'] == approx({'load': 5., 'match': 1.})
+    assert record['counts'] == {'points': 15}
+    assert records[0]['total'] == approx(3.)
+
+def test_summarise():
+    # stage 'match' takes 1, 2, ... 100 seconds; 'load' is only in half.
+    records = [_record('w{}'.format(i % 2), i + .5, 10 * i, match=i, \
+        **({'load': .5} if i % 2 else {})) for i in range(1, 101)]
+    summary = summarise(records)
+
+    assert summary['records'] == 100
+    assert summary['stages']['match'] == approx(
+        {'p50': 50.5, 'p95': 95.05, 'p99': 99.01, 'sum': 5050.})
+    assert summary['stages']['load'] == approx(
+        {'p50': .5, 'p95': .5, 'p99': .5, 'sum': 25.})
+    assert summary['stages']['total']['sum'] == approx(5100.)
+
+    odd = summary['workers']['w1']
+    assert odd['records'] == 50
+    assert odd['points'] == 10 * 2500
+    assert odd['seconds'] == approx(2525.)
+    assert odd['points_per_second'] == approx(25000 / 2525)
+
+def test_summarise_empty():
+    assert summarise([]) == {'records': 0, 'stages': {}, 'workers': {}}
+
+def test_summarise_match_metrics(tmp_path, monkeypatch):
+    monkeypatch.setattr(_valhalla, 'METRICS_PATH', str(tmp_path))
+    records = [_record('w0', 2., 10, match=1.), _record('w1', 4., 30, match=3.)]
+    # the metrics of two shards, which are summarised together...
+    for shard, record in enumerate(records):
+        with open(MatchToNetwork(DATES, shard, 2).metrics_file_name, 'w') as mf:
+            mf.write(json.dumps(record) + '\n\n')
+    # ... and not with those of a run for other dates.
+    with open(MatchToNetwork(DATES[:1], 0, 2).metrics_file_name, 'w') as mf:
+        mf.write(json.dumps(_record('w0', 100., 1, match=99.)) + '\n')
+
+    def summary(task):
+        task.run()
+        with open(task.output().fn) as sf:
+            return json.load(sf)
+
+    task = SummariseMatchMetrics(DATES, n_shards=2)
+    assert summary(task) == json.loads(json.dumps(summarise(records)))
+    assert summary(task)['stages']['match']['p50'] == approx(2.)
+    assert summary(task)['workers']['w1']['points_per_second'] == approx(7.5)
+    # or those of one shard.
+    shard = SummariseMatchMetrics(DATES, 1, 2)
+    assert shard.output().fn != task.output().fn
+    assert summary(shard) == json.loads(json.dumps(summarise(records[1:])))
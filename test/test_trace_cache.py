@@ -0,0 +1,48 @@
+import os
+from datetime import date
+import numpy as np
+from cvts._trace import make_trace
+from cvts._trace_cache import TraceCache, day_slices
+
+
+
+def _reader(calls):
+    def read(source):
+        calls.append(source)
+        times = np.loadtxt(source, ndmin=1)
+        n = len(times)
+        return make_trace(np.zeros(n), np.zeros(n), times, np.zeros(n), np.arange(n))
+    return read
+
+def test_trace_cache(tmp_path):
+    root = tmp_path / 'raw'
+    (root / '04').mkdir(parents=True)
+    source = root / '04' / 'vehicle_1.zip'
+    # rows out of order over three days.
+    day = 86400
+    times = [18360 * day + 5, 18362 * day + 1, 18360 * day + 2, 18361 * day, 18362 * day]
+    np.savetxt(source, times)
+
+    calls = []
+    cache = TraceCache(str(tmp_path / 'cache'), str(root))
+    dates = [date(2020, 4, 8), date(2020, 4, 9), date(2020, 4, 10)]
+
+    trace, index = cache.get(str(source), _reader(calls))
+    days = list(day_slices(trace, index, dates + [date(2020, 4, 11)]))
+    assert [list(d['speed']) for d in days] == [[0, 2], [3], [1, 4], []]
+    assert len(calls) == 1
+
+    # served from the cache.
+    trace, index = cache.get(str(source), _reader(calls))
+    assert len(calls) == 1
+    assert isinstance(trace, np.memmap)
+    assert [list(d['speed']) for d in day_slices(trace, index, dates)] == \
+        [[0, 2], [3], [1, 4]]
+
+    # converted again when the source changes.
+    np.savetxt(source, times[:2])
+    st = os.stat(source)
+    os.utime(source, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    trace, index = cache.get(str(source), _reader(calls))
+    assert len(calls) == 2
+    assert [len(d) for d in day_slices(trace, index, dates)] == [1, 0, 1]
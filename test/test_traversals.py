@@ -0,0 +1,121 @@
+import os
+import time
+from datetime import datetime
+from functools import reduce
+import numpy as np
+import pandas as pd
+from pytest import approx
+from cvts._traversals import time_fields
+from cvts.tasks._valhalla import (
+    _traversals,
+    MM_KEYS,
+    NA_VALUE,
+    TRAVERSAL_KEYS,
+    TRAVERSAL_INDS)
+
+
+
+def _reference_traversals(results, edge_ids):
+    """The pandas implementation that :py:func:`_traversals` replaced."""
+    df = pd.DataFrame({k:r[i] for k, i in zip(
+        TRAVERSAL_KEYS, TRAVERSAL_INDS)} for r in results)
+    df.drop(df[(df.status == 'failure') | (df.edge_id == NA_VALUE)].index, inplace=True)
+    if df.shape[0] == 0:
+        return []
+    df['edge_id'] = df['edge_id'].astype(np.uint64)
+
+    def ave_speed(df):
+        return pd.Series({
+            'edge_id'  : df['edge_id'].iloc[0],
+            'speed'    : np.average(df['speed']),
+            'weight'   : df.shape[0],
+            'timestamp': int(np.average(df['time']))})
+
+    speed = df[df.speed > 6].groupby(['edge_index']).apply(
+        ave_speed).reset_index(drop=True)
+
+    def edge_times(i1, i2, t1, t2):
+        d = int(i2 - i1)
+        if d < 2: return []
+        dfrac = 1. / float(d)
+        tdiff = float(t2 - t1)
+        return [(
+            int(i1 + i + 1),
+            int(t1 + (float(i)+1.) * dfrac * tdiff)) for i in range(d-1)]
+
+    eds = reduce(lambda a, n: a + edge_times(*n), zip(
+        df['edge_index'].iloc[ :-1], df['edge_index'].iloc[1:  ],
+        df['time'].iloc[ :-1], df['time'].iloc[1:  ]), [])
+
+    def times(ts):
+        d  = datetime.fromtimestamp(int(ts))
+        _, week, day = d.isocalendar()
+        return int(ts), d.hour, day - 1, 7*(week - 1) + day - 1, week - 1
+
+    out = [(int(l['edge_id']),) + times(l['timestamp']) + (l['speed'], l['weight']) \
+        for _, l in speed.iterrows()]
+    return out + [(edge_ids[i],) + times(t) + (None, 1) for i, t in eds]
+
+
+
+def _random_results(rng, n):
+    edge_index = np.sort(rng.integers(0, n // 2 + 3, n))
+    edge_ids = list(rng.integers(1, 2**40, edge_index.max() + 1))
+    t0 = rng.integers(1.4e9, 1.7e9)
+    times = t0 + np.cumsum(rng.integers(1, 60, n)).astype(float)
+    results = []
+    for ei, t in zip(edge_index, times):
+        status = 'failure' if rng.random() < .05 else 'success'
+        edge_id = NA_VALUE if rng.random() < .05 else edge_ids[ei]
+        point = {k: None for k in MM_KEYS}
+        point.update(
+            edge_id=edge_id,
+            edge_index=int(ei),
+            status=status,
+            speed=float(rng.integers(0, 60)),
+            time=t)
+        results.append(tuple(point[k] for k in MM_KEYS))
+    return results, edge_ids
+
+def test_traversals_match_reference():
+    rng = np.random.default_rng(42)
+    for n in (1, 2, 5, 50, 500):
+        results, edge_ids = _random_results(rng, n)
+        expected = _reference_traversals(results, edge_ids)
+        travs = _traversals(results, edge_ids)
+        if travs is None:
+            assert expected == []
+            continue
+
+        got = list(zip(*(travs[k].tolist() for k in (
+            'edge', 'timestamp', 'hour', 'dow', 'doy', 'woy', 'speed', 'count'))))
+        assert len(got) == len(expected)
+        for g, e in zip(got, expected):
+            assert g[:6] == e[:6]
+            assert g[7] == e[7]
+            if e[6] is None:
+                assert np.isnan(g[6])
+            else:
+                assert g[6] == approx(e[6])
+
+def test_time_fields():
+    tz = os.environ.get('TZ')
+    ts = np.random.default_rng(0).integers(0, 2e9, 5000)
+    # include times around the turn of years with 53 ISO weeks.
+    ts = np.concatenate((ts, np.arange(1577750400, 1578009600, 1800)))
+    try:
+        for zone in ('UTC', 'Asia/Ho_Chi_Minh', 'Europe/London', 'Asia/Kathmandu'):
+            os.environ['TZ'] = zone
+            time.tzset()
+            expected = []
+            for t in ts:
+                d = datetime.fromtimestamp(int(t))
+                _, week, day = d.isocalendar()
+                expected.append((d.hour, day - 1, 7*(week - 1) + day - 1, week - 1))
+            assert list(zip(*(f.tolist() for f in time_fields(ts)))) == expected
+    finally:
+        if tz is None:
+            os.environ.pop('TZ')
+        else:
+            os.environ['TZ'] = tz
+        time.tzset()
@@ -0,0 +1,100 @@
+import numpy as np
+from cvts._trace import make_trace
+from cvts._utils import _loadcsv, _trip_slices, distance
+from cvts.settings import MIN_STOP_TIME, MIN_MOVING_SPEED, MIN_MOVE_DISTANCE
+
+
+
+def _reference_trip_slices(locs):
+    """The loop that :py:func:`_trip_slices` replaced."""
+    if len(locs) == 0:
+        yield 0, locs
+        return
+
+    ts, ss, ys, xs = (locs[k].tolist() for k in ('time', 'speed', 'lat', 'lon'))
+    last_moved_time, ly, lx = ts[0], ys[0], xs[0]
+    next_chunk        = [0]
+    stationary_points = []
+
+    for i in range(1, len(ts)):
+        t, s, y, x = ts[i], ss[i], ys[i], xs[i]
+        has_moved = s > MIN_MOVING_SPEED or distance(lx, ly, x, y) > MIN_MOVE_DISTANCE
+
+        if has_moved:
+            if t - last_moved_time > MIN_STOP_TIME:
+                nsp = len(stationary_points)
+                if nsp > 0:
+                    next_chunk.append(stationary_points[0])
+                    yield nsp, locs[next_chunk]
+                    next_chunk = [stationary_points[-1], i]
+                else:
+                    yield nsp, locs[next_chunk]
+                    next_chunk = [i]
+            else:
+                next_chunk.append(i)
+            del stationary_points[:]
+            lx, ly, last_moved_time = x, y, t
+
+        else:
+            stationary_points.append(i)
+
+    nsp = len(stationary_points)
+    if nsp > 0:
+        next_chunk.append(stationary_points[0])
+    yield nsp, locs[next_chunk]
+
+
+
+def _random_trace(rng, n, p_stop=.05, p_gap=.01, speed_zero=False):
+    """A trace alternating between driving, crawling and waiting (with GPS
+    jitter), with occasional gaps in the data."""
+    lat, lon = 21. + rng.random(), 105. + rng.random()
+    t = 1.6e9
+    lats, lons, times, speeds = [], [], [], []
+    mode = 'drive'
+    for _ in range(n):
+        r = rng.random()
+        if r < p_stop:
+            mode = rng.choice(['drive', 'crawl', 'wait'])
+        if mode == 'drive':
+            step, speed = 2e-3, rng.uniform(10, 60)
+        elif mode == 'crawl':
+            step, speed = 4e-4, rng.uniform(0, 2 * MIN_MOVING_SPEED)
+        else:
+            step, speed = 5e-5, 0.
+        lat += rng.normal(0, step)
+        lon += rng.normal(0, step)
+        t += rng.integers(1, 30) + (rng.integers(600, 7200) if rng.random() < p_gap else 0)
+        lats.append(lat); lons.append(lon); times.append(t)
+        speeds.append(0. if speed_zero else speed)
+    return make_trace(lats, lons, times, np.zeros(n), speeds)
+
+
+
+def _check(trace):
+    expected = list(_reference_trip_slices(trace))
+    got = list(_trip_slices(trace))
+    assert len(got) == len(expected)
+    for (gn, gt), (en, et) in zip(got, expected):
+        assert gn == en
+        assert np.array_equal(gt, et)
+
+def test_trip_slices_empty_and_short():
+    _check(make_trace([], [], [], [], []))
+    _check(make_trace([21.], [105.], [0.], [0.], [0.]))
+    _check(make_trace([21., 21.], [105., 105.], [0., 1000.], [0., 0.], [0., 20.]))
+
+def test_trip_slices_random():
+    rng = np.random.default_rng(1)
+    for n in (2, 3, 10, 100, 1000, 5000):
+        for p_stop, p_gap in ((.05, .01), (.2, .05), (.01, 0.)):
+            _check(_random_trace(rng, n, p_stop, p_gap))
+
+def test_trip_slices_speed_always_zero():
+    # every move is detected by distance, which exercises long chains.
+    rng = np.random.default_rng(2)
+    for n in (10, 1000, 5000):
+        _check(_random_trace(rng, n, speed_zero=True))
+
+def test_trip_slices_test_csv():
+    _check(_loadcsv('test.csv'))
@@ -0,0 +1,82 @@
+import pickle
+import importlib
+from datetime import date
+import pytest
+import pandas as pd
+import shapely.wkt
+from shapely.geometry import box
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from cvts.tasks import _valhalla, ListRawFiles
+
+D1, D2 = date(2020, 4, 5), date(2020, 4, 6)
+
+def _postgis_functions(dbapi_connection, connection_record):
+    # stand-ins for the PostGIS functions vehicle_days uses (geometries are
+    # stored as WKT).
+    if hasattr(dbapi_connection, 'create_function'):
+        dbapi_connection.create_function('ST_SRID', 1, lambda g: 4326)
+        dbapi_connection.create_function('ST_MakeEnvelope', 5,
+            lambda x0, y0, x1, y1, srid: box(x0, y0, x1, y1).wkt)
+        dbapi_connection.create_function('ST_Intersects', 2,
+            lambda a, b: a is not None and \
+                shapely.wkt.loads(a).intersects(shapely.wkt.loads(b)))
+
+@pytest.fixture
+def data_retrieval(tmp_path, monkeypatch):
+    """:py:mod:`cvts._data_retrieval` using a lake (in SQLite) with a
+    *vehicle_days* table."""
+    conn = 'sqlite:///{}'.format(tmp_path / 'lake.sqlite')
+    monkeypatch.setenv('DATALAKE_CONNECTION_STRING', conn)
+    monkeypatch.setenv('DATALAKE_RAW_PATH', str(tmp_path))
+    module = importlib.import_module('cvts._data_retrieval')
+    monkeypatch.setattr(module, 'DATALAKE_CONNECTION_STRING', conn)
+
+    pd.DataFrame([
+        # vehicle, day, pings, bounding box
+        (1, D1, 5, box(105.8, 21.0, 105.9, 21.1).wkt),
+        (1, D2, 0, None),
+        (2, D1, 2, box(105.8, 21.0, 105.9, 21.1).wkt),
+        (3, D1, 4, box(106.6, 10.7, 106.7, 10.8).wkt),
+        (3, D2, 6, box(105.7, 20.9, 105.85, 21.05).wkt)],
+        columns=['vehicle_id', 'day', 'pings', 'geom']).to_sql(
+        'vehicle_days', conn, index=False)
+
+    event.listen(Engine, 'connect', _postgis_functions)
+    yield module
+    event.remove(Engine, 'connect', _postgis_functions)
+
+def test_vehicle_days(data_retrieval):
+    vehicle_days = data_retrieval.vehicle_days
+    assert vehicle_days() == {1: {D1: 5}, 2: {D1: 2}, 3: {D1: 4, D2: 6}}
+    # days without pings are not listed.
+    assert vehicle_days([D2]) == {3: {D2: 6}}
+
+def test_vehicle_days_min_pings(data_retrieval):
+    vehicle_days = data_retrieval.vehicle_days
+    # the pings are counted over the days considered.
+    assert vehicle_days([D1, D2], min_pings=5) == {1: {D1: 5}, 3: {D1: 4, D2: 6}}
+    assert vehicle_days([D1], min_pings=5) == {1: {D1: 5}}
+
+def test_vehicle_days_bbox(data_retrieval):
+    vehicle_days = data_retrieval.vehicle_days
+    hanoi = (105.5, 20.8, 106., 21.2)
+    assert vehicle_days(bbox=hanoi) == {1: {D1: 5}, 2: {D1: 2}, 3: {D2: 6}}
+    assert vehicle_days([D1], 3, hanoi) == {1: {D1: 5}}
+
+def test_list_raw_files_for_dates(tmp_path, monkeypatch):
+    files = {
+        'a': [str(tmp_path / '20200405' / 'a.csv')],
+        'b': [str(tmp_path / '20200405' / 'b.csv'), str(tmp_path / '20200406' / 'b.csv')]}
+    monkeypatch.setattr(_valhalla, 'OUT_PATH', str(tmp_path))
+    monkeypatch.setattr(_valhalla, 'vehicle_ids', lambda: dict(files))
+
+    def listed(task):
+        task.run()
+        with open(task.output().fn, 'rb') as pf:
+            return sorted(pickle.load(pf))
+
+    # runs for different dates do not share outputs.
+    tasks = [ListRawFiles(dates) for dates in (None, [D1], [D2], [D1, D2])]
+    assert len(set(t.output().fn for t in tasks)) == len(tasks)
+    assert [listed(t) for t in tasks] == [['a', 'b'], ['a', 'b'], ['b'], ['a', 'b']]